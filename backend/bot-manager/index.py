@@ -1,23 +1,596 @@
 '''
-Business: Управление телеграм-ботами - создание, настройка, получение списка
-Args: event с httpMethod, body, queryStringParameters, headers с X-User-Id
+Business: Управление телеграм-ботами - создание, настройка, получение списка, рассылки подписчикам
+Args: event с httpMethod, body (bot_token или bot_tokens для массовой регистрации),
+      queryStringParameters (resource=broadcasts для рассылок),
+      headers с X-User-Id, If-None-Match, Accept-Encoding
       context с request_id
-Returns: HTTP response с данными бота или списком ботов
+Returns: HTTP response с данными бота, списком ботов или прогрессом рассылок
 '''
 
+import base64
+import bisect
+import gzip
+import hashlib
 import json
 import os
+import threading
+import time
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from typing import Dict, Any
+import psycopg2.pool
+from psycopg2.extras import RealDictCursor, execute_values
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Tuple
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def get_db_connection():
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', '300'))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.environ.get('DB_POOL_CHECKOUT_TIMEOUT', '10'))
+DB_POOL_LOG_METRICS = os.environ.get('DB_POOL_LOG_METRICS') == '1'
+
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED') == '1'
+TRACE_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Трассировка запроса: спаны копятся в потоке и в конце обработчика пишутся одной JSON-строкой;
+# при выключенной трассировке trace_span отдаёт общий пустой контекст и ничего не замеряет
+_trace_local = threading.local()
+_trace_lock = threading.Lock()
+TRACE_HISTOGRAMS: Dict[str, Dict[str, Any]] = {}
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+class _Span:
+    __slots__ = ('name', 'tags', 'started')
+
+    def __init__(self, name: str, tags: Dict[str, Any]):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.tags['error'] = exc_type.__name__
+        trace_record(self.name, (time.perf_counter() - self.started) * 1000, self.started, **self.tags)
+        return False
+
+def trace_span(name: str, **tags):
+    if not TRACE_ENABLED:
+        return _NOOP_SPAN
+    return _Span(name, tags)
+
+def trace_start():
+    if TRACE_ENABLED:
+        _trace_local.started = time.perf_counter()
+        _trace_local.spans = []
+        _trace_local.error = None
+
+def trace_record(name: str, elapsed_ms: float, started: float = None, **tags):
+    spans = getattr(_trace_local, 'spans', None) if TRACE_ENABLED else None
+    if spans is None:
+        return
+    at = (started if started is not None else time.perf_counter() - elapsed_ms / 1000) - _trace_local.started
+    spans.append({'name': name, 'at_ms': round(at * 1000, 3), 'ms': round(elapsed_ms, 3), **tags})
+
+def trace_error(error: Exception):
+    if TRACE_ENABLED:
+        _trace_local.error = f'{type(error).__name__}: {public_error(error)}'
+
+def _trace_observe(name: str, elapsed_ms: float):
+    histogram = TRACE_HISTOGRAMS.get(name)
+    if histogram is None:
+        histogram = TRACE_HISTOGRAMS[name] = {
+            'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * (len(TRACE_BUCKETS_MS) + 1)
+        }
+    histogram['count'] += 1
+    histogram['total_ms'] += elapsed_ms
+    histogram['max_ms'] = max(histogram['max_ms'], round(elapsed_ms, 3))
+    histogram['buckets'][bisect.bisect_left(TRACE_BUCKETS_MS, elapsed_ms)] += 1
+
+def flush_trace(function_name: str, context: Any):
+    spans = getattr(_trace_local, 'spans', None) if TRACE_ENABLED else None
+    if spans is None:
+        return
+    duration_ms = (time.perf_counter() - _trace_local.started) * 1000
+    with _trace_lock:
+        _trace_observe('request', duration_ms)
+        for span in spans:
+            _trace_observe(span['name'], span['ms'])
+    print(json.dumps({
+        'trace': function_name,
+        'request_id': getattr(context, 'request_id', None),
+        'duration_ms': round(duration_ms, 3),
+        'error': _trace_local.error,
+        'spans': spans
+    }, default=str))
+    _trace_local.spans = None
+
+def _statement_name(query: Any) -> str:
+    text = query[:160].decode(errors='replace') if isinstance(query, bytes) else str(query)[:160]
+    return ' '.join(text.split())[:80]
+
+_traced_cursors: Dict[type, type] = {}
+
+def _traced_cursor(base: type) -> type:
+    if base not in _traced_cursors:
+        class TracedCursor(base):
+            def execute(self, query, vars=None):
+                with trace_span('db.query', statement=_statement_name(query)):
+                    return super().execute(query, vars)
+
+        _traced_cursors[base] = TracedCursor
+    return _traced_cursors[base]
+
+class TracedConnection(psycopg2.extensions.connection):
+    # Подключается только при TRACE_ENABLED: каждый запрос, commit и rollback становится спаном
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _traced_cursor(base)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        with trace_span('db.commit'):
+            return super().commit()
+
+    def rollback(self):
+        with trace_span('db.rollback'):
+            return super().rollback()
+
+# Пул живёт на уровне модуля и переживает "тёплые" вызовы функции
+_pool_lock = threading.Condition()
+_pool_idle: List[Tuple[Any, float]] = []
+POOL_METRICS: Dict[str, Any] = {
+    'checkouts': 0,
+    'created': 0,
+    'discarded': 0,
+    'in_use': 0,
+    'idle': 0,
+    'last_wait_ms': 0.0,
+    'max_wait_ms': 0.0,
+    'total_wait_ms': 0.0
+}
+
+def _open_db_connection():
     dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn)
+    with trace_span('db.connect'):
+        conn = psycopg2.connect(dsn, connection_factory=TracedConnection if TRACE_ENABLED else None)
+    POOL_METRICS['created'] += 1
+    return conn
+
+def _discard_db_connection(conn):
+    POOL_METRICS['discarded'] += 1
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def _is_connection_healthy(conn, idle_for: float) -> bool:
+    if conn.closed:
+        return False
+    if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        return False
+    if idle_for < DB_POOL_CHECK_AFTER:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _reap_idle_connections(now: float):
+    while len(_pool_idle) > DB_POOL_MIN_SIZE and now - _pool_idle[0][1] > DB_POOL_IDLE_TIMEOUT:
+        conn, _ = _pool_idle.pop(0)
+        _discard_db_connection(conn)
+
+def get_db_connection():
+    # Под замком только ожидание слота и выбор кандидата; connect и проверка SELECT 1
+    # идут без замка, чтобы медленная сеть не останавливала выдачу соединений другим потокам
+    started = time.monotonic()
+    with _pool_lock:
+        _reap_idle_connections(started)
+        while not _pool_idle and POOL_METRICS['in_use'] >= DB_POOL_MAX_SIZE:
+            remaining = DB_POOL_CHECKOUT_TIMEOUT - (time.monotonic() - started)
+            if remaining <= 0 or not _pool_lock.wait(timeout=remaining):
+                raise psycopg2.pool.PoolError('connection pool exhausted')
+        POOL_METRICS['in_use'] += 1
+        candidate = _pool_idle.pop() if _pool_idle else None
+        POOL_METRICS['idle'] = len(_pool_idle)
+    
+    try:
+        while candidate is not None and not _is_connection_healthy(candidate[0], time.monotonic() - candidate[1]):
+            _discard_db_connection(candidate[0])
+            with _pool_lock:
+                candidate = _pool_idle.pop() if _pool_idle else None
+                POOL_METRICS['idle'] = len(_pool_idle)
+        conn = candidate[0] if candidate is not None else _open_db_connection()
+    except Exception:
+        with _pool_lock:
+            POOL_METRICS['in_use'] -= 1
+            _pool_lock.notify()
+        raise
+    
+    wait_ms = (time.monotonic() - started) * 1000
+    with _pool_lock:
+        POOL_METRICS['checkouts'] += 1
+        POOL_METRICS['last_wait_ms'] = round(wait_ms, 3)
+        POOL_METRICS['max_wait_ms'] = max(POOL_METRICS['max_wait_ms'], round(wait_ms, 3))
+        POOL_METRICS['total_wait_ms'] += wait_ms
+    trace_record('db.checkout', wait_ms)
+    return conn
+
+def release_db_connection(conn):
+    with _pool_lock:
+        POOL_METRICS['in_use'] -= 1
+        if conn.closed or len(_pool_idle) >= DB_POOL_MAX_SIZE:
+            _discard_db_connection(conn)
+        else:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                _pool_idle.append((conn, time.monotonic()))
+            except psycopg2.Error:
+                _discard_db_connection(conn)
+        POOL_METRICS['idle'] = len(_pool_idle)
+        _pool_lock.notify()
+
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org')
+TELEGRAM_TIMEOUT = float(os.environ.get('TELEGRAM_TIMEOUT', '10'))
+TELEGRAM_CONNECT_RETRIES = int(os.environ.get('TELEGRAM_CONNECT_RETRIES', '2'))
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', '10'))
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', 'https://functions.poehali.dev/af40ed3c-a51d-4f3f-ae16-ef69f32d3a02')
+
+# Keep-alive сессия живёт между "тёплыми" вызовами; повторяем только ошибки соединения,
+# чтобы не отправить сообщение дважды
+_telegram_session = requests.Session()
+_telegram_session.mount(TELEGRAM_API_BASE, HTTPAdapter(
+    pool_connections=TELEGRAM_POOL_SIZE,
+    pool_maxsize=TELEGRAM_POOL_SIZE,
+    max_retries=Retry(total=TELEGRAM_CONNECT_RETRIES, connect=TELEGRAM_CONNECT_RETRIES, read=0, status=0, other=0)
+))
+TELEGRAM_METRICS: Dict[str, Any] = {'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'methods': {}}
+
+def webhook_params(bot_id: int, webhook_secret: str) -> Dict[str, Any]:
+    # Токен в адрес не попадает: вебхук находит бота по id и сверяет секрет из заголовка
+    return {'url': f'{WEBHOOK_URL}?bot={bot_id}', 'secret_token': webhook_secret}
+
+def telegram_call(bot_token: str, method: str, payload: Dict[str, Any] = None, timeout: float = None) -> requests.Response:
+    started = time.monotonic()
+    try:
+        with trace_span('telegram.call', method=method):
+            return _telegram_session.post(
+                f'{TELEGRAM_API_BASE}/bot{bot_token}/{method}',
+                json=payload or {},
+                timeout=timeout or TELEGRAM_TIMEOUT
+            )
+    except requests.RequestException:
+        TELEGRAM_METRICS['errors'] += 1
+        raise
+    finally:
+        elapsed_ms = (time.monotonic() - started) * 1000
+        TELEGRAM_METRICS['calls'] += 1
+        TELEGRAM_METRICS['total_ms'] += elapsed_ms
+        TELEGRAM_METRICS['max_ms'] = max(TELEGRAM_METRICS['max_ms'], round(elapsed_ms, 3))
+        per_method = TELEGRAM_METRICS['methods'].setdefault(method, {'calls': 0, 'total_ms': 0.0})
+        per_method['calls'] += 1
+        per_method['total_ms'] += elapsed_ms
+
+def public_error(error: Exception) -> str:
+    # Текст исключений requests содержит URL с токеном бота - наружу и в трейс отдаём только тип
+    if isinstance(error, requests.RequestException):
+        return f'Telegram request failed: {type(error).__name__}'
+    return str(error)
+
+def log_pool_metrics(function_name: str, context: Any):
+    flush_trace(function_name, context)
+    if DB_POOL_LOG_METRICS:
+        print(json.dumps({
+            'function': function_name,
+            'request_id': getattr(context, 'request_id', None),
+            'db_pool': POOL_METRICS,
+            'telegram': TELEGRAM_METRICS,
+            'traces': TRACE_HISTOGRAMS if TRACE_ENABLED else None
+        }))
+
+GZIP_MIN_SIZE = int(os.environ.get('GZIP_MIN_SIZE', '1024'))
+
+def get_header(headers: Dict[str, str], name: str) -> str:
+    for key, value in (headers or {}).items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+def dumps(payload: Any) -> bytes:
+    # orjson сериализует datetime сам в том же ISO-формате, что и isoformat()
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, default=lambda value: value.isoformat(), ensure_ascii=False).encode()
+
+def not_modified_response(etag: str) -> Dict[str, Any]:
+    return {
+        'statusCode': 304,
+        'headers': {'ETag': etag, 'Cache-Control': 'no-cache', 'Access-Control-Allow-Origin': '*'},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def encoded_response(payload: Any, request_headers: Dict[str, str], etag: str) -> Dict[str, Any]:
+    body = dumps(payload)
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'ETag': etag,
+        'Cache-Control': 'no-cache',
+        'Vary': 'Accept-Encoding'
+    }
+    if len(body) >= GZIP_MIN_SIZE and 'gzip' in get_header(request_headers, 'accept-encoding'):
+        headers['Content-Encoding'] = 'gzip'
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': base64.b64encode(gzip.compress(body, compresslevel=5)).decode(),
+            'isBase64Encoded': True
+        }
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': body.decode(),
+        'isBase64Encoded': False
+    }
+
+BROADCAST_MAX_LENGTH = 4096
+BROADCAST_LIST_LIMIT = 20
+
+def broadcast_progress(row: Dict[str, Any]) -> Dict[str, Any]:
+    # Темп - обработанные получатели (доставлено, ошибка, блокировка) в секунду с момента запуска
+    broadcast = dict(row)
+    elapsed = float(broadcast.pop('elapsed_seconds') or 0)
+    processed = broadcast['sent_count'] + broadcast['failed_count'] + broadcast['blocked_count']
+    remaining = max(max(broadcast['total_count'], broadcast['queued_count']) - processed, 0)
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    broadcast['processed_count'] = processed
+    broadcast['per_second'] = round(rate, 2)
+    broadcast['eta_seconds'] = (
+        round(remaining / rate) if rate > 0 and broadcast['status'] in ('running', 'queued') else None
+    )
+    return broadcast
+
+BROADCAST_COLUMNS = '''bc.id, bc.bot_id, bc.message_text, bc.status, bc.total_count, bc.queued_count,
+                       bc.sent_count, bc.failed_count, bc.blocked_count, bc.created_at, bc.finished_at,
+                       bc.updated_at, EXTRACT(EPOCH FROM COALESCE(bc.finished_at, CURRENT_TIMESTAMP) - bc.created_at) AS elapsed_seconds'''
+
+BULK_MAX_TOKENS = int(os.environ.get('BULK_MAX_TOKENS', '500'))
+BULK_CONCURRENCY = int(os.environ.get('BULK_CONCURRENCY', str(TELEGRAM_POOL_SIZE)))
+DEFAULT_WELCOME_TEXT = 'Привет! Напиши мне сообщение, и я передам его владельцу.'
+
+def mask_token(bot_token: str) -> str:
+    # В ответе и логах токен узнаваем владельцу, но непригоден для использования
+    bot_id, _, secret = bot_token.partition(':')
+    return f'{bot_id}:…{secret[-4:]}'
+
+def check_token(bot_token: str) -> Tuple[str, str]:
+    try:
+        response = telegram_call(bot_token, 'getMe')
+    except requests.RequestException as e:
+        # Текст исключения содержит URL с токеном
+        return '', f'Telegram request failed: {type(e).__name__}'
+    try:
+        result = response.json()
+    except ValueError:
+        # Не-JSON ответ (HTML прокси, обрезанное тело) валит только этот токен, а не всю пачку
+        return '', 'Invalid Telegram response'
+    if response.status_code != 200 or not result.get('ok'):
+        return '', 'Invalid bot token'
+    return result['result']['username'], ''
+
+def set_webhook(bot: Dict[str, Any]) -> bool:
+    try:
+        response = telegram_call(bot['bot_token'], 'setWebhook', webhook_params(bot['id'], bot['webhook_secret']))
+    except requests.RequestException:
+        return False
+    return response.status_code == 200
+
+def register_bots(conn, cursor, user_id: str, bot_tokens: List[str], welcome_text: str) -> Dict[str, Any]:
+    # getMe и setWebhook идут параллельно через общую keep-alive сессию (не больше BULK_CONCURRENCY
+    # запросов одновременно), а все валидные боты сохраняются одним INSERT ... ON CONFLICT
+    tokens = list(dict.fromkeys(token.strip() for token in bot_tokens if token.strip()))
+    workers = max(1, min(BULK_CONCURRENCY, len(tokens)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        checks = dict(zip(tokens, executor.map(check_token, tokens)))
+        
+        valid = [(user_id, token, username, welcome_text) for token, (username, _) in checks.items() if username]
+        saved: Dict[str, Dict[str, Any]] = {}
+        if valid:
+            rows = execute_values(
+                cursor,
+                '''INSERT INTO bots (owner_id, bot_token, bot_username, welcome_text)
+                   VALUES %s
+                   ON CONFLICT (bot_token) DO UPDATE
+                   SET owner_id = EXCLUDED.owner_id,
+                       bot_username = EXCLUDED.bot_username,
+                       is_active = true,
+                       updated_at = CURRENT_TIMESTAMP
+                   RETURNING id, owner_id, bot_username, welcome_text, is_active, created_at, bot_token, webhook_secret,
+                             delivery_mode''',
+                valid,
+                page_size=len(valid),
+                fetch=True
+            )
+            conn.commit()
+            saved = {row['bot_token']: dict(row) for row in rows}
+        
+        # Вебхук у бота в режиме polling заставил бы getUpdates отвечать 409
+        webhook_bots = [bot for bot in saved.values() if bot['delivery_mode'] != 'polling']
+        webhooks = dict(zip((bot['bot_token'] for bot in webhook_bots), executor.map(set_webhook, webhook_bots)))
+    
+    results = []
+    for token in tokens:
+        bot = saved.get(token)
+        if bot:
+            bot.pop('bot_token')
+            bot.pop('webhook_secret')
+            bot.pop('delivery_mode')
+        results.append({
+            'token': mask_token(token),
+            'ok': bot is not None,
+            'bot': bot,
+            'webhook': webhooks.get(token, False),
+            'error': checks[token][1] or None
+        })
+    return {'success': True, 'registered': len(saved), 'failed': len(tokens) - len(saved), 'results': results}
+
+def handle_broadcasts(conn, cursor, method: str, user_id: str, event: Dict[str, Any]) -> Dict[str, Any]:
+    # Рассылки бота: GET - прогресс, POST - запуск, DELETE - отмена; отправляет диспетчер
+    query_params = event.get('queryStringParameters', {}) or {}
+    headers = event.get('headers', {})
+    
+    if method == 'GET':
+        bot_id = query_params.get('bot_id')
+        if not bot_id:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'bot_id is required'}),
+                'isBase64Encoded': False
+            }
+        
+        cursor.execute(
+            f'''SELECT {BROADCAST_COLUMNS}
+                FROM broadcasts bc
+                JOIN bots b ON b.id = bc.bot_id
+                WHERE bc.bot_id = %s AND b.owner_id = %s
+                ORDER BY bc.id DESC
+                LIMIT %s''',
+            (bot_id, user_id, BROADCAST_LIST_LIMIT)
+        )
+        rows = cursor.fetchall()
+        
+        versions = [f"{row['id']}:{row['updated_at']}:{row['status']}" for row in rows]
+        etag = f'"{hashlib.md5(",".join(versions).encode()).hexdigest()}"'
+        if get_header(headers, 'if-none-match') == etag:
+            return not_modified_response(etag)
+        
+        return encoded_response({'broadcasts': [broadcast_progress(row) for row in rows]}, headers, etag)
+    
+    if method == 'POST':
+        body = json.loads(event.get('body', '{}'))
+        bot_id = body.get('bot_id')
+        text = (body.get('text') or '').strip()
+        
+        if not bot_id or not text or len(text) > BROADCAST_MAX_LENGTH:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': f'bot_id and text (up to {BROADCAST_MAX_LENGTH} characters) are required'}),
+                'isBase64Encoded': False
+            }
+        
+        cursor.execute(
+            f'''WITH bc AS (
+                    INSERT INTO broadcasts (bot_id, message_text, total_count)
+                    SELECT b.id, %s, (SELECT COUNT(*) FROM bot_subscribers s WHERE s.bot_id = b.id AND s.blocked_at IS NULL)
+                    FROM bots b
+                    WHERE b.id = %s AND b.owner_id = %s AND b.is_active = true
+                    RETURNING *
+                )
+                SELECT {BROADCAST_COLUMNS}, pg_notify('outbox_pending', '') FROM bc''',
+            (text, bot_id, user_id)
+        )
+        row = cursor.fetchone()
+        
+        if not row:
+            return {
+                'statusCode': 404,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Bot not found'}),
+                'isBase64Encoded': False
+            }
+        
+        conn.commit()
+        broadcast = dict(row)
+        broadcast.pop('pg_notify')
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, 'broadcast': broadcast_progress(broadcast)}, default=str),
+            'isBase64Encoded': False
+        }
+    
+    if method == 'DELETE':
+        broadcast_id = query_params.get('broadcast_id')
+        if not broadcast_id:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'broadcast_id is required'}),
+                'isBase64Encoded': False
+            }
+        
+        # Уже взятые диспетчером записи доотправятся, остальные снимаются с очереди
+        cursor.execute(
+            '''WITH cancelled AS (
+                   UPDATE broadcasts bc
+                   SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                   FROM bots b
+                   WHERE bc.id = %s AND b.id = bc.bot_id AND b.owner_id = %s
+                     AND bc.status IN ('running', 'queued')
+                   RETURNING bc.id
+               ), dropped AS (
+                   UPDATE outbox SET status = 'cancelled'
+                   WHERE broadcast_id IN (SELECT id FROM cancelled) AND status = 'pending'
+                   RETURNING 1
+               )
+               SELECT (SELECT COUNT(*) FROM cancelled) AS cancelled, (SELECT COUNT(*) FROM dropped) AS dropped''',
+            (broadcast_id, user_id)
+        )
+        result = cursor.fetchone()
+        
+        if not result['cancelled']:
+            return {
+                'statusCode': 404,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Active broadcast not found'}),
+                'isBase64Encoded': False
+            }
+        
+        conn.commit()
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, 'dropped': result['dropped']}),
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 405,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'error': 'Method not allowed'}),
+        'isBase64Encoded': False
+    }
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
+    trace_start()
     
     if method == 'OPTIONS':
         return {
@@ -25,7 +598,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -39,8 +612,31 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
+        if (event.get('queryStringParameters') or {}).get('resource') == 'broadcasts':
+            return handle_broadcasts(conn, cursor, method, user_id, event)
+        
         if method == 'POST':
             body = json.loads(event.get('body', '{}'))
+            
+            if 'bot_tokens' in body:
+                bot_tokens = body['bot_tokens']
+                if (not isinstance(bot_tokens, list) or not bot_tokens or len(bot_tokens) > BULK_MAX_TOKENS
+                        or not all(isinstance(token, str) for token in bot_tokens)):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': f'bot_tokens must be a list of 1 to {BULK_MAX_TOKENS} tokens'}),
+                        'isBase64Encoded': False
+                    }
+                
+                result = register_bots(conn, cursor, user_id, bot_tokens, body.get('welcome_text', DEFAULT_WELCOME_TEXT))
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps(result, default=str, ensure_ascii=False),
+                    'isBase64Encoded': False
+                }
+            
             bot_token = body.get('bot_token', '').strip()
             
             if not bot_token:
@@ -51,8 +647,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            telegram_api_url = f'https://api.telegram.org/bot{bot_token}/getMe'
-            response = requests.get(telegram_api_url, timeout=10)
+            response = telegram_call(bot_token, 'getMe')
             
             if response.status_code != 200:
                 return {
@@ -81,13 +676,18 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                        bot_username = EXCLUDED.bot_username,
                        is_active = true,
                        updated_at = CURRENT_TIMESTAMP
-                   RETURNING id, owner_id, bot_username, welcome_text, is_active, created_at''',
-                (user_id, bot_token, bot_username, body.get('welcome_text', 'Привет! Напиши мне сообщение, и я передам его владельцу.'))
+                   RETURNING id, owner_id, bot_username, welcome_text, is_active, created_at, webhook_secret, delivery_mode''',
+                (user_id, bot_token, bot_username, body.get('welcome_text', DEFAULT_WELCOME_TEXT))
             )
             
             bot_data = dict(cursor.fetchone())
             conn.commit()
             
+            webhook_secret = bot_data.pop('webhook_secret')
+            # Бот в режиме polling забирает обновления через getUpdates, вебхук ему не ставим
+            if bot_data.pop('delivery_mode') != 'polling':
+                telegram_call(bot_token, 'setWebhook', webhook_params(bot_data['id'], webhook_secret))
+            
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -97,34 +697,56 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         elif method == 'GET':
             cursor.execute(
-                'SELECT id, bot_username, welcome_text, is_active, created_at FROM bots WHERE owner_id = %s AND is_active = true',
+                '''SELECT b.id, b.bot_username, b.welcome_text, b.is_active, b.created_at, b.retention_days,
+                          COALESCE(s.unread_count, 0) AS unread_count,
+                          COALESCE(s.total_count, 0) AS total_count,
+                          s.last_message_at,
+                          b.updated_at, COALESCE(s.version, 0) AS version
+                   FROM bots b
+                   LEFT JOIN bot_stats s ON s.bot_id = b.id
+                   WHERE b.owner_id = %s AND b.is_active = true
+                   ORDER BY b.id''',
                 (user_id,)
             )
             bots = [dict(row) for row in cursor.fetchall()]
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'bots': bots}, default=str),
-                'isBase64Encoded': False
-            }
+            # ETag по настройкам и версиям сообщений ботов: без изменений отвечаем 304 без сериализации
+            versions = [f"{bot['id']}:{bot.pop('updated_at')}:{bot.pop('version')}" for bot in bots]
+            etag = f'"{hashlib.md5(",".join(versions).encode()).hexdigest()}"'
+            if get_header(headers, 'if-none-match') == etag:
+                return not_modified_response(etag)
+            
+            return encoded_response({'bots': bots}, headers, etag)
         
         elif method == 'PUT':
             body = json.loads(event.get('body', '{}'))
             bot_id = body.get('bot_id')
             welcome_text = body.get('welcome_text')
+            has_retention = 'retention_days' in body
+            retention_days = body.get('retention_days')
             
-            if not bot_id or not welcome_text:
+            if not bot_id or not (welcome_text or has_retention):
                 return {
                     'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'bot_id and welcome_text are required'}),
+                    'body': json.dumps({'error': 'bot_id and welcome_text or retention_days are required'}),
+                    'isBase64Encoded': False
+                }
+            
+            if retention_days is not None and (not isinstance(retention_days, int) or retention_days <= 0):
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'retention_days must be a positive integer or null'}),
                     'isBase64Encoded': False
                 }
             
             cursor.execute(
-                'UPDATE bots SET welcome_text = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s AND owner_id = %s RETURNING id',
-                (welcome_text, bot_id, user_id)
+                '''UPDATE bots SET welcome_text = COALESCE(%s, welcome_text),
+                                   retention_days = CASE WHEN %s THEN %s ELSE retention_days END,
+                                   updated_at = CURRENT_TIMESTAMP
+                   WHERE id = %s AND owner_id = %s RETURNING id''',
+                (welcome_text or None, has_retention, retention_days, bot_id, user_id)
             )
             
             if cursor.rowcount == 0:
@@ -187,13 +809,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     except Exception as e:
         conn.rollback()
+        trace_error(e)
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
+            'body': json.dumps({'error': public_error(e)}),
             'isBase64Encoded': False
         }
     
     finally:
         cursor.close()
-        conn.close()
+        release_db_connection(conn)
+        log_pool_metrics('bot-manager', context)
@@ -1,37 +1,635 @@
 '''
-Business: Получение списка входящих сообщений для бота
-Args: event с httpMethod GET, queryStringParameters с bot_id, headers с X-User-Id
+Business: Получение списка входящих сообщений для бота, полнотекстовый поиск и массовая отметка прочитанными/архивация
+Args: event с httpMethod GET, queryStringParameters с bot_id и необязательными
+      before_id/after_id, is_read, archived, chat_id, date_from/date_to, since, limit, wait,
+      q и search_after для поиска, export (csv/jsonl) и export_after для выгрузки истории;
+      headers с X-User-Id, If-None-Match, Accept-Encoding
+      POST/PATCH body с bot_id, action (read/unread/archive) и message_ids, up_to_id или all
       context с request_id
-Returns: HTTP response со списком сообщений
+Returns: HTTP response со списком сообщений или частью выгрузки
 '''
 
+import base64
+import bisect
+import csv
+import gzip
+import hashlib
+import io
 import json
 import os
+import select
+import threading
+import time
 import psycopg2
+import psycopg2.pool
 from psycopg2.extras import RealDictCursor
-from typing import Dict, Any
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def get_db_connection():
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', '300'))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.environ.get('DB_POOL_CHECKOUT_TIMEOUT', '10'))
+DB_POOL_LOG_METRICS = os.environ.get('DB_POOL_LOG_METRICS') == '1'
+
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED') == '1'
+TRACE_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Трассировка запроса: спаны копятся в потоке и в конце обработчика пишутся одной JSON-строкой;
+# при выключенной трассировке trace_span отдаёт общий пустой контекст и ничего не замеряет
+_trace_local = threading.local()
+_trace_lock = threading.Lock()
+TRACE_HISTOGRAMS: Dict[str, Dict[str, Any]] = {}
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+class _Span:
+    __slots__ = ('name', 'tags', 'started')
+
+    def __init__(self, name: str, tags: Dict[str, Any]):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.tags['error'] = exc_type.__name__
+        trace_record(self.name, (time.perf_counter() - self.started) * 1000, self.started, **self.tags)
+        return False
+
+def trace_span(name: str, **tags):
+    if not TRACE_ENABLED:
+        return _NOOP_SPAN
+    return _Span(name, tags)
+
+def trace_start():
+    if TRACE_ENABLED:
+        _trace_local.started = time.perf_counter()
+        _trace_local.spans = []
+        _trace_local.error = None
+
+def trace_record(name: str, elapsed_ms: float, started: float = None, **tags):
+    spans = getattr(_trace_local, 'spans', None) if TRACE_ENABLED else None
+    if spans is None:
+        return
+    at = (started if started is not None else time.perf_counter() - elapsed_ms / 1000) - _trace_local.started
+    spans.append({'name': name, 'at_ms': round(at * 1000, 3), 'ms': round(elapsed_ms, 3), **tags})
+
+def trace_error(error: Exception):
+    if TRACE_ENABLED:
+        _trace_local.error = f'{type(error).__name__}: {error}'
+
+def _trace_observe(name: str, elapsed_ms: float):
+    histogram = TRACE_HISTOGRAMS.get(name)
+    if histogram is None:
+        histogram = TRACE_HISTOGRAMS[name] = {
+            'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * (len(TRACE_BUCKETS_MS) + 1)
+        }
+    histogram['count'] += 1
+    histogram['total_ms'] += elapsed_ms
+    histogram['max_ms'] = max(histogram['max_ms'], round(elapsed_ms, 3))
+    histogram['buckets'][bisect.bisect_left(TRACE_BUCKETS_MS, elapsed_ms)] += 1
+
+def flush_trace(function_name: str, context: Any):
+    spans = getattr(_trace_local, 'spans', None) if TRACE_ENABLED else None
+    if spans is None:
+        return
+    duration_ms = (time.perf_counter() - _trace_local.started) * 1000
+    with _trace_lock:
+        _trace_observe('request', duration_ms)
+        for span in spans:
+            _trace_observe(span['name'], span['ms'])
+    print(json.dumps({
+        'trace': function_name,
+        'request_id': getattr(context, 'request_id', None),
+        'duration_ms': round(duration_ms, 3),
+        'error': _trace_local.error,
+        'spans': spans
+    }, default=str))
+    _trace_local.spans = None
+
+def _statement_name(query: Any) -> str:
+    text = query[:160].decode(errors='replace') if isinstance(query, bytes) else str(query)[:160]
+    return ' '.join(text.split())[:80]
+
+_traced_cursors: Dict[type, type] = {}
+
+def _traced_cursor(base: type) -> type:
+    if base not in _traced_cursors:
+        class TracedCursor(base):
+            def execute(self, query, vars=None):
+                with trace_span('db.query', statement=_statement_name(query)):
+                    return super().execute(query, vars)
+
+        _traced_cursors[base] = TracedCursor
+    return _traced_cursors[base]
+
+class TracedConnection(psycopg2.extensions.connection):
+    # Подключается только при TRACE_ENABLED: каждый запрос, commit и rollback становится спаном
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _traced_cursor(base)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        with trace_span('db.commit'):
+            return super().commit()
+
+    def rollback(self):
+        with trace_span('db.rollback'):
+            return super().rollback()
+
+# Пул живёт на уровне модуля и переживает "тёплые" вызовы функции
+_pool_lock = threading.Condition()
+_pool_idle: List[Tuple[Any, float]] = []
+POOL_METRICS: Dict[str, Any] = {
+    'checkouts': 0,
+    'created': 0,
+    'discarded': 0,
+    'in_use': 0,
+    'idle': 0,
+    'last_wait_ms': 0.0,
+    'max_wait_ms': 0.0,
+    'total_wait_ms': 0.0
+}
+
+def _open_db_connection():
     dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn)
+    with trace_span('db.connect'):
+        conn = psycopg2.connect(dsn, connection_factory=TracedConnection if TRACE_ENABLED else None)
+    POOL_METRICS['created'] += 1
+    return conn
+
+def _discard_db_connection(conn):
+    POOL_METRICS['discarded'] += 1
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def _is_connection_healthy(conn, idle_for: float) -> bool:
+    if conn.closed:
+        return False
+    if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        return False
+    if idle_for < DB_POOL_CHECK_AFTER:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _reap_idle_connections(now: float):
+    while len(_pool_idle) > DB_POOL_MIN_SIZE and now - _pool_idle[0][1] > DB_POOL_IDLE_TIMEOUT:
+        conn, _ = _pool_idle.pop(0)
+        _discard_db_connection(conn)
+
+def get_db_connection():
+    # Под замком только ожидание слота и выбор кандидата; connect и проверка SELECT 1
+    # идут без замка, чтобы медленная сеть не останавливала выдачу соединений другим потокам
+    started = time.monotonic()
+    with _pool_lock:
+        _reap_idle_connections(started)
+        while not _pool_idle and POOL_METRICS['in_use'] >= DB_POOL_MAX_SIZE:
+            remaining = DB_POOL_CHECKOUT_TIMEOUT - (time.monotonic() - started)
+            if remaining <= 0 or not _pool_lock.wait(timeout=remaining):
+                raise psycopg2.pool.PoolError('connection pool exhausted')
+        POOL_METRICS['in_use'] += 1
+        candidate = _pool_idle.pop() if _pool_idle else None
+        POOL_METRICS['idle'] = len(_pool_idle)
+    
+    try:
+        while candidate is not None and not _is_connection_healthy(candidate[0], time.monotonic() - candidate[1]):
+            _discard_db_connection(candidate[0])
+            with _pool_lock:
+                candidate = _pool_idle.pop() if _pool_idle else None
+                POOL_METRICS['idle'] = len(_pool_idle)
+        conn = candidate[0] if candidate is not None else _open_db_connection()
+    except Exception:
+        with _pool_lock:
+            POOL_METRICS['in_use'] -= 1
+            _pool_lock.notify()
+        raise
+    
+    wait_ms = (time.monotonic() - started) * 1000
+    with _pool_lock:
+        POOL_METRICS['checkouts'] += 1
+        POOL_METRICS['last_wait_ms'] = round(wait_ms, 3)
+        POOL_METRICS['max_wait_ms'] = max(POOL_METRICS['max_wait_ms'], round(wait_ms, 3))
+        POOL_METRICS['total_wait_ms'] += wait_ms
+    trace_record('db.checkout', wait_ms)
+    return conn
+
+def release_db_connection(conn):
+    with _pool_lock:
+        POOL_METRICS['in_use'] -= 1
+        if conn.closed or len(_pool_idle) >= DB_POOL_MAX_SIZE:
+            _discard_db_connection(conn)
+        else:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                _pool_idle.append((conn, time.monotonic()))
+            except psycopg2.Error:
+                _discard_db_connection(conn)
+        POOL_METRICS['idle'] = len(_pool_idle)
+        _pool_lock.notify()
+
+def log_pool_metrics(function_name: str, context: Any):
+    flush_trace(function_name, context)
+    if DB_POOL_LOG_METRICS:
+        print(json.dumps({
+            'function': function_name,
+            'request_id': getattr(context, 'request_id', None),
+            'db_pool': POOL_METRICS,
+            'traces': TRACE_HISTOGRAMS if TRACE_ENABLED else None
+        }))
+
+GZIP_MIN_SIZE = int(os.environ.get('GZIP_MIN_SIZE', '1024'))
+
+def get_header(headers: Dict[str, str], name: str) -> str:
+    for key, value in (headers or {}).items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+def dumps(payload: Any) -> bytes:
+    # orjson сериализует datetime сам в том же ISO-формате, что и isoformat()
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, default=lambda value: value.isoformat(), ensure_ascii=False).encode()
+
+def not_modified_response(etag: str) -> Dict[str, Any]:
+    return {
+        'statusCode': 304,
+        'headers': {'ETag': etag, 'Cache-Control': 'no-cache', 'Access-Control-Allow-Origin': '*'},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def encoded_response(payload: Any, request_headers: Dict[str, str], etag: str) -> Dict[str, Any]:
+    body = dumps(payload)
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'ETag': etag,
+        'Cache-Control': 'no-cache',
+        'Vary': 'Accept-Encoding'
+    }
+    if len(body) >= GZIP_MIN_SIZE and 'gzip' in get_header(request_headers, 'accept-encoding'):
+        headers['Content-Encoding'] = 'gzip'
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': base64.b64encode(gzip.compress(body, compresslevel=5)).decode(),
+            'isBase64Encoded': True
+        }
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': body.decode(),
+        'isBase64Encoded': False
+    }
+
+MESSAGES_PAGE_SIZE = 100
+MESSAGES_MAX_WAIT = float(os.environ.get('MESSAGES_MAX_WAIT', '25'))
+# Долгий опрос держит соединение пула до MESSAGES_MAX_WAIT секунд; ожидающих не больше этого числа,
+# чтобы обычным запросам всегда оставалось соединение. Сверх лимита запрос отвечает сразу, как короткий опрос
+MESSAGES_MAX_WAITERS = int(os.environ.get('MESSAGES_MAX_WAITERS', str(max(1, DB_POOL_MAX_SIZE - 1))))
+_waiters = threading.BoundedSemaphore(MESSAGES_MAX_WAITERS)
+WAIT_METRICS: Dict[str, int] = {'short_polled': 0}
+
+def parse_wait(params: Dict[str, str]) -> float:
+    wait = float(params.get('wait') or 0)
+    if wait < 0:
+        raise ValueError('wait must not be negative')
+    return min(wait, MESSAGES_MAX_WAIT)
+
+def fetch_bot_stats(cursor, bot_id: int, user_id: str) -> Optional[Dict[str, Any]]:
+    cursor.execute(
+        '''SELECT b.id,
+                  COALESCE(s.unread_count, 0) AS unread_count,
+                  COALESCE(s.total_count, 0) AS total_count,
+                  s.last_message_at,
+                  COALESCE(s.version, 0) AS version
+           FROM bots b
+           LEFT JOIN bot_stats s ON s.bot_id = b.id
+           WHERE b.id = %s AND b.owner_id = %s AND b.is_active = true''',
+        (bot_id, user_id)
+    )
+    return cursor.fetchone()
+
+def wait_for_messages(conn, bot_id: int, timeout: float) -> bool:
+    # Долгий опрос: запрос висит до NOTIFY messages_new по этому боту или до таймаута
+    deadline = time.monotonic() + timeout
+    while True:
+        conn.poll()
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            if json.loads(notify.payload).get('bot_id') == bot_id:
+                return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        select.select([conn], [], [], remaining)
+
+SEARCH_MIN_LENGTH = 2
+SEARCH_TRGM_MAX_LENGTH = int(os.environ.get('SEARCH_TRGM_MAX_LENGTH', '3'))
+# Выражения совпадают с индексами idx_messages_search и idx_messages_search_trgm
+SEARCH_TSQUERY_SQL = ("(websearch_to_tsquery('russian', %s) || websearch_to_tsquery('english', %s)"
+                      " || websearch_to_tsquery('simple', %s))")
+SEARCH_TEXT_SQL = ("(message_text || ' ' || COALESCE(username, '') || ' ' || COALESCE(first_name, '')"
+                   " || ' ' || COALESCE(last_name, ''))")
+
+def page_limit(params: Dict[str, str]) -> int:
+    limit = min(int(params.get('limit', MESSAGES_PAGE_SIZE)), MESSAGES_PAGE_SIZE)
+    if limit <= 0:
+        raise ValueError('limit must be positive')
+    return limit
+
+def build_search_query(conditions: List[str], args: List[Any], params: Dict[str, str]) -> Tuple[str, List[Any], bool]:
+    text = ' '.join(params['q'].split())
+    if len(text) < SEARCH_MIN_LENGTH:
+        raise ValueError(f'q must be at least {SEARCH_MIN_LENGTH} characters')
+    if params.get('before_id') or params.get('after_id'):
+        raise ValueError('q cannot be combined with before_id or after_id, use search_after')
+    
+    if ' ' not in text and len(text) <= SEARCH_TRGM_MAX_LENGTH:
+        # Короткое слово морфология не найдёт - ищем подстроку по триграммному индексу
+        pattern = '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        conditions.append(f'{SEARCH_TEXT_SQL} ILIKE %s')
+        args.append(pattern)
+        rank_sql = f'similarity({SEARCH_TEXT_SQL}, %s)'
+        rank_args = [text]
+    else:
+        conditions.append(f'search_vector @@ {SEARCH_TSQUERY_SQL}')
+        args.extend([text] * 3)
+        rank_sql = f'ts_rank_cd(search_vector, {SEARCH_TSQUERY_SQL})'
+        rank_args = [text] * 3
+    
+    # Keyset по (rank, created_at, id): курсор search_after = "rank|created_at|id" из next_cursor
+    cursor_sql = ''
+    cursor_args: List[Any] = []
+    if params.get('search_after'):
+        try:
+            rank, created_at, message_id = params['search_after'].split('|')
+            cursor_args = [float(rank), created_at, int(message_id)]
+        except ValueError:
+            raise ValueError('search_after must be a next_cursor value from a search response')
+        cursor_sql = 'WHERE (rank, created_at, id) < (%s::real, %s::timestamp, %s)'
+    
+    sql = f'''SELECT * FROM (
+                   SELECT id, chat_id, username, first_name, last_name, message_text, is_read, created_at,
+                          {rank_sql} AS rank
+                   FROM messages
+                   WHERE {' AND '.join(conditions)}
+               ) ranked
+               {cursor_sql}
+               ORDER BY rank DESC, created_at DESC, id DESC
+               LIMIT %s'''
+    return sql, rank_args + args + cursor_args + [page_limit(params)], False
+
+def search_cursor(message: Dict[str, Any]) -> str:
+    return f"{message['rank']!r}|{message['created_at'].isoformat()}|{message['id']}"
+
+def build_messages_query(bot_id: int, params: Dict[str, str]) -> Tuple[str, List[Any], bool]:
+    conditions = ['bot_id = %s', 'is_archived = %s']
+    args: List[Any] = [bot_id, params.get('archived') == 'true']
+    
+    if params.get('is_read') is not None:
+        if params['is_read'] not in ('true', 'false'):
+            raise ValueError('is_read must be true or false')
+        conditions.append('is_read = %s')
+        args.append(params['is_read'] == 'true')
+    if params.get('chat_id'):
+        conditions.append('chat_id = %s')
+        args.append(int(params['chat_id']))
+    if params.get('date_from'):
+        conditions.append('created_at >= %s')
+        args.append(params['date_from'])
+    if params.get('date_to'):
+        conditions.append('created_at < %s')
+        args.append(params['date_to'])
+    if params.get('since'):
+        conditions.append('created_at > %s')
+        args.append(params['since'])
+    if params.get('q') is not None:
+        return build_search_query(conditions, args, params)
+    
+    # Курсор (created_at, id) позволяет листать без OFFSET по индексу idx_messages_bot_created_id
+    ascending = False
+    if params.get('before_id'):
+        conditions.append('(created_at, id) < (SELECT created_at, id FROM messages WHERE id = %s)')
+        args.append(int(params['before_id']))
+    elif params.get('after_id'):
+        conditions.append('(created_at, id) > (SELECT created_at, id FROM messages WHERE id = %s)')
+        args.append(int(params['after_id']))
+        ascending = True
+    
+    args.append(page_limit(params))
+    
+    order = 'ASC' if ascending else 'DESC'
+    sql = f'''SELECT id, chat_id, username, first_name, last_name, message_text, is_read, created_at
+               FROM messages 
+               WHERE {' AND '.join(conditions)}
+               ORDER BY created_at {order}, id {order}
+               LIMIT %s'''
+    return sql, args, ascending
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'jsonl': ('application/x-ndjson', 'jsonl')
+}
+EXPORT_COLUMNS = ('id', 'chat_id', 'username', 'first_name', 'last_name', 'message_text', 'is_read', 'is_archived', 'created_at')
+EXPORT_ITERSIZE = int(os.environ.get('EXPORT_ITERSIZE', '2000'))
+EXPORT_PART_BYTES = int(os.environ.get('EXPORT_PART_BYTES', str(4 * 1024 * 1024)))
+EXPORT_TIME_BUDGET = float(os.environ.get('EXPORT_TIME_BUDGET', '20'))
+
+def build_export_query(bot_id: int, params: Dict[str, str]) -> Tuple[str, List[Any]]:
+    if params['export'] not in EXPORT_FORMATS:
+        raise ValueError('export must be one of: ' + ', '.join(EXPORT_FORMATS))
+    conditions = ['bot_id = %s']
+    args: List[Any] = [bot_id]
+    
+    if params.get('date_from'):
+        conditions.append('created_at >= %s')
+        args.append(params['date_from'])
+    if params.get('date_to'):
+        conditions.append('created_at < %s')
+        args.append(params['date_to'])
+    if params.get('export_after'):
+        created_at, _, message_id = params['export_after'].rpartition('|')
+        try:
+            args.extend([datetime.fromisoformat(created_at), int(message_id)])
+        except ValueError:
+            raise ValueError('export_after must be "created_at|id"')
+        conditions.append('(created_at, id) > (%s, %s)')
+    
+    sql = f'''SELECT {', '.join(EXPORT_COLUMNS)}
+               FROM messages
+               WHERE {' AND '.join(conditions)}
+               ORDER BY created_at, id'''
+    return sql, args
+
+def export_response(conn, sql: str, args: List[Any], params: Dict[str, str], request_headers: Dict[str, str]) -> Dict[str, Any]:
+    # История читается серверным курсором пачками по EXPORT_ITERSIZE и сразу пишется в CSV/JSONL
+    # (и gzip), поэтому память не зависит от объёма истории. Ответ функции не стримится,
+    # так что выгрузка режется на части по EXPORT_PART_BYTES: заголовок X-Export-Next
+    # содержит курсор для запроса следующей части
+    export_format = params['export']
+    content_type, extension = EXPORT_FORMATS[export_format]
+    use_gzip = 'gzip' in get_header(request_headers, 'accept-encoding')
+    
+    output = io.BytesIO()
+    sink = gzip.GzipFile(fileobj=output, mode='wb', compresslevel=5) if use_gzip else output
+    if export_format == 'csv' and not params.get('export_after'):
+        # BOM, чтобы Excel открыл кириллицу в UTF-8
+        sink.write(('\ufeff' + ','.join(EXPORT_COLUMNS) + '\r\n').encode())
+    
+    started = time.monotonic()
+    rows = 0
+    last = None
+    complete = True
+    cursor = conn.cursor(name='messages_export')
+    cursor.itersize = EXPORT_ITERSIZE
+    try:
+        cursor.execute(sql, args)
+        while True:
+            chunk = cursor.fetchmany(EXPORT_ITERSIZE)
+            if not chunk:
+                break
+            if export_format == 'csv':
+                # Даты в том же ISO-формате, что и в JSONL
+                text = io.StringIO()
+                csv.writer(text).writerows(
+                    [value.isoformat() if isinstance(value, datetime) else value for value in row] for row in chunk
+                )
+                sink.write(text.getvalue().encode())
+            else:
+                sink.write(b''.join(dumps(dict(zip(EXPORT_COLUMNS, row))) + b'\n' for row in chunk))
+            rows += len(chunk)
+            last = chunk[-1]
+            if output.tell() >= EXPORT_PART_BYTES or time.monotonic() - started >= EXPORT_TIME_BUDGET:
+                complete = len(chunk) < EXPORT_ITERSIZE or not cursor.fetchmany(1)
+                break
+    finally:
+        cursor.close()
+        conn.commit()
+    if use_gzip:
+        sink.close()
+    
+    body = output.getvalue()
+    headers = {
+        'Content-Type': content_type,
+        'Content-Disposition': f'attachment; filename="bot-{int(params["bot_id"])}-messages.{extension}"',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'X-Export-Next, X-Export-Rows, Content-Disposition',
+        'X-Export-Rows': str(rows),
+        'Cache-Control': 'no-store'
+    }
+    if not complete:
+        headers['X-Export-Next'] = f"{last[EXPORT_COLUMNS.index('created_at')].isoformat()}|{last[0]}"
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+        return {'statusCode': 200, 'headers': headers, 'body': base64.b64encode(body).decode(), 'isBase64Encoded': True}
+    return {'statusCode': 200, 'headers': headers, 'body': body.decode(), 'isBase64Encoded': False}
+
+MESSAGE_ACTIONS = {
+    'read': ('is_read = true', 'm.is_read = false', -1),
+    'unread': ('is_read = false', 'm.is_read = true AND m.is_archived = false', 1),
+    'archive': ('is_read = true, is_archived = true', 'm.is_archived = false', 0)
+}
+
+def build_update_query(bot_id: int, user_id: str, params: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    action = params.get('action', 'read')
+    if action not in MESSAGE_ACTIONS:
+        raise ValueError('action must be one of: ' + ', '.join(MESSAGE_ACTIONS))
+    assignments, pending_condition, unread_delta = MESSAGE_ACTIONS[action]
+    
+    # Проверка владельца, массовый UPDATE и новый счётчик непрочитанных - один запрос
+    args: List[Any] = [bot_id, user_id]
+    if params.get('message_ids'):
+        message_ids = params['message_ids']
+        # Строка тоже итерируема: "12" превратилась бы в id 1 и 2
+        if not isinstance(message_ids, list) or not all(
+            isinstance(message_id, int) and not isinstance(message_id, bool) for message_id in message_ids
+        ):
+            raise ValueError('message_ids must be a list of integers')
+        selector = 'm.id = ANY(%s)'
+        args.append(message_ids)
+    elif params.get('up_to_id'):
+        selector = '(m.created_at, m.id) <= (SELECT created_at, id FROM messages WHERE id = %s)'
+        args.append(int(params['up_to_id']))
+    elif params.get('all') is True:
+        selector = 'true'
+    else:
+        raise ValueError('message_ids, up_to_id or all is required')
+    
+    if action == 'archive':
+        # Архивация тоже снимает непрочитанность, но только у тех, кто был непрочитан до UPDATE
+        source = 'FROM messages prev'
+        source_condition = 'AND prev.id = m.id'
+        returning = 'prev.is_read = false'
+        unread_change = '- (SELECT COUNT(*) FROM updated WHERE was_unread)'
+    else:
+        source = ''
+        source_condition = ''
+        returning = 'true'
+        unread_change = f'+ {unread_delta} * (SELECT COUNT(*) FROM updated)'
+    
+    sql = f'''WITH owned AS (
+                   SELECT id FROM bots WHERE id = %s AND owner_id = %s AND is_active = true
+               ),
+               updated AS (
+                   UPDATE messages m SET {assignments}
+                   {source}
+                   WHERE m.bot_id = (SELECT id FROM owned) {source_condition}
+                     AND {pending_condition} AND {selector}
+                   RETURNING {returning} AS was_unread
+               )
+               SELECT (SELECT id FROM owned) AS bot_id,
+                      (SELECT COUNT(*) FROM updated) AS updated,
+                      COALESCE((SELECT unread_count FROM bot_stats WHERE bot_id = (SELECT id FROM owned)), 0)
+                          {unread_change} AS unread_count'''
+    return sql, args
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
+    trace_start()
     
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Methods': 'GET, POST, PATCH, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
-    if method != 'GET':
+    if method not in ('GET', 'POST', 'PATCH'):
         return {
             'statusCode': 405,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -42,14 +640,30 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     headers = event.get('headers', {})
     user_id = headers.get('x-user-id') or headers.get('X-User-Id', 'anonymous')
     
-    query_params = event.get('queryStringParameters', {}) or {}
-    bot_id = query_params.get('bot_id')
-    
-    if not bot_id:
+    wait = 0
+    try:
+        if method == 'GET':
+            query_params = event.get('queryStringParameters', {}) or {}
+        else:
+            query_params = json.loads(event.get('body') or '{}')
+            if not isinstance(query_params, dict):
+                raise ValueError('body must be a JSON object')
+        bot_id = query_params.get('bot_id')
+        if not bot_id:
+            raise ValueError('bot_id is required')
+        
+        if method == 'GET' and query_params.get('export'):
+            export_sql, export_args = build_export_query(int(bot_id), query_params)
+        elif method == 'GET':
+            messages_sql, messages_args, ascending = build_messages_query(int(bot_id), query_params)
+            wait = parse_wait(query_params)
+        else:
+            update_sql, update_args = build_update_query(int(bot_id), user_id, query_params)
+    except (ValueError, TypeError) as e:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'bot_id is required'}),
+            'body': json.dumps({'error': str(e)}),
             'isBase64Encoded': False
         }
     
@@ -57,12 +671,53 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
-        cursor.execute(
-            'SELECT id FROM bots WHERE id = %s AND owner_id = %s AND is_active = true',
-            (bot_id, user_id)
-        )
+        if method != 'GET':
+            cursor.execute(update_sql, update_args)
+            result = cursor.fetchone()
+            
+            if result['bot_id'] is None:
+                conn.rollback()
+                return {
+                    'statusCode': 404,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Bot not found'}),
+                    'isBase64Encoded': False
+                }
+            
+            conn.commit()
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'updated': result['updated'],
+                    'unread_count': result['unread_count']
+                }),
+                'isBase64Encoded': False
+            }
+        
+        if query_params.get('export'):
+            if not fetch_bot_stats(cursor, int(bot_id), user_id):
+                return {
+                    'statusCode': 404,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Bot not found'}),
+                    'isBase64Encoded': False
+                }
+            return export_response(conn, export_sql, export_args, query_params, headers)
         
-        if not cursor.fetchone():
+        if wait and not _waiters.acquire(blocking=False):
+            WAIT_METRICS['short_polled'] += 1
+            wait = 0
+        if wait:
+            # LISTEN действует после коммита - подписываемся до первого чтения, чтобы не пропустить вставку
+            cursor.execute('LISTEN messages_new')
+            conn.commit()
+        
+        bot = fetch_bot_stats(cursor, int(bot_id), user_id)
+        
+        if not bot:
             return {
                 'statusCode': 404,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -70,25 +725,46 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        cursor.execute(
-            '''SELECT id, chat_id, username, first_name, last_name, message_text, is_read, created_at
-               FROM messages 
-               WHERE bot_id = %s 
-               ORDER BY created_at DESC 
-               LIMIT 100''',
-            (bot_id,)
-        )
+        # Версия бота меняется при любой вставке, отметке, архивации и удалении сообщений,
+        # поэтому совпавший ETag отвечает 304 без запроса к messages
+        query_hash = hashlib.md5(json.dumps(query_params, sort_keys=True).encode()).hexdigest()[:12]
+        etag = f'"{bot["id"]}-{bot["version"]}-{query_hash}"'
+        if not wait and get_header(headers, 'if-none-match') == etag:
+            return not_modified_response(etag)
+        
+        cursor.execute(messages_sql, messages_args)
         
         messages = [dict(row) for row in cursor.fetchall()]
+        if not messages and wait:
+            conn.commit()
+            if wait_for_messages(conn, bot['id'], wait):
+                bot = fetch_bot_stats(cursor, int(bot_id), user_id) or bot
+                etag = f'"{bot["id"]}-{bot["version"]}-{query_hash}"'
+                cursor.execute(messages_sql, messages_args)
+                messages = [dict(row) for row in cursor.fetchall()]
+        if ascending:
+            messages.reverse()
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'messages': messages}, default=str),
-            'isBase64Encoded': False
-        }
+        next_cursor = None
+        if len(messages) == messages_args[-1]:
+            next_cursor = search_cursor(messages[-1]) if query_params.get('q') is not None else messages[-1]['id']
+        
+        return encoded_response({
+            'messages': messages,
+            'next_cursor': next_cursor,
+            'newest_id': messages[0]['id'] if messages else None,
+            # false - сервер не держал запрос (не просили или занят лимит ожидающих), повтор стоит отложить
+            'waited': bool(wait),
+            'stats': {
+                'unread_count': bot['unread_count'],
+                'total_count': bot['total_count'],
+                'last_message_at': bot['last_message_at']
+            }
+        }, headers, etag)
     
     except Exception as e:
+        conn.rollback()
+        trace_error(e)
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -97,5 +773,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     finally:
+        if method == 'GET' and wait and not conn.closed:
+            # Соединение вернётся в пул - подписка не должна пережить запрос
+            try:
+                conn.rollback()
+                cursor.execute('UNLISTEN messages_new')
+                conn.commit()
+                conn.notifies.clear()
+            except psycopg2.Error:
+                pass
+        if method == 'GET' and wait:
+            _waiters.release()
         cursor.close()
-        conn.close()
+        release_db_connection(conn)
+        log_pool_metrics('bot-messages', context)
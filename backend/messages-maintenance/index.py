@@ -0,0 +1,461 @@
+'''
+Business: Обслуживание секций messages - создание будущих месяцев, удаление устаревших секций и сообщений по сроку хранения бота, очистка processed_updates и reply_keys
+Args: event с httpMethod GET/POST (вызывается по расписанию)
+      context с request_id
+Returns: HTTP response со списком созданных и удалённых секций
+'''
+
+import bisect
+import json
+import os
+import re
+import threading
+import time
+from datetime import date, datetime, timedelta
+import psycopg2
+import psycopg2.pool
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor
+from typing import Dict, Any, List, Optional, Tuple
+
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', '300'))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.environ.get('DB_POOL_CHECKOUT_TIMEOUT', '10'))
+DB_POOL_LOG_METRICS = os.environ.get('DB_POOL_LOG_METRICS') == '1'
+
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED') == '1'
+TRACE_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Трассировка запроса: спаны копятся в потоке и в конце обработчика пишутся одной JSON-строкой;
+# при выключенной трассировке trace_span отдаёт общий пустой контекст и ничего не замеряет
+_trace_local = threading.local()
+_trace_lock = threading.Lock()
+TRACE_HISTOGRAMS: Dict[str, Dict[str, Any]] = {}
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+class _Span:
+    __slots__ = ('name', 'tags', 'started')
+
+    def __init__(self, name: str, tags: Dict[str, Any]):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.tags['error'] = exc_type.__name__
+        trace_record(self.name, (time.perf_counter() - self.started) * 1000, self.started, **self.tags)
+        return False
+
+def trace_span(name: str, **tags):
+    if not TRACE_ENABLED:
+        return _NOOP_SPAN
+    return _Span(name, tags)
+
+def trace_start():
+    if TRACE_ENABLED:
+        _trace_local.started = time.perf_counter()
+        _trace_local.spans = []
+        _trace_local.error = None
+
+def trace_record(name: str, elapsed_ms: float, started: float = None, **tags):
+    spans = getattr(_trace_local, 'spans', None) if TRACE_ENABLED else None
+    if spans is None:
+        return
+    at = (started if started is not None else time.perf_counter() - elapsed_ms / 1000) - _trace_local.started
+    spans.append({'name': name, 'at_ms': round(at * 1000, 3), 'ms': round(elapsed_ms, 3), **tags})
+
+def trace_error(error: Exception):
+    if TRACE_ENABLED:
+        _trace_local.error = f'{type(error).__name__}: {error}'
+
+def _trace_observe(name: str, elapsed_ms: float):
+    histogram = TRACE_HISTOGRAMS.get(name)
+    if histogram is None:
+        histogram = TRACE_HISTOGRAMS[name] = {
+            'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * (len(TRACE_BUCKETS_MS) + 1)
+        }
+    histogram['count'] += 1
+    histogram['total_ms'] += elapsed_ms
+    histogram['max_ms'] = max(histogram['max_ms'], round(elapsed_ms, 3))
+    histogram['buckets'][bisect.bisect_left(TRACE_BUCKETS_MS, elapsed_ms)] += 1
+
+def flush_trace(function_name: str, context: Any):
+    spans = getattr(_trace_local, 'spans', None) if TRACE_ENABLED else None
+    if spans is None:
+        return
+    duration_ms = (time.perf_counter() - _trace_local.started) * 1000
+    with _trace_lock:
+        _trace_observe('request', duration_ms)
+        for span in spans:
+            _trace_observe(span['name'], span['ms'])
+    print(json.dumps({
+        'trace': function_name,
+        'request_id': getattr(context, 'request_id', None),
+        'duration_ms': round(duration_ms, 3),
+        'error': _trace_local.error,
+        'spans': spans
+    }, default=str))
+    _trace_local.spans = None
+
+def _statement_name(query: Any) -> str:
+    text = query[:160].decode(errors='replace') if isinstance(query, bytes) else str(query)[:160]
+    return ' '.join(text.split())[:80]
+
+_traced_cursors: Dict[type, type] = {}
+
+def _traced_cursor(base: type) -> type:
+    if base not in _traced_cursors:
+        class TracedCursor(base):
+            def execute(self, query, vars=None):
+                with trace_span('db.query', statement=_statement_name(query)):
+                    return super().execute(query, vars)
+
+        _traced_cursors[base] = TracedCursor
+    return _traced_cursors[base]
+
+class TracedConnection(psycopg2.extensions.connection):
+    # Подключается только при TRACE_ENABLED: каждый запрос, commit и rollback становится спаном
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _traced_cursor(base)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        with trace_span('db.commit'):
+            return super().commit()
+
+    def rollback(self):
+        with trace_span('db.rollback'):
+            return super().rollback()
+
+# Пул живёт на уровне модуля и переживает "тёплые" вызовы функции
+_pool_lock = threading.Condition()
+_pool_idle: List[Tuple[Any, float]] = []
+POOL_METRICS: Dict[str, Any] = {
+    'checkouts': 0,
+    'created': 0,
+    'discarded': 0,
+    'in_use': 0,
+    'idle': 0,
+    'last_wait_ms': 0.0,
+    'max_wait_ms': 0.0,
+    'total_wait_ms': 0.0
+}
+
+def _open_db_connection():
+    dsn = os.environ.get('DATABASE_URL')
+    with trace_span('db.connect'):
+        conn = psycopg2.connect(dsn, connection_factory=TracedConnection if TRACE_ENABLED else None)
+    POOL_METRICS['created'] += 1
+    return conn
+
+def _discard_db_connection(conn):
+    POOL_METRICS['discarded'] += 1
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def _is_connection_healthy(conn, idle_for: float) -> bool:
+    if conn.closed:
+        return False
+    if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        return False
+    if idle_for < DB_POOL_CHECK_AFTER:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _reap_idle_connections(now: float):
+    while len(_pool_idle) > DB_POOL_MIN_SIZE and now - _pool_idle[0][1] > DB_POOL_IDLE_TIMEOUT:
+        conn, _ = _pool_idle.pop(0)
+        _discard_db_connection(conn)
+
+def get_db_connection():
+    # Под замком только ожидание слота и выбор кандидата; connect и проверка SELECT 1
+    # идут без замка, чтобы медленная сеть не останавливала выдачу соединений другим потокам
+    started = time.monotonic()
+    with _pool_lock:
+        _reap_idle_connections(started)
+        while not _pool_idle and POOL_METRICS['in_use'] >= DB_POOL_MAX_SIZE:
+            remaining = DB_POOL_CHECKOUT_TIMEOUT - (time.monotonic() - started)
+            if remaining <= 0 or not _pool_lock.wait(timeout=remaining):
+                raise psycopg2.pool.PoolError('connection pool exhausted')
+        POOL_METRICS['in_use'] += 1
+        candidate = _pool_idle.pop() if _pool_idle else None
+        POOL_METRICS['idle'] = len(_pool_idle)
+    
+    try:
+        while candidate is not None and not _is_connection_healthy(candidate[0], time.monotonic() - candidate[1]):
+            _discard_db_connection(candidate[0])
+            with _pool_lock:
+                candidate = _pool_idle.pop() if _pool_idle else None
+                POOL_METRICS['idle'] = len(_pool_idle)
+        conn = candidate[0] if candidate is not None else _open_db_connection()
+    except Exception:
+        with _pool_lock:
+            POOL_METRICS['in_use'] -= 1
+            _pool_lock.notify()
+        raise
+    
+    wait_ms = (time.monotonic() - started) * 1000
+    with _pool_lock:
+        POOL_METRICS['checkouts'] += 1
+        POOL_METRICS['last_wait_ms'] = round(wait_ms, 3)
+        POOL_METRICS['max_wait_ms'] = max(POOL_METRICS['max_wait_ms'], round(wait_ms, 3))
+        POOL_METRICS['total_wait_ms'] += wait_ms
+    trace_record('db.checkout', wait_ms)
+    return conn
+
+def release_db_connection(conn):
+    with _pool_lock:
+        POOL_METRICS['in_use'] -= 1
+        if conn.closed or len(_pool_idle) >= DB_POOL_MAX_SIZE:
+            _discard_db_connection(conn)
+        else:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                _pool_idle.append((conn, time.monotonic()))
+            except psycopg2.Error:
+                _discard_db_connection(conn)
+        POOL_METRICS['idle'] = len(_pool_idle)
+        _pool_lock.notify()
+
+def log_pool_metrics(function_name: str, context: Any):
+    flush_trace(function_name, context)
+    if DB_POOL_LOG_METRICS:
+        print(json.dumps({
+            'function': function_name,
+            'request_id': getattr(context, 'request_id', None),
+            'db_pool': POOL_METRICS,
+            'traces': TRACE_HISTOGRAMS if TRACE_ENABLED else None
+        }))
+
+MESSAGES_RETENTION_DAYS = int(os.environ.get('MESSAGES_RETENTION_DAYS', '0'))
+MAINTENANCE_MONTHS_AHEAD = int(os.environ.get('MAINTENANCE_MONTHS_AHEAD', '2'))
+MAINTENANCE_TIME_BUDGET = float(os.environ.get('MAINTENANCE_TIME_BUDGET', '20'))
+RETENTION_DELETE_BATCH = int(os.environ.get('RETENTION_DELETE_BATCH', '5000'))
+PROCESSED_UPDATES_TTL_HOURS = int(os.environ.get('PROCESSED_UPDATES_TTL_HOURS', '48'))
+REPLY_KEYS_TTL_DAYS = int(os.environ.get('REPLY_KEYS_TTL_DAYS', '30'))
+
+PARTITION_BOUND_RE = re.compile(r"FROM \((?:'([^']+)'|MINVALUE)\) TO \((?:'([^']+)'|MAXVALUE)\)")
+
+def add_months(month_start: date, months: int) -> date:
+    index = month_start.month - 1 + months
+    return date(month_start.year + index // 12, index % 12 + 1, 1)
+
+def list_partitions(cursor) -> List[Tuple[str, Optional[datetime], Optional[datetime]]]:
+    cursor.execute(
+        '''SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+           FROM pg_inherits i
+           JOIN pg_class c ON c.oid = i.inhrelid
+           WHERE i.inhparent = 'messages'::regclass'''
+    )
+    partitions = []
+    for row in cursor.fetchall():
+        match = PARTITION_BOUND_RE.search(row['bound'])
+        if not match:
+            continue
+        lower = datetime.fromisoformat(match.group(1)) if match.group(1) else None
+        upper = datetime.fromisoformat(match.group(2)) if match.group(2) else None
+        partitions.append((row['name'], lower, upper))
+    return partitions
+
+def create_future_partitions(cursor) -> List[str]:
+    partitions = list_partitions(cursor)
+    month_start = date.today().replace(day=1)
+    created = []
+    for i in range(MAINTENANCE_MONTHS_AHEAD + 1):
+        lower = datetime.combine(add_months(month_start, i), datetime.min.time())
+        upper = datetime.combine(add_months(month_start, i + 1), datetime.min.time())
+        overlaps = any(
+            (p_lower is None or p_lower < upper) and (p_upper is None or lower < p_upper)
+            for _, p_lower, p_upper in partitions
+        )
+        if overlaps:
+            continue
+        name = f'messages_p{lower:%Y%m}'
+        cursor.execute(
+            'SELECT EXISTS (SELECT 1 FROM messages_default WHERE created_at >= %s AND created_at < %s) AS stranded',
+            (lower, upper)
+        )
+        if cursor.fetchone()['stranded']:
+            attach_with_default_rows(cursor, name, lower, upper)
+        else:
+            cursor.execute(
+                sql.SQL('CREATE TABLE {} PARTITION OF messages FOR VALUES FROM (%s) TO (%s)').format(sql.Identifier(name)),
+                (lower, upper)
+            )
+        created.append(name)
+    return created
+
+def attach_with_default_rows(cursor, name: str, lower: datetime, upper: datetime):
+    # Пока месяц не был создан, его строки легли в messages_default, и CREATE ... PARTITION OF упадёт.
+    # Переносим их в отдельную таблицу и подключаем её секцией: индексы и внешние ключи ATTACH
+    # создаст сам, а перенос мимо родительской таблицы не трогает счётчики bot_stats
+    cursor.execute(
+        '''SELECT attname FROM pg_attribute
+           WHERE attrelid = 'messages'::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+           ORDER BY attnum'''
+    )
+    columns = sql.SQL(', ').join(sql.Identifier(row['attname']) for row in cursor.fetchall())
+    cursor.execute(
+        sql.SQL('CREATE TABLE {} (LIKE messages INCLUDING DEFAULTS INCLUDING GENERATED)').format(sql.Identifier(name))
+    )
+    cursor.execute(
+        sql.SQL('''WITH moved AS (
+                       DELETE FROM messages_default WHERE created_at >= %s AND created_at < %s
+                       RETURNING {columns}
+                   )
+                   INSERT INTO {name} ({columns}) SELECT {columns} FROM moved''').format(
+            columns=columns, name=sql.Identifier(name)
+        ),
+        (lower, upper)
+    )
+    cursor.execute(
+        sql.SQL('ALTER TABLE messages ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)').format(sql.Identifier(name)),
+        (lower, upper)
+    )
+
+def drop_expired_partitions(conn, cursor) -> List[str]:
+    if MESSAGES_RETENTION_DAYS <= 0:
+        return []
+    cutoff = datetime.now() - timedelta(days=MESSAGES_RETENTION_DAYS)
+    dropped = []
+    for name, _, upper in list_partitions(cursor):
+        if upper is None or upper > cutoff:
+            continue
+        # DROP не вызывает триггеры, поэтому счётчики bot_stats вычитаем сами
+        cursor.execute(
+            sql.SQL('''UPDATE bot_stats s
+                       SET total_count = s.total_count - d.total_count,
+                           unread_count = s.unread_count - d.unread_count,
+                           version = s.version + 1
+                       FROM (
+                           SELECT bot_id, COUNT(*) AS total_count,
+                                  COUNT(*) FILTER (WHERE is_read IS NOT TRUE) AS unread_count
+                           FROM {} GROUP BY bot_id
+                       ) d
+                       WHERE s.bot_id = d.bot_id''').format(sql.Identifier(name))
+        )
+        cursor.execute(sql.SQL('ALTER TABLE messages DETACH PARTITION {}').format(sql.Identifier(name)))
+        cursor.execute(sql.SQL('DROP TABLE {}').format(sql.Identifier(name)))
+        conn.commit()
+        dropped.append(name)
+    return dropped
+
+def delete_expired_messages(conn, cursor, deadline: float) -> int:
+    deleted = 0
+    while time.monotonic() < deadline:
+        cursor.execute(
+            '''DELETE FROM messages
+               WHERE (id, created_at) IN (
+                   SELECT m.id, m.created_at FROM messages m
+                   JOIN bots b ON b.id = m.bot_id
+                   WHERE b.retention_days IS NOT NULL
+                     AND m.created_at < CURRENT_TIMESTAMP - b.retention_days * INTERVAL '1 day'
+                   LIMIT %s
+               )''',
+            (RETENTION_DELETE_BATCH,)
+        )
+        conn.commit()
+        deleted += cursor.rowcount
+        if cursor.rowcount < RETENTION_DELETE_BATCH:
+            break
+    return deleted
+
+def delete_expired_updates(conn, cursor) -> int:
+    # Telegram хранит неподтверждённые обновления не дольше суток, старые ключи не нужны
+    cursor.execute(
+        '''DELETE FROM processed_updates
+           WHERE processed_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 hour' ''',
+        (PROCESSED_UPDATES_TTL_HOURS,)
+    )
+    conn.commit()
+    return cursor.rowcount
+
+def delete_expired_reply_keys(conn, cursor) -> int:
+    cursor.execute(
+        '''DELETE FROM reply_keys
+           WHERE created_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day' ''',
+        (REPLY_KEYS_TTL_DAYS,)
+    )
+    conn.commit()
+    return cursor.rowcount
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'POST')
+    trace_start()
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    started = time.monotonic()
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    
+    try:
+        created = create_future_partitions(cursor)
+        conn.commit()
+        dropped = drop_expired_partitions(conn, cursor)
+        deleted = delete_expired_messages(conn, cursor, started + MAINTENANCE_TIME_BUDGET)
+        expired_updates = delete_expired_updates(conn, cursor)
+        expired_reply_keys = delete_expired_reply_keys(conn, cursor)
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({
+                'created': created,
+                'dropped': dropped,
+                'deleted': deleted,
+                'expired_updates': expired_updates,
+                'expired_reply_keys': expired_reply_keys
+            }),
+            'isBase64Encoded': False
+        }
+    
+    except Exception as e:
+        conn.rollback()
+        trace_error(e)
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
+    
+    finally:
+        cursor.close()
+        release_db_connection(conn)
+        log_pool_metrics('messages-maintenance', context)
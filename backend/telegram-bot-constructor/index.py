@@ -5,61 +5,908 @@ Args: event с httpMethod POST, body с Telegram update
 Returns: HTTP response 200 OK
 '''
 
+import bisect
+import hashlib
+import html
 import json
 import os
+import threading
+import time
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from typing import Dict, Any, Optional
+import psycopg2.pool
+from psycopg2.extras import RealDictCursor, Json, execute_values
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def get_db_connection():
-    dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn)
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', '300'))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.environ.get('DB_POOL_CHECKOUT_TIMEOUT', '10'))
+DB_POOL_LOG_METRICS = os.environ.get('DB_POOL_LOG_METRICS') == '1'
 
-def get_user_state(cursor, telegram_user_id: int) -> Dict[str, Any]:
-    cursor.execute(
-        '''SELECT state, state_data FROM bot_constructor_users 
-           WHERE telegram_user_id = %s''',
-        (telegram_user_id,)
-    )
-    result = cursor.fetchone()
-    if result:
-        return {
-            'state': result['state'],
-            'state_data': json.loads(result['state_data']) if result['state_data'] else {}
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED') == '1'
+TRACE_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Трассировка запроса: спаны копятся в потоке и в конце обработчика пишутся одной JSON-строкой;
+# при выключенной трассировке trace_span отдаёт общий пустой контекст и ничего не замеряет
+_trace_local = threading.local()
+_trace_lock = threading.Lock()
+TRACE_HISTOGRAMS: Dict[str, Dict[str, Any]] = {}
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+class _Span:
+    __slots__ = ('name', 'tags', 'started')
+
+    def __init__(self, name: str, tags: Dict[str, Any]):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.tags['error'] = exc_type.__name__
+        trace_record(self.name, (time.perf_counter() - self.started) * 1000, self.started, **self.tags)
+        return False
+
+def trace_span(name: str, **tags):
+    if not TRACE_ENABLED:
+        return _NOOP_SPAN
+    return _Span(name, tags)
+
+def trace_start():
+    if TRACE_ENABLED:
+        _trace_local.started = time.perf_counter()
+        _trace_local.spans = []
+        _trace_local.error = None
+
+def trace_record(name: str, elapsed_ms: float, started: float = None, **tags):
+    spans = getattr(_trace_local, 'spans', None) if TRACE_ENABLED else None
+    if spans is None:
+        return
+    at = (started if started is not None else time.perf_counter() - elapsed_ms / 1000) - _trace_local.started
+    spans.append({'name': name, 'at_ms': round(at * 1000, 3), 'ms': round(elapsed_ms, 3), **tags})
+
+def trace_error(error: Exception):
+    if TRACE_ENABLED:
+        _trace_local.error = f'{type(error).__name__}: {public_error(error)}'
+
+def _trace_observe(name: str, elapsed_ms: float):
+    histogram = TRACE_HISTOGRAMS.get(name)
+    if histogram is None:
+        histogram = TRACE_HISTOGRAMS[name] = {
+            'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * (len(TRACE_BUCKETS_MS) + 1)
         }
-    return {'state': 'idle', 'state_data': {}}
+    histogram['count'] += 1
+    histogram['total_ms'] += elapsed_ms
+    histogram['max_ms'] = max(histogram['max_ms'], round(elapsed_ms, 3))
+    histogram['buckets'][bisect.bisect_left(TRACE_BUCKETS_MS, elapsed_ms)] += 1
 
-def set_user_state(cursor, telegram_user_id: int, username: str, state: str, state_data: Dict = None):
-    cursor.execute(
-        '''INSERT INTO bot_constructor_users (telegram_user_id, telegram_username, state, state_data, updated_at)
-           VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
-           ON CONFLICT (telegram_user_id) DO UPDATE 
-           SET state = EXCLUDED.state, 
-               state_data = EXCLUDED.state_data,
-               telegram_username = EXCLUDED.telegram_username,
-               updated_at = CURRENT_TIMESTAMP''',
-        (telegram_user_id, username, state, json.dumps(state_data) if state_data else None)
-    )
+def flush_trace(function_name: str, context: Any):
+    spans = getattr(_trace_local, 'spans', None) if TRACE_ENABLED else None
+    if spans is None:
+        return
+    duration_ms = (time.perf_counter() - _trace_local.started) * 1000
+    with _trace_lock:
+        _trace_observe('request', duration_ms)
+        for span in spans:
+            _trace_observe(span['name'], span['ms'])
+    print(json.dumps({
+        'trace': function_name,
+        'request_id': getattr(context, 'request_id', None),
+        'duration_ms': round(duration_ms, 3),
+        'error': _trace_local.error,
+        'spans': spans
+    }, default=str))
+    _trace_local.spans = None
+
+def _statement_name(query: Any) -> str:
+    text = query[:160].decode(errors='replace') if isinstance(query, bytes) else str(query)[:160]
+    return ' '.join(text.split())[:80]
+
+_traced_cursors: Dict[type, type] = {}
+
+def _traced_cursor(base: type) -> type:
+    if base not in _traced_cursors:
+        class TracedCursor(base):
+            def execute(self, query, vars=None):
+                with trace_span('db.query', statement=_statement_name(query)):
+                    return super().execute(query, vars)
+
+        _traced_cursors[base] = TracedCursor
+    return _traced_cursors[base]
+
+class TracedConnection(psycopg2.extensions.connection):
+    # Подключается только при TRACE_ENABLED: каждый запрос, commit и rollback становится спаном
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _traced_cursor(base)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        with trace_span('db.commit'):
+            return super().commit()
+
+    def rollback(self):
+        with trace_span('db.rollback'):
+            return super().rollback()
+
+# Пул живёт на уровне модуля и переживает "тёплые" вызовы функции
+_pool_lock = threading.Condition()
+_pool_idle: List[Tuple[Any, float]] = []
+POOL_METRICS: Dict[str, Any] = {
+    'checkouts': 0,
+    'created': 0,
+    'discarded': 0,
+    'in_use': 0,
+    'idle': 0,
+    'last_wait_ms': 0.0,
+    'max_wait_ms': 0.0,
+    'total_wait_ms': 0.0
+}
+
+def _open_db_connection():
+    dsn = os.environ.get('DATABASE_URL')
+    with trace_span('db.connect'):
+        conn = psycopg2.connect(dsn, connection_factory=TracedConnection if TRACE_ENABLED else None)
+    POOL_METRICS['created'] += 1
+    return conn
+
+def _discard_db_connection(conn):
+    POOL_METRICS['discarded'] += 1
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def _is_connection_healthy(conn, idle_for: float) -> bool:
+    if conn.closed:
+        return False
+    if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        return False
+    if idle_for < DB_POOL_CHECK_AFTER:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _reap_idle_connections(now: float):
+    while len(_pool_idle) > DB_POOL_MIN_SIZE and now - _pool_idle[0][1] > DB_POOL_IDLE_TIMEOUT:
+        conn, _ = _pool_idle.pop(0)
+        _discard_db_connection(conn)
+
+def get_db_connection():
+    # Под замком только ожидание слота и выбор кандидата; connect и проверка SELECT 1
+    # идут без замка, чтобы медленная сеть не останавливала выдачу соединений другим потокам
+    started = time.monotonic()
+    with _pool_lock:
+        _reap_idle_connections(started)
+        while not _pool_idle and POOL_METRICS['in_use'] >= DB_POOL_MAX_SIZE:
+            remaining = DB_POOL_CHECKOUT_TIMEOUT - (time.monotonic() - started)
+            if remaining <= 0 or not _pool_lock.wait(timeout=remaining):
+                raise psycopg2.pool.PoolError('connection pool exhausted')
+        POOL_METRICS['in_use'] += 1
+        candidate = _pool_idle.pop() if _pool_idle else None
+        POOL_METRICS['idle'] = len(_pool_idle)
+    
+    try:
+        while candidate is not None and not _is_connection_healthy(candidate[0], time.monotonic() - candidate[1]):
+            _discard_db_connection(candidate[0])
+            with _pool_lock:
+                candidate = _pool_idle.pop() if _pool_idle else None
+                POOL_METRICS['idle'] = len(_pool_idle)
+        conn = candidate[0] if candidate is not None else _open_db_connection()
+    except Exception:
+        with _pool_lock:
+            POOL_METRICS['in_use'] -= 1
+            _pool_lock.notify()
+        raise
+    
+    wait_ms = (time.monotonic() - started) * 1000
+    with _pool_lock:
+        POOL_METRICS['checkouts'] += 1
+        POOL_METRICS['last_wait_ms'] = round(wait_ms, 3)
+        POOL_METRICS['max_wait_ms'] = max(POOL_METRICS['max_wait_ms'], round(wait_ms, 3))
+        POOL_METRICS['total_wait_ms'] += wait_ms
+    trace_record('db.checkout', wait_ms)
+    return conn
+
+def release_db_connection(conn):
+    with _pool_lock:
+        POOL_METRICS['in_use'] -= 1
+        if conn.closed or len(_pool_idle) >= DB_POOL_MAX_SIZE:
+            _discard_db_connection(conn)
+        else:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                _pool_idle.append((conn, time.monotonic()))
+            except psycopg2.Error:
+                _discard_db_connection(conn)
+        POOL_METRICS['idle'] = len(_pool_idle)
+        _pool_lock.notify()
+
+def log_pool_metrics(function_name: str, context: Any):
+    flush_trace(function_name, context)
+    if DB_POOL_LOG_METRICS:
+        print(json.dumps({
+            'function': function_name,
+            'request_id': getattr(context, 'request_id', None),
+            'db_pool': POOL_METRICS,
+            'telegram': TELEGRAM_METRICS,
+            'dedup': DEDUP_METRICS,
+            'traces': TRACE_HISTOGRAMS if TRACE_ENABLED else None
+        }))
+
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org')
+TELEGRAM_TIMEOUT = float(os.environ.get('TELEGRAM_TIMEOUT', '10'))
+TELEGRAM_CONNECT_RETRIES = int(os.environ.get('TELEGRAM_CONNECT_RETRIES', '2'))
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', '10'))
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', 'https://functions.poehali.dev/af40ed3c-a51d-4f3f-ae16-ef69f32d3a02')
+
+# Keep-alive сессия живёт между "тёплыми" вызовами; повторяем только ошибки соединения,
+# чтобы не отправить сообщение дважды
+_telegram_session = requests.Session()
+_telegram_session.mount(TELEGRAM_API_BASE, HTTPAdapter(
+    pool_connections=TELEGRAM_POOL_SIZE,
+    pool_maxsize=TELEGRAM_POOL_SIZE,
+    max_retries=Retry(total=TELEGRAM_CONNECT_RETRIES, connect=TELEGRAM_CONNECT_RETRIES, read=0, status=0, other=0)
+))
+TELEGRAM_METRICS: Dict[str, Any] = {'calls': 0, 'errors': 0, 'deferred': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'methods': {}}
+
+def webhook_params(bot_id: int, webhook_secret: str) -> Dict[str, Any]:
+    # Токен в адрес не попадает: вебхук находит бота по id и сверяет секрет из заголовка
+    return {'url': f'{WEBHOOK_URL}?bot={bot_id}', 'secret_token': webhook_secret}
+
+def telegram_call(bot_token: str, method: str, payload: Dict[str, Any] = None, timeout: float = None) -> requests.Response:
+    started = time.monotonic()
+    try:
+        with trace_span('telegram.call', method=method):
+            return _telegram_session.post(
+                f'{TELEGRAM_API_BASE}/bot{bot_token}/{method}',
+                json=payload or {},
+                timeout=timeout or TELEGRAM_TIMEOUT
+            )
+    except requests.RequestException:
+        TELEGRAM_METRICS['errors'] += 1
+        raise
+    finally:
+        elapsed_ms = (time.monotonic() - started) * 1000
+        TELEGRAM_METRICS['calls'] += 1
+        TELEGRAM_METRICS['total_ms'] += elapsed_ms
+        TELEGRAM_METRICS['max_ms'] = max(TELEGRAM_METRICS['max_ms'], round(elapsed_ms, 3))
+        per_method = TELEGRAM_METRICS['methods'].setdefault(method, {'calls': 0, 'total_ms': 0.0})
+        per_method['calls'] += 1
+        per_method['total_ms'] += elapsed_ms
+
+def public_error(error: Exception) -> str:
+    # Текст исключений requests содержит URL с токеном бота - наружу и в трейс отдаём только тип
+    if isinstance(error, requests.RequestException):
+        return f'Telegram request failed: {type(error).__name__}'
+    return str(error)
+
+TELEGRAM_RATE_PER_TOKEN = float(os.environ.get('TELEGRAM_RATE_PER_TOKEN', '30'))
+TELEGRAM_RATE_PER_CHAT = float(os.environ.get('TELEGRAM_RATE_PER_CHAT', '1'))
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_MAX_INLINE_WAIT = float(os.environ.get('TELEGRAM_MAX_INLINE_WAIT', '3'))
+
+TELEGRAM_BUCKETS_SIZE = int(os.environ.get('TELEGRAM_BUCKETS_SIZE', '10000'))
+
+# Token bucket: ключ -> (доступные токены, время последнего пополнения). Давно не тронутые
+# вёдра успели наполниться и ничем не отличаются от новых, поэтому вытесняются первыми
+_buckets: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()
+
+def bucket_wait(key: str, rate: float, capacity: float, now: float) -> float:
+    tokens, updated_at = _buckets.get(key, (capacity, now))
+    tokens = min(capacity, tokens + (now - updated_at) * rate)
+    _buckets[key] = (tokens, now)
+    _buckets.move_to_end(key)
+    while len(_buckets) > TELEGRAM_BUCKETS_SIZE:
+        _buckets.popitem(last=False)
+    return 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+def bucket_take(key: str):
+    tokens, updated_at = _buckets[key]
+    _buckets[key] = (tokens - 1, updated_at)
+
+def retry_after_seconds(response: requests.Response) -> float:
+    try:
+        return float(response.json().get('parameters', {}).get('retry_after', 1))
+    except ValueError:
+        return 1.0
+
+# Вызовы, отложенные за время обработки апдейта: пишутся в outbox соединением обработчика
+# в одной транзакции с его состоянием, поэтому второе соединение пула не нужно
+_deferred_local = threading.local()
+
+def enqueue_deferred(bot_token: str, method: str, payload: Dict[str, Any], delay: float):
+    # Ждать лимит Telegram дольше TELEGRAM_MAX_INLINE_WAIT нельзя: вызов уходит в outbox,
+    # и диспетчер отправит его, когда лимит снимется
+    _deferred_local.calls.append((bot_token, method, Json(payload), delay))
+
+def save_deferred(cursor):
+    calls = _deferred_local.calls
+    _deferred_local.calls = []
+    if calls:
+        execute_values(
+            cursor,
+            '''INSERT INTO outbox (bot_token, method, payload, next_attempt_at) VALUES %s''',
+            calls,
+            template="(%s, %s, %s, CURRENT_TIMESTAMP + %s * INTERVAL '1 second')"
+        )
+        TELEGRAM_METRICS['deferred'] += len(calls)
+
+def telegram_request(bot_token: str, method: str, payload: Dict[str, Any] = None, timeout: float = None,
+                     deferrable: bool = False) -> Optional[requests.Response]:
+    # deferrable: ответ вызывающему не нужен, и при долгом лимите вызов можно отправить позже через outbox
+    keys = [(f'token:{bot_token}', TELEGRAM_RATE_PER_TOKEN, TELEGRAM_RATE_PER_TOKEN)]
+    if payload and payload.get('chat_id') is not None:
+        keys.append((f'chat:{bot_token}:{payload["chat_id"]}', TELEGRAM_RATE_PER_CHAT, TELEGRAM_CHAT_BURST))
+    
+    wait = max(bucket_wait(key, rate, capacity, time.monotonic()) for key, rate, capacity in keys)
+    if wait > TELEGRAM_MAX_INLINE_WAIT and deferrable:
+        enqueue_deferred(bot_token, method, payload, wait)
+        return None
+    if wait > 0:
+        time.sleep(min(wait, TELEGRAM_MAX_INLINE_WAIT))
+        for key, rate, capacity in keys:
+            bucket_wait(key, rate, capacity, time.monotonic())
+    for key, _, _ in keys:
+        bucket_take(key)
+    
+    response = telegram_call(bot_token, method, payload, timeout)
+    if response.status_code == 429:
+        retry_after = retry_after_seconds(response)
+        if retry_after <= TELEGRAM_MAX_INLINE_WAIT:
+            time.sleep(retry_after)
+            response = telegram_call(bot_token, method, payload, timeout)
+            if response.status_code == 429:
+                retry_after = retry_after_seconds(response)
+        if response.status_code == 429 and deferrable:
+            enqueue_deferred(bot_token, method, payload, retry_after)
+    return response
 
 def send_message(bot_token: str, chat_id: int, text: str, reply_markup: Dict = None):
-    url = f'https://api.telegram.org/bot{bot_token}/sendMessage'
     payload = {'chat_id': chat_id, 'text': text, 'parse_mode': 'HTML'}
     if reply_markup:
         payload['reply_markup'] = reply_markup
-    requests.post(url, json=payload, timeout=10)
+    telegram_request(bot_token, 'sendMessage', payload, deferrable=True)
+
+def edit_message(bot_token: str, chat_id: int, message_id: int, text: str, reply_markup: Dict = None):
+    payload = {'chat_id': chat_id, 'message_id': message_id, 'text': text, 'parse_mode': 'HTML'}
+    if reply_markup:
+        payload['reply_markup'] = reply_markup
+    telegram_request(bot_token, 'editMessageText', payload, deferrable=True)
 
-def get_main_menu_keyboard():
+def get_main_menu_keyboard(unread: int = 0):
+    messages_text = f'💬 Входящие сообщения ({unread})' if unread else '💬 Входящие сообщения'
     return {
         'inline_keyboard': [
             [{'text': '🤖 Создать бота', 'callback_data': 'create_bot'}],
             [{'text': '⚙️ Мои боты', 'callback_data': 'my_bots'}],
-            [{'text': '💬 Входящие сообщения', 'callback_data': 'messages'}],
+            [{'text': messages_text, 'callback_data': 'messages'}],
+            [{'text': '🔎 Поиск', 'callback_data': 'search'}],
         ]
     }
 
+def token_key(bot_token: str) -> str:
+    return hashlib.md5(bot_token.encode()).hexdigest()
+
+UPDATE_DEDUP_SIZE = int(os.environ.get('UPDATE_DEDUP_SIZE', '10000'))
+
+# Недавно обработанные (md5(bot_token), update_id): повтор отсекается ещё до обращения к базе
+_recent_updates: 'OrderedDict[Tuple[str, int], None]' = OrderedDict()
+DEDUP_METRICS: Dict[str, int] = {'suppressed': 0}
+
+def is_recent_update(bot_key: str, update_id: Optional[int]) -> bool:
+    if update_id is None or (bot_key, update_id) not in _recent_updates:
+        return False
+    _recent_updates.move_to_end((bot_key, update_id))
+    DEDUP_METRICS['suppressed'] += 1
+    return True
+
+def remember_update(bot_key: str, update_id: Optional[int]):
+    if update_id is None:
+        return
+    _recent_updates[(bot_key, update_id)] = None
+    _recent_updates.move_to_end((bot_key, update_id))
+    while len(_recent_updates) > UPDATE_DEDUP_SIZE:
+        _recent_updates.popitem(last=False)
+
+def claim_update(cursor, bot_key: str, update_id: Optional[int],
+                 user_id: Optional[int] = None) -> Tuple[bool, str, Dict[str, Any]]:
+    # Захват фиксируется вместе с шагом диалога; при ошибке откатывается, и Telegram сможет повторить.
+    # Тем же оператором читается состояние диалога пользователя: переход выбирается по состоянию,
+    # поэтому прочитать его в операторе перехода нельзя, а отдельный SELECT стоил бы ещё одного обращения
+    if update_id is not None and is_recent_update(bot_key, update_id):
+        return False, 'idle', {}
+    if update_id is None and user_id is None:
+        return True, 'idle', {}
+    cursor.execute(
+        '''WITH claimed AS (
+               INSERT INTO processed_updates (bot_key, update_id)
+               SELECT %s, %s::bigint WHERE %s::bigint IS NOT NULL
+               ON CONFLICT DO NOTHING
+               RETURNING 1
+           )
+           SELECT %s::bigint IS NULL OR EXISTS (SELECT 1 FROM claimed) AS claimed, u.state, u.state_data
+           FROM (SELECT 1) AS one
+           LEFT JOIN bot_constructor_users u ON u.telegram_user_id = %s''',
+        (bot_key, update_id, update_id, update_id, user_id)
+    )
+    row = cursor.fetchone()
+    if not row['claimed']:
+        DEDUP_METRICS['suppressed'] += 1
+        remember_update(bot_key, update_id)
+        return False, 'idle', {}
+    return True, row['state'] or 'idle', row['state_data'] or {}
+
+def release_update(conn, cursor, bot_key: str, update_id: Optional[int]):
+    # Шаги диалога коммитятся до ответа в Telegram, и захват уходит в базу вместе с первым коммитом.
+    # Если обработка потом упала, снимаем захват: иначе повтор от Telegram будет отброшен как дубликат
+    if update_id is None:
+        return
+    try:
+        cursor.execute('DELETE FROM processed_updates WHERE bot_key = %s AND update_id = %s', (bot_key, update_id))
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+
+REPLY_KEY_CACHE_SIZE = int(os.environ.get('REPLY_KEY_CACHE_SIZE', '5000'))
+
+# (чат владельца, id приглашения) -> (bot_id, chat_id, telegram_message_id); ключи не меняются, TTL не нужен
+_reply_keys: 'OrderedDict[Tuple[int, int], Tuple[int, int, Optional[int]]]' = OrderedDict()
+
+def cache_reply_key(key: Tuple[int, int], target: Tuple[int, int, Optional[int]]):
+    _reply_keys[key] = target
+    _reply_keys.move_to_end(key)
+    while len(_reply_keys) > REPLY_KEY_CACHE_SIZE:
+        _reply_keys.popitem(last=False)
+
+def resolve_reply_key(cursor, owner_chat_id: int, prompt_message_id: int) -> Optional[Tuple[int, int, Optional[int]]]:
+    key = (owner_chat_id, prompt_message_id)
+    if key in _reply_keys:
+        _reply_keys.move_to_end(key)
+        return _reply_keys[key]
+    cursor.execute(
+        '''SELECT bot_id, chat_id, telegram_message_id FROM reply_keys
+           WHERE owner_chat_id = %s AND prompt_message_id = %s''',
+        key
+    )
+    row = cursor.fetchone()
+    if not row:
+        return None
+    target = (row['bot_id'], row['chat_id'], row['telegram_message_id'])
+    cache_reply_key(key, target)
+    return target
+
+def save_transition(ctx: Dict[str, Any], state: str, state_data: Dict = None,
+                    effect: str = None, effect_args: Tuple = (), with_unread: bool = False) -> Dict[str, Any]:
+    # Побочная запись (effect должен заканчиваться RETURNING), новое состояние
+    # и при необходимости счётчик непрочитанных - одним оператором
+    effect_cte = f'effect AS ({effect}),' if effect else ''
+    affected = '(SELECT COUNT(*) FROM effect)' if effect else '0'
+    effect_row = '(SELECT to_jsonb(e) FROM effect e LIMIT 1)' if effect else 'NULL::jsonb'
+    unread = '''(SELECT COALESCE(SUM(s.unread_count), 0) FROM bot_stats s
+                 JOIN bots b ON b.id = s.bot_id
+                 WHERE b.owner_id = %s AND b.is_active = true)''' if with_unread else '0'
+    args = list(effect_args) + [ctx['user_id'], ctx['username'], state, Json(state_data or {})]
+    if with_unread:
+        args.append(ctx['owner_id'])
+    
+    ctx['cursor'].execute(
+        f'''WITH {effect_cte} saved AS (
+               INSERT INTO bot_constructor_users (telegram_user_id, telegram_username, state, state_data, updated_at)
+               VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+               ON CONFLICT (telegram_user_id) DO UPDATE 
+               SET state = EXCLUDED.state, 
+                   state_data = EXCLUDED.state_data,
+                   telegram_username = EXCLUDED.telegram_username,
+                   updated_at = CURRENT_TIMESTAMP
+               RETURNING 1
+           )
+           SELECT {affected} AS affected, {effect_row} AS effect_row, {unread} AS unread FROM saved''',
+        args
+    )
+    return ctx['cursor'].fetchone()
+
+def on_start(ctx: Dict[str, Any], text: str):
+    result = save_transition(ctx, 'idle', with_unread=True)
+    ctx['conn'].commit()
+    
+    welcome_text = (
+        "🤖 <b>Добро пожаловать в Bot Constructor!</b>\n\n"
+        "Я помогу вам создать своего Telegram-бота для обратной связи.\n\n"
+        "Выберите действие:"
+    )
+    send_message(ctx['bot_token'], ctx['chat_id'], welcome_text, get_main_menu_keyboard(result['unread']))
+
+def on_idle_text(ctx: Dict[str, Any], text: str):
+    send_message(ctx['bot_token'], ctx['chat_id'], 'Используйте /start для начала работы.')
+
+def on_bot_token_text(ctx: Dict[str, Any], text: str):
+    if len(text) < 10 or ':' not in text:
+        send_message(ctx['bot_token'], ctx['chat_id'], '❌ Некорректный токен. Попробуйте ещё раз или отправьте /start для отмены.')
+        return
+    
+    response = telegram_request(text, 'getMe')
+    if response.status_code != 200 or not response.json().get('ok'):
+        send_message(ctx['bot_token'], ctx['chat_id'], '❌ Неверный токен. Проверьте и попробуйте снова.')
+        return
+    
+    bot_username = response.json()['result']['username']
+    result = save_transition(
+        ctx, 'idle',
+        effect='''INSERT INTO bots (owner_id, bot_token, bot_username)
+                  VALUES (%s, %s, %s)
+                  ON CONFLICT (bot_token) DO UPDATE 
+                  SET owner_id = EXCLUDED.owner_id, is_active = true, updated_at = CURRENT_TIMESTAMP
+                  RETURNING id, webhook_secret, delivery_mode''',
+        effect_args=(ctx['owner_id'], text, bot_username)
+    )
+    bot = result['effect_row']
+    ctx['conn'].commit()
+    
+    # Бот в режиме polling забирает обновления через getUpdates, вебхук ему не ставим
+    if bot['delivery_mode'] != 'polling':
+        telegram_request(text, 'setWebhook', webhook_params(bot['id'], bot['webhook_secret']))
+    
+    success_text = (
+        f"🎉 <b>Бот @{bot_username} успешно подключен!</b>\n\n"
+        "Теперь пользователи могут писать в него сообщения, "
+        "и вы будете получать их в разделе 'Входящие сообщения'."
+    )
+    send_message(ctx['bot_token'], ctx['chat_id'], success_text, get_main_menu_keyboard())
+
+def on_welcome_text(ctx: Dict[str, Any], text: str):
+    bot_id = ctx['state_data'].get('bot_id')
+    if not bot_id:
+        return
+    
+    save_transition(
+        ctx, 'idle',
+        effect='''UPDATE bots SET welcome_text = %s, updated_at = CURRENT_TIMESTAMP
+                  WHERE id = %s AND owner_id = %s RETURNING id''',
+        effect_args=(text, bot_id, ctx['owner_id'])
+    )
+    ctx['conn'].commit()
+    send_message(ctx['bot_token'], ctx['chat_id'], '✅ Текст приветствия обновлён!', get_main_menu_keyboard())
+
+def on_create_bot(ctx: Dict[str, Any], arg: str):
+    save_transition(ctx, 'waiting_bot_token')
+    ctx['conn'].commit()
+    
+    instruction_text = (
+        "📝 <b>Создание бота</b>\n\n"
+        "<b>Шаг 1:</b> Откройте @BotFather\n"
+        "<b>Шаг 2:</b> Отправьте /newbot\n"
+        "<b>Шаг 3:</b> Следуйте инструкциям\n"
+        "<b>Шаг 4:</b> Скопируйте токен и отправьте мне\n\n"
+        "Жду токен вашего бота:"
+    )
+    send_message(ctx['bot_token'], ctx['chat_id'], instruction_text)
+
+def on_my_bots(ctx: Dict[str, Any], arg: str):
+    ctx['cursor'].execute(
+        '''SELECT b.id, b.bot_username, b.is_active, COALESCE(s.unread_count, 0) AS unread_count
+           FROM bots b
+           LEFT JOIN bot_stats s ON s.bot_id = b.id
+           WHERE b.owner_id = %s AND b.is_active = true''',
+        (ctx['owner_id'],)
+    )
+    bots = ctx['cursor'].fetchall()
+    
+    if not bots:
+        send_message(ctx['bot_token'], ctx['chat_id'], 'У вас пока нет подключенных ботов.', get_main_menu_keyboard())
+        return
+    
+    buttons = []
+    for bot in bots:
+        unread_badge = f' ({bot["unread_count"]})' if bot['unread_count'] else ''
+        buttons.append([
+            {'text': f'@{bot["bot_username"]}{unread_badge}', 'callback_data': f'bot_{bot["id"]}'}
+        ])
+    buttons.append([{'text': '◀️ Назад', 'callback_data': 'main_menu'}])
+    
+    send_message(ctx['bot_token'], ctx['chat_id'], '🤖 <b>Ваши боты:</b>', {'inline_keyboard': buttons})
+
+def on_bot_menu(ctx: Dict[str, Any], arg: str):
+    bot_id = int(arg)
+    ctx['cursor'].execute(
+        'SELECT bot_username, bot_token FROM bots WHERE id = %s AND owner_id = %s',
+        (bot_id, ctx['owner_id'])
+    )
+    bot = ctx['cursor'].fetchone()
+    
+    if bot:
+        keyboard = {
+            'inline_keyboard': [
+                [{'text': '⚙️ Изменить приветствие', 'callback_data': f'edit_welcome_{bot_id}'}],
+                [{'text': '🔌 Отвязать бота', 'callback_data': f'disconnect_{bot_id}'}],
+                [{'text': '◀️ Назад', 'callback_data': 'my_bots'}]
+            ]
+        }
+        send_message(ctx['bot_token'], ctx['chat_id'], f'Бот @{bot["bot_username"]}', keyboard)
+
+def on_edit_welcome(ctx: Dict[str, Any], arg: str):
+    save_transition(ctx, 'waiting_welcome_text', {'bot_id': int(arg)})
+    ctx['conn'].commit()
+    send_message(ctx['bot_token'], ctx['chat_id'], 'Отправьте новый текст приветствия:')
+
+def on_disconnect(ctx: Dict[str, Any], arg: str):
+    ctx['cursor'].execute(
+        'UPDATE bots SET is_active = false, updated_at = CURRENT_TIMESTAMP WHERE id = %s AND owner_id = %s',
+        (int(arg), ctx['owner_id'])
+    )
+    ctx['conn'].commit()
+    send_message(ctx['bot_token'], ctx['chat_id'], '✅ Бот отвязан', get_main_menu_keyboard())
+
+INBOX_PAGE_SIZE = int(os.environ.get('INBOX_PAGE_SIZE', '5'))
+INBOX_TEXT_LIMIT = 600
+
+def fetch_inbox_page(cursor, owner_id: str, before_id: int = None, after_id: int = None) -> Tuple[List[Dict[str, Any]], bool, bool]:
+    # Keyset по (created_at, id): страница берётся с запасом в одну строку, чтобы знать, есть ли продолжение.
+    # Каждый бот отдаёт не больше страницы по индексу idx_messages_bot_created_id, и только эти строки
+    # сортируются: у владельца с сотней ботов JOIN по всем сообщениям планировщик читал таблицу целиком
+    conditions = ['bot_id = b.id', 'is_archived = false']
+    args: List[Any] = []
+    order = 'DESC'
+    if before_id:
+        conditions.append('(created_at, id) < (SELECT created_at, id FROM messages WHERE id = %s)')
+        args.append(before_id)
+    elif after_id:
+        conditions.append('(created_at, id) > (SELECT created_at, id FROM messages WHERE id = %s)')
+        args.append(after_id)
+        order = 'ASC'
+    args.extend([INBOX_PAGE_SIZE + 1, owner_id, INBOX_PAGE_SIZE + 1])
+    
+    cursor.execute(
+        f'''SELECT m.id, m.chat_id, m.username, m.first_name, m.message_text, m.created_at, b.bot_username
+           FROM bots b
+           CROSS JOIN LATERAL (
+               SELECT id, chat_id, username, first_name, message_text, created_at
+               FROM messages
+               WHERE {' AND '.join(conditions)}
+               ORDER BY created_at {order}, id {order}
+               LIMIT %s
+           ) m
+           WHERE b.owner_id = %s AND b.is_active = true
+           ORDER BY m.created_at {order}, m.id {order}
+           LIMIT %s''',
+        args
+    )
+    rows = cursor.fetchall()
+    has_more = len(rows) > INBOX_PAGE_SIZE
+    rows = rows[:INBOX_PAGE_SIZE]
+    
+    if after_id:
+        rows.reverse()
+        return rows, has_more, True
+    return rows, bool(before_id), has_more
+
+def render_inbox_page(messages: List[Dict[str, Any]], has_newer: bool, has_older: bool,
+                      title: str = '💬 <b>Входящие сообщения</b>') -> Tuple[str, Dict[str, Any]]:
+    lines = [title]
+    reply_buttons = []
+    for number, msg in enumerate(messages, 1):
+        username_display = f"@{msg['username']}" if msg['username'] else msg['first_name']
+        message_text = msg['message_text']
+        if len(message_text) > INBOX_TEXT_LIMIT:
+            message_text = message_text[:INBOX_TEXT_LIMIT] + '…'
+        lines.append(
+            f"<b>{number}.</b> {html.escape(username_display or '')} → @{msg['bot_username']} "
+            f"· {msg['created_at']:%d.%m %H:%M}\n{html.escape(message_text)}"
+        )
+        reply_buttons.append({'text': f'↩️ {number}', 'callback_data': f'reply_{msg["id"]}'})
+    
+    navigation = []
+    if has_newer:
+        navigation.append({'text': '◀️ Новее', 'callback_data': f'inbox_newer_{messages[0]["id"]}'})
+    if has_older:
+        navigation.append({'text': 'Старее ▶️', 'callback_data': f'inbox_older_{messages[-1]["id"]}'})
+    
+    keyboard = [reply_buttons]
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([{'text': '🏠 Главное меню', 'callback_data': 'main_menu'}])
+    return '\n\n'.join(lines), {'inline_keyboard': keyboard}
+
+def on_messages(ctx: Dict[str, Any], arg: str):
+    messages, has_newer, has_older = fetch_inbox_page(ctx['cursor'], ctx['owner_id'])
+    
+    if not messages:
+        send_message(ctx['bot_token'], ctx['chat_id'], 'Нет входящих сообщений.', get_main_menu_keyboard())
+        return
+    
+    text, keyboard = render_inbox_page(messages, has_newer, has_older)
+    send_message(ctx['bot_token'], ctx['chat_id'], text, keyboard)
+
+def on_inbox_page(ctx: Dict[str, Any], arg: str):
+    direction, message_id = arg.split('_')
+    if direction == 'older':
+        messages, has_newer, has_older = fetch_inbox_page(ctx['cursor'], ctx['owner_id'], before_id=int(message_id))
+    else:
+        messages, has_newer, has_older = fetch_inbox_page(ctx['cursor'], ctx['owner_id'], after_id=int(message_id))
+        if not messages:
+            messages, has_newer, has_older = fetch_inbox_page(ctx['cursor'], ctx['owner_id'])
+    
+    if not messages:
+        return
+    
+    # Листание редактирует уже показанное сообщение - один вызов API на страницу
+    text, keyboard = render_inbox_page(messages, has_newer, has_older)
+    edit_message(ctx['bot_token'], ctx['chat_id'], ctx['message_id'], text, keyboard)
+
+def on_reply(ctx: Dict[str, Any], arg: str):
+    # Кнопка создаёт приглашение с force_reply; ответ на него (Reply) адресуется по ключу,
+    # поэтому можно открыть несколько приглашений и отвечать в любом порядке без смены состояния
+    message_id = int(arg.split('_')[0])
+    ctx['cursor'].execute(
+        '''SELECT m.bot_id, m.chat_id, m.telegram_message_id, m.username, m.first_name, m.message_text
+           FROM messages m
+           JOIN bots b ON m.bot_id = b.id
+           WHERE m.id = %s AND b.owner_id = %s''',
+        (message_id, ctx['owner_id'])
+    )
+    msg = ctx['cursor'].fetchone()
+    if not msg:
+        return
+    
+    username_display = f"@{msg['username']}" if msg['username'] else msg['first_name']
+    message_text = msg['message_text']
+    if len(message_text) > INBOX_TEXT_LIMIT:
+        message_text = message_text[:INBOX_TEXT_LIMIT] + '…'
+    response = telegram_request(ctx['bot_token'], 'sendMessage', {
+        'chat_id': ctx['chat_id'],
+        'text': (
+            f"↩️ <b>Ответ для {html.escape(username_display or '')}</b>\n\n"
+            f"<i>{html.escape(message_text)}</i>\n\n"
+            "Ответьте на это сообщение (Reply), чтобы отправить ответ."
+        ),
+        'parse_mode': 'HTML',
+        'reply_markup': {'force_reply': True, 'input_field_placeholder': 'Ваш ответ'}
+    })
+    prompt = response.json().get('result') if response.ok else None
+    if not prompt:
+        return
+    
+    key = (ctx['chat_id'], prompt['message_id'])
+    target = (msg['bot_id'], msg['chat_id'], msg['telegram_message_id'])
+    ctx['cursor'].execute(
+        '''INSERT INTO reply_keys (owner_chat_id, prompt_message_id, message_id, bot_id, chat_id, telegram_message_id)
+           VALUES (%s, %s, %s, %s, %s, %s)
+           ON CONFLICT DO NOTHING''',
+        key + (message_id,) + target
+    )
+    cache_reply_key(key, target)
+
+def on_native_reply(ctx: Dict[str, Any], text: str, target: Tuple[int, int, Optional[int]]):
+    bot_id, original_chat_id, telegram_message_id = target
+    payload = {'chat_id': original_chat_id, 'text': f'📩 Ответ от владельца:\n\n{text}'}
+    if telegram_message_id:
+        payload['reply_parameters'] = {'message_id': telegram_message_id, 'allow_sending_without_reply': True}
+    
+    # Токен бота и права владельца проверяются в той же вставке в outbox
+    ctx['cursor'].execute(
+        '''INSERT INTO outbox (bot_token, method, payload)
+           SELECT bot_token, 'sendMessage', %s FROM bots
+           WHERE id = %s AND owner_id = %s AND is_active = true
+           RETURNING id''',
+        (Json(payload), bot_id, ctx['owner_id'])
+    )
+    sent = ctx['cursor'].fetchone()
+    ctx['conn'].commit()
+    send_message(ctx['bot_token'], ctx['chat_id'], '✅ Ответ отправлен!' if sent else '❌ Бот отключён, ответ не отправлен.')
+
+SEARCH_MIN_LENGTH = 2
+SEARCH_TRGM_MAX_LENGTH = int(os.environ.get('SEARCH_TRGM_MAX_LENGTH', '3'))
+# Выражения совпадают с индексами idx_messages_search и idx_messages_search_trgm
+SEARCH_TSQUERY_SQL = ("(websearch_to_tsquery('russian', %s) || websearch_to_tsquery('english', %s)"
+                      " || websearch_to_tsquery('simple', %s))")
+SEARCH_TEXT_SQL = ("(m.message_text || ' ' || COALESCE(m.username, '') || ' ' || COALESCE(m.first_name, '')"
+                   " || ' ' || COALESCE(m.last_name, ''))")
+
+def fetch_search_page(cursor, owner_id: str, text: str) -> List[Dict[str, Any]]:
+    if ' ' not in text and len(text) <= SEARCH_TRGM_MAX_LENGTH:
+        pattern = '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        condition, condition_args = f'{SEARCH_TEXT_SQL} ILIKE %s', [pattern]
+        rank, rank_args = f'similarity({SEARCH_TEXT_SQL}, %s)', [text]
+    else:
+        condition, condition_args = f'm.search_vector @@ {SEARCH_TSQUERY_SQL}', [text] * 3
+        rank, rank_args = f'ts_rank_cd(m.search_vector, {SEARCH_TSQUERY_SQL})', [text] * 3
+    
+    cursor.execute(
+        f'''SELECT m.id, m.chat_id, m.username, m.first_name, m.message_text, m.created_at, b.bot_username
+           FROM messages m
+           JOIN bots b ON m.bot_id = b.id
+           WHERE b.owner_id = %s AND b.is_active = true AND {condition}
+           ORDER BY {rank} DESC, m.created_at DESC, m.id DESC
+           LIMIT %s''',
+        [owner_id] + condition_args + rank_args + [INBOX_PAGE_SIZE]
+    )
+    return cursor.fetchall()
+
+def on_search(ctx: Dict[str, Any], arg: str):
+    save_transition(ctx, 'waiting_search')
+    ctx['conn'].commit()
+    send_message(ctx['bot_token'], ctx['chat_id'], '🔎 Введите слово или фразу для поиска по входящим:')
+
+def on_search_text(ctx: Dict[str, Any], text: str):
+    text = ' '.join(text.split())
+    if len(text) < SEARCH_MIN_LENGTH:
+        send_message(ctx['bot_token'], ctx['chat_id'], f'Запрос должен быть не короче {SEARCH_MIN_LENGTH} символов.')
+        return
+    
+    save_transition(ctx, 'idle')
+    ctx['conn'].commit()
+    messages = fetch_search_page(ctx['cursor'], ctx['owner_id'], text)
+    if not messages:
+        send_message(ctx['bot_token'], ctx['chat_id'], 'Ничего не найдено.', get_main_menu_keyboard())
+        return
+    
+    reply, keyboard = render_inbox_page(messages, False, False, title=f'🔎 <b>Поиск:</b> {html.escape(text)}')
+    send_message(ctx['bot_token'], ctx['chat_id'], reply, keyboard)
+
+def on_main_menu(ctx: Dict[str, Any], arg: str):
+    result = save_transition(ctx, 'idle', with_unread=True)
+    ctx['conn'].commit()
+    send_message(ctx['bot_token'], ctx['chat_id'], 'Главное меню:', get_main_menu_keyboard(result['unread']))
+
+# Конечный автомат диалога: текст обрабатывается по текущему состоянию,
+# нажатия кнопок от состояния не зависят и состояние не читают
+MESSAGE_HANDLERS = {
+    'idle': on_idle_text,
+    'waiting_bot_token': on_bot_token_text,
+    'waiting_welcome_text': on_welcome_text,
+    'waiting_search': on_search_text
+}
+
+CALLBACK_HANDLERS = {
+    'create_bot': on_create_bot,
+    'my_bots': on_my_bots,
+    'messages': on_messages,
+    'search': on_search,
+    'main_menu': on_main_menu
+}
+
+CALLBACK_PREFIX_HANDLERS = [
+    ('edit_welcome_', on_edit_welcome),
+    ('disconnect_', on_disconnect),
+    ('reply_', on_reply),
+    ('inbox_', on_inbox_page),
+    ('bot_', on_bot_menu)
+]
+
+def handle_callback(ctx: Dict[str, Any], data: str):
+    if data in CALLBACK_HANDLERS:
+        CALLBACK_HANDLERS[data](ctx, '')
+        return
+    for prefix, step in CALLBACK_PREFIX_HANDLERS:
+        if data.startswith(prefix):
+            step(ctx, data[len(prefix):])
+            return
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'POST')
+    trace_start()
     
     if method == 'OPTIONS':
         return {
@@ -87,235 +934,74 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
+    bot_key = token_key(bot_token)
+    _deferred_local.calls = []
+    update_id = None
+    claimed = False
     
     try:
         update = json.loads(event.get('body', '{}'))
+        update_id = update.get('update_id')
+        
+        user_id = update['message']['from']['id'] if 'message' in update else None
+        claimed, state, state_data = claim_update(cursor, bot_key, update_id, user_id)
+        if not claimed:
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'ok': True}),
+                'isBase64Encoded': False
+            }
         
         if 'message' in update:
             message = update['message']
-            chat_id = message['chat']['id']
-            telegram_user_id = message['from']['id']
-            username = message['from'].get('username', 'user')
+            ctx = {
+                'conn': conn,
+                'cursor': cursor,
+                'bot_token': bot_token,
+                'chat_id': message['chat']['id'],
+                'user_id': message['from']['id'],
+                'owner_id': str(message['from']['id']),
+                'username': message['from'].get('username', 'user'),
+                'state_data': {}
+            }
             text = message.get('text', '')
             
-            user_state = get_user_state(cursor, telegram_user_id)
-            current_state = user_state['state']
-            state_data = user_state['state_data']
+            reply_to = message.get('reply_to_message')
+            target = resolve_reply_key(cursor, ctx['chat_id'], reply_to['message_id']) if reply_to and text and text != '/start' else None
             
             if text == '/start':
-                set_user_state(cursor, telegram_user_id, username, 'idle', {})
-                conn.commit()
-                
-                welcome_text = (
-                    "🤖 <b>Добро пожаловать в Bot Constructor!</b>\n\n"
-                    "Я помогу вам создать своего Telegram-бота для обратной связи.\n\n"
-                    "Выберите действие:"
-                )
-                send_message(bot_token, chat_id, welcome_text, get_main_menu_keyboard())
-            
-            elif current_state == 'waiting_bot_token':
-                if len(text) < 10 or ':' not in text:
-                    send_message(bot_token, chat_id, '❌ Некорректный токен. Попробуйте ещё раз или отправьте /start для отмены.')
-                else:
-                    telegram_api_url = f'https://api.telegram.org/bot{text}/getMe'
-                    response = requests.get(telegram_api_url, timeout=10)
-                    
-                    if response.status_code == 200 and response.json().get('ok'):
-                        bot_info = response.json()['result']
-                        bot_username = bot_info['username']
-                        
-                        cursor.execute(
-                            '''INSERT INTO bots (owner_id, bot_token, bot_username)
-                               VALUES (%s, %s, %s)
-                               ON CONFLICT (bot_token) DO UPDATE 
-                               SET owner_id = EXCLUDED.owner_id, is_active = true
-                               RETURNING id''',
-                            (str(telegram_user_id), text, bot_username)
-                        )
-                        bot_id = cursor.fetchone()['id']
-                        
-                        webhook_url = f"https://functions.poehali.dev/af40ed3c-a51d-4f3f-ae16-ef69f32d3a02?bot_token={text}"
-                        requests.post(f'https://api.telegram.org/bot{text}/setWebhook', 
-                                    json={'url': webhook_url}, timeout=10)
-                        
-                        set_user_state(cursor, telegram_user_id, username, 'idle', {})
-                        conn.commit()
-                        
-                        success_text = (
-                            f"🎉 <b>Бот @{bot_username} успешно подключен!</b>\n\n"
-                            "Теперь пользователи могут писать в него сообщения, "
-                            "и вы будете получать их в разделе 'Входящие сообщения'."
-                        )
-                        send_message(bot_token, chat_id, success_text, get_main_menu_keyboard())
-                    else:
-                        send_message(bot_token, chat_id, '❌ Неверный токен. Проверьте и попробуйте снова.')
-            
-            elif current_state == 'waiting_welcome_text':
-                bot_id = state_data.get('bot_id')
-                if bot_id:
-                    cursor.execute(
-                        'UPDATE bots SET welcome_text = %s WHERE id = %s AND owner_id = %s',
-                        (text, bot_id, str(telegram_user_id))
-                    )
-                    conn.commit()
-                    
-                    set_user_state(cursor, telegram_user_id, username, 'idle', {})
-                    send_message(bot_token, chat_id, '✅ Текст приветствия обновлён!', get_main_menu_keyboard())
-            
-            elif current_state == 'waiting_reply':
-                message_id = state_data.get('message_id')
-                original_chat_id = state_data.get('chat_id')
-                user_bot_token = state_data.get('bot_token')
-                
-                if message_id and original_chat_id and user_bot_token:
-                    requests.post(
-                        f'https://api.telegram.org/bot{user_bot_token}/sendMessage',
-                        json={'chat_id': original_chat_id, 'text': f'📩 Ответ от владельца:\n\n{text}'},
-                        timeout=10
-                    )
-                    
-                    set_user_state(cursor, telegram_user_id, username, 'idle', {})
-                    send_message(bot_token, chat_id, '✅ Ответ отправлен!', get_main_menu_keyboard())
-            
+                on_start(ctx, text)
+            elif target:
+                on_native_reply(ctx, text, target)
+            elif text == '/search':
+                on_search(ctx, '')
+            elif text.startswith('/search '):
+                on_search_text(ctx, text[len('/search '):])
             else:
-                send_message(bot_token, chat_id, 'Используйте /start для начала работы.')
+                ctx['state_data'] = state_data
+                MESSAGE_HANDLERS.get(state, on_idle_text)(ctx, text)
         
         elif 'callback_query' in update:
             callback_query = update['callback_query']
-            chat_id = callback_query['message']['chat']['id']
-            telegram_user_id = callback_query['from']['id']
-            username = callback_query['from'].get('username', 'user')
-            data = callback_query['data']
+            ctx = {
+                'conn': conn,
+                'cursor': cursor,
+                'bot_token': bot_token,
+                'chat_id': callback_query['message']['chat']['id'],
+                'user_id': callback_query['from']['id'],
+                'owner_id': str(callback_query['from']['id']),
+                'username': callback_query['from'].get('username', 'user'),
+                'message_id': callback_query['message']['message_id'],
+                'state_data': {}
+            }
             
-            requests.post(
-                f'https://api.telegram.org/bot{bot_token}/answerCallbackQuery',
-                json={'callback_query_id': callback_query['id']},
-                timeout=5
-            )
-            
-            if data == 'create_bot':
-                set_user_state(cursor, telegram_user_id, username, 'waiting_bot_token', {})
-                conn.commit()
-                
-                instruction_text = (
-                    "📝 <b>Создание бота</b>\n\n"
-                    "<b>Шаг 1:</b> Откройте @BotFather\n"
-                    "<b>Шаг 2:</b> Отправьте /newbot\n"
-                    "<b>Шаг 3:</b> Следуйте инструкциям\n"
-                    "<b>Шаг 4:</b> Скопируйте токен и отправьте мне\n\n"
-                    "Жду токен вашего бота:"
-                )
-                send_message(bot_token, chat_id, instruction_text)
-            
-            elif data == 'my_bots':
-                cursor.execute(
-                    'SELECT id, bot_username, is_active FROM bots WHERE owner_id = %s AND is_active = true',
-                    (str(telegram_user_id),)
-                )
-                bots = cursor.fetchall()
-                
-                if not bots:
-                    send_message(bot_token, chat_id, 'У вас пока нет подключенных ботов.', get_main_menu_keyboard())
-                else:
-                    buttons = []
-                    for bot in bots:
-                        buttons.append([
-                            {'text': f'@{bot["bot_username"]}', 'callback_data': f'bot_{bot["id"]}'}
-                        ])
-                    buttons.append([{'text': '◀️ Назад', 'callback_data': 'main_menu'}])
-                    
-                    send_message(bot_token, chat_id, '🤖 <b>Ваши боты:</b>', {'inline_keyboard': buttons})
-            
-            elif data.startswith('bot_'):
-                bot_id = int(data.split('_')[1])
-                cursor.execute(
-                    'SELECT bot_username, bot_token FROM bots WHERE id = %s AND owner_id = %s',
-                    (bot_id, str(telegram_user_id))
-                )
-                bot = cursor.fetchone()
-                
-                if bot:
-                    keyboard = {
-                        'inline_keyboard': [
-                            [{'text': '⚙️ Изменить приветствие', 'callback_data': f'edit_welcome_{bot_id}'}],
-                            [{'text': '🔌 Отвязать бота', 'callback_data': f'disconnect_{bot_id}'}],
-                            [{'text': '◀️ Назад', 'callback_data': 'my_bots'}]
-                        ]
-                    }
-                    send_message(bot_token, chat_id, f'Бот @{bot["bot_username"]}', keyboard)
-            
-            elif data.startswith('edit_welcome_'):
-                bot_id = int(data.split('_')[2])
-                set_user_state(cursor, telegram_user_id, username, 'waiting_welcome_text', {'bot_id': bot_id})
-                conn.commit()
-                send_message(bot_token, chat_id, 'Отправьте новый текст приветствия:')
-            
-            elif data.startswith('disconnect_'):
-                bot_id = int(data.split('_')[1])
-                cursor.execute(
-                    'UPDATE bots SET is_active = false WHERE id = %s AND owner_id = %s',
-                    (bot_id, str(telegram_user_id))
-                )
-                conn.commit()
-                send_message(bot_token, chat_id, '✅ Бот отвязан', get_main_menu_keyboard())
-            
-            elif data == 'messages':
-                cursor.execute(
-                    '''SELECT m.id, m.chat_id, m.username, m.first_name, m.message_text, m.created_at, b.bot_token, b.bot_username
-                       FROM messages m
-                       JOIN bots b ON m.bot_id = b.id
-                       WHERE b.owner_id = %s AND b.is_active = true
-                       ORDER BY m.created_at DESC
-                       LIMIT 10''',
-                    (str(telegram_user_id),)
-                )
-                messages = cursor.fetchall()
-                
-                if not messages:
-                    send_message(bot_token, chat_id, 'Нет входящих сообщений.', get_main_menu_keyboard())
-                else:
-                    for msg in messages:
-                        username_display = f"@{msg['username']}" if msg['username'] else msg['first_name']
-                        msg_text = (
-                            f"💬 <b>Сообщение от {username_display}</b>\n"
-                            f"📍 Бот: @{msg['bot_username']}\n\n"
-                            f"{msg['message_text']}"
-                        )
-                        keyboard = {
-                            'inline_keyboard': [[
-                                {'text': '↩️ Ответить', 'callback_data': f'reply_{msg["id"]}_{msg["chat_id"]}'}
-                            ]]
-                        }
-                        send_message(bot_token, chat_id, msg_text, keyboard)
-                    
-                    send_message(bot_token, chat_id, 'Главное меню:', get_main_menu_keyboard())
-            
-            elif data.startswith('reply_'):
-                parts = data.split('_')
-                message_id = int(parts[1])
-                original_chat_id = int(parts[2])
-                
-                cursor.execute(
-                    '''SELECT b.bot_token FROM messages m
-                       JOIN bots b ON m.bot_id = b.id
-                       WHERE m.id = %s AND b.owner_id = %s''',
-                    (message_id, str(telegram_user_id))
-                )
-                result = cursor.fetchone()
-                
-                if result:
-                    set_user_state(cursor, telegram_user_id, username, 'waiting_reply', {
-                        'message_id': message_id,
-                        'chat_id': original_chat_id,
-                        'bot_token': result['bot_token']
-                    })
-                    conn.commit()
-                    send_message(bot_token, chat_id, 'Напишите ваш ответ:')
-            
-            elif data == 'main_menu':
-                set_user_state(cursor, telegram_user_id, username, 'idle', {})
-                conn.commit()
-                send_message(bot_token, chat_id, 'Главное меню:', get_main_menu_keyboard())
+            telegram_request(bot_token, 'answerCallbackQuery', {'callback_query_id': callback_query['id']}, timeout=5)
+            handle_callback(ctx, callback_query['data'])
+        
+        save_deferred(cursor)
+        conn.commit()
+        remember_update(bot_key, update_id)
         
         return {
             'statusCode': 200,
@@ -326,13 +1012,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     except Exception as e:
         conn.rollback()
+        trace_error(e)
+        if claimed:
+            release_update(conn, cursor, bot_key, update_id)
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
+            'body': json.dumps({'error': public_error(e)}),
             'isBase64Encoded': False
         }
     
     finally:
         cursor.close()
-        conn.close()
+        release_db_connection(conn)
+        log_pool_metrics('telegram-bot-constructor', context)
@@ -0,0 +1,688 @@
+'''
+Business: Диспетчер очереди исходящих сообщений Telegram (outbox) с повторами, backoff и рассылками
+Args: event с httpMethod GET/POST (вызывается по расписанию), queryStringParameters с batch_size
+      context с request_id
+Returns: HTTP response со статистикой отправки
+'''
+
+import bisect
+import json
+import math
+import os
+import select
+import threading
+import time
+import psycopg2
+import psycopg2.pool
+from psycopg2.extras import RealDictCursor, execute_values
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', '300'))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.environ.get('DB_POOL_CHECKOUT_TIMEOUT', '10'))
+DB_POOL_LOG_METRICS = os.environ.get('DB_POOL_LOG_METRICS') == '1'
+
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED') == '1'
+TRACE_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Трассировка запроса: спаны копятся в потоке и в конце обработчика пишутся одной JSON-строкой;
+# при выключенной трассировке trace_span отдаёт общий пустой контекст и ничего не замеряет
+_trace_local = threading.local()
+_trace_lock = threading.Lock()
+TRACE_HISTOGRAMS: Dict[str, Dict[str, Any]] = {}
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+class _Span:
+    __slots__ = ('name', 'tags', 'started')
+
+    def __init__(self, name: str, tags: Dict[str, Any]):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.tags['error'] = exc_type.__name__
+        trace_record(self.name, (time.perf_counter() - self.started) * 1000, self.started, **self.tags)
+        return False
+
+def trace_span(name: str, **tags):
+    if not TRACE_ENABLED:
+        return _NOOP_SPAN
+    return _Span(name, tags)
+
+def trace_start():
+    if TRACE_ENABLED:
+        _trace_local.started = time.perf_counter()
+        _trace_local.spans = []
+        _trace_local.error = None
+
+def trace_record(name: str, elapsed_ms: float, started: float = None, **tags):
+    spans = getattr(_trace_local, 'spans', None) if TRACE_ENABLED else None
+    if spans is None:
+        return
+    at = (started if started is not None else time.perf_counter() - elapsed_ms / 1000) - _trace_local.started
+    spans.append({'name': name, 'at_ms': round(at * 1000, 3), 'ms': round(elapsed_ms, 3), **tags})
+
+def trace_error(error: Exception):
+    if TRACE_ENABLED:
+        _trace_local.error = f'{type(error).__name__}: {error}'
+
+def _trace_observe(name: str, elapsed_ms: float):
+    histogram = TRACE_HISTOGRAMS.get(name)
+    if histogram is None:
+        histogram = TRACE_HISTOGRAMS[name] = {
+            'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * (len(TRACE_BUCKETS_MS) + 1)
+        }
+    histogram['count'] += 1
+    histogram['total_ms'] += elapsed_ms
+    histogram['max_ms'] = max(histogram['max_ms'], round(elapsed_ms, 3))
+    histogram['buckets'][bisect.bisect_left(TRACE_BUCKETS_MS, elapsed_ms)] += 1
+
+def flush_trace(function_name: str, context: Any):
+    spans = getattr(_trace_local, 'spans', None) if TRACE_ENABLED else None
+    if spans is None:
+        return
+    duration_ms = (time.perf_counter() - _trace_local.started) * 1000
+    with _trace_lock:
+        _trace_observe('request', duration_ms)
+        for span in spans:
+            _trace_observe(span['name'], span['ms'])
+    print(json.dumps({
+        'trace': function_name,
+        'request_id': getattr(context, 'request_id', None),
+        'duration_ms': round(duration_ms, 3),
+        'error': _trace_local.error,
+        'spans': spans
+    }, default=str))
+    _trace_local.spans = None
+
+def _statement_name(query: Any) -> str:
+    text = query[:160].decode(errors='replace') if isinstance(query, bytes) else str(query)[:160]
+    return ' '.join(text.split())[:80]
+
+_traced_cursors: Dict[type, type] = {}
+
+def _traced_cursor(base: type) -> type:
+    if base not in _traced_cursors:
+        class TracedCursor(base):
+            def execute(self, query, vars=None):
+                with trace_span('db.query', statement=_statement_name(query)):
+                    return super().execute(query, vars)
+
+        _traced_cursors[base] = TracedCursor
+    return _traced_cursors[base]
+
+class TracedConnection(psycopg2.extensions.connection):
+    # Подключается только при TRACE_ENABLED: каждый запрос, commit и rollback становится спаном
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _traced_cursor(base)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        with trace_span('db.commit'):
+            return super().commit()
+
+    def rollback(self):
+        with trace_span('db.rollback'):
+            return super().rollback()
+
+# Пул живёт на уровне модуля и переживает "тёплые" вызовы функции
+_pool_lock = threading.Condition()
+_pool_idle: List[Tuple[Any, float]] = []
+POOL_METRICS: Dict[str, Any] = {
+    'checkouts': 0,
+    'created': 0,
+    'discarded': 0,
+    'in_use': 0,
+    'idle': 0,
+    'last_wait_ms': 0.0,
+    'max_wait_ms': 0.0,
+    'total_wait_ms': 0.0
+}
+
+def _open_db_connection():
+    dsn = os.environ.get('DATABASE_URL')
+    with trace_span('db.connect'):
+        conn = psycopg2.connect(dsn, connection_factory=TracedConnection if TRACE_ENABLED else None)
+    POOL_METRICS['created'] += 1
+    return conn
+
+def _discard_db_connection(conn):
+    POOL_METRICS['discarded'] += 1
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def _is_connection_healthy(conn, idle_for: float) -> bool:
+    if conn.closed:
+        return False
+    if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        return False
+    if idle_for < DB_POOL_CHECK_AFTER:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _reap_idle_connections(now: float):
+    while len(_pool_idle) > DB_POOL_MIN_SIZE and now - _pool_idle[0][1] > DB_POOL_IDLE_TIMEOUT:
+        conn, _ = _pool_idle.pop(0)
+        _discard_db_connection(conn)
+
+def get_db_connection():
+    # Под замком только ожидание слота и выбор кандидата; connect и проверка SELECT 1
+    # идут без замка, чтобы медленная сеть не останавливала выдачу соединений другим потокам
+    started = time.monotonic()
+    with _pool_lock:
+        _reap_idle_connections(started)
+        while not _pool_idle and POOL_METRICS['in_use'] >= DB_POOL_MAX_SIZE:
+            remaining = DB_POOL_CHECKOUT_TIMEOUT - (time.monotonic() - started)
+            if remaining <= 0 or not _pool_lock.wait(timeout=remaining):
+                raise psycopg2.pool.PoolError('connection pool exhausted')
+        POOL_METRICS['in_use'] += 1
+        candidate = _pool_idle.pop() if _pool_idle else None
+        POOL_METRICS['idle'] = len(_pool_idle)
+    
+    try:
+        while candidate is not None and not _is_connection_healthy(candidate[0], time.monotonic() - candidate[1]):
+            _discard_db_connection(candidate[0])
+            with _pool_lock:
+                candidate = _pool_idle.pop() if _pool_idle else None
+                POOL_METRICS['idle'] = len(_pool_idle)
+        conn = candidate[0] if candidate is not None else _open_db_connection()
+    except Exception:
+        with _pool_lock:
+            POOL_METRICS['in_use'] -= 1
+            _pool_lock.notify()
+        raise
+    
+    wait_ms = (time.monotonic() - started) * 1000
+    with _pool_lock:
+        POOL_METRICS['checkouts'] += 1
+        POOL_METRICS['last_wait_ms'] = round(wait_ms, 3)
+        POOL_METRICS['max_wait_ms'] = max(POOL_METRICS['max_wait_ms'], round(wait_ms, 3))
+        POOL_METRICS['total_wait_ms'] += wait_ms
+    trace_record('db.checkout', wait_ms)
+    return conn
+
+def release_db_connection(conn):
+    with _pool_lock:
+        POOL_METRICS['in_use'] -= 1
+        if conn.closed or len(_pool_idle) >= DB_POOL_MAX_SIZE:
+            _discard_db_connection(conn)
+        else:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                _pool_idle.append((conn, time.monotonic()))
+            except psycopg2.Error:
+                _discard_db_connection(conn)
+        POOL_METRICS['idle'] = len(_pool_idle)
+        _pool_lock.notify()
+
+def log_pool_metrics(function_name: str, context: Any):
+    flush_trace(function_name, context)
+    if DB_POOL_LOG_METRICS:
+        print(json.dumps({
+            'function': function_name,
+            'request_id': getattr(context, 'request_id', None),
+            'db_pool': POOL_METRICS,
+            'telegram': TELEGRAM_METRICS,
+            'traces': TRACE_HISTOGRAMS if TRACE_ENABLED else None
+        }))
+
+DISPATCH_BATCH_SIZE = int(os.environ.get('DISPATCH_BATCH_SIZE', '50'))
+DISPATCH_TIME_BUDGET = float(os.environ.get('DISPATCH_TIME_BUDGET', '20'))
+DISPATCH_LEASE_SECONDS = int(os.environ.get('DISPATCH_LEASE_SECONDS', '60'))
+DISPATCH_MAX_ATTEMPTS = int(os.environ.get('DISPATCH_MAX_ATTEMPTS', '8'))
+DISPATCH_BASE_BACKOFF = int(os.environ.get('DISPATCH_BASE_BACKOFF', '5'))
+DISPATCH_MAX_BACKOFF = int(os.environ.get('DISPATCH_MAX_BACKOFF', '3600'))
+DISPATCH_MAX_WAIT = float(os.environ.get('DISPATCH_MAX_WAIT', '2'))
+DISPATCH_IDLE_LISTEN = os.environ.get('DISPATCH_IDLE_LISTEN', '1') == '1'
+DISPATCH_MIN_IDLE_WAIT = 0.05
+
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '25'))
+BROADCAST_WINDOW = int(os.environ.get('BROADCAST_WINDOW', '200'))
+
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', 'https://functions.poehali.dev/af40ed3c-a51d-4f3f-ae16-ef69f32d3a02')
+WEBHOOK_REGISTER_BATCH = int(os.environ.get('WEBHOOK_REGISTER_BATCH', '500'))
+WEBHOOK_REGISTER_RETRY = int(os.environ.get('WEBHOOK_REGISTER_RETRY', '3600'))
+
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org')
+TELEGRAM_TIMEOUT = float(os.environ.get('TELEGRAM_TIMEOUT', '10'))
+TELEGRAM_CONNECT_RETRIES = int(os.environ.get('TELEGRAM_CONNECT_RETRIES', '2'))
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', '10'))
+
+# Keep-alive сессия живёт между "тёплыми" вызовами; повторяем только ошибки соединения,
+# чтобы не отправить сообщение дважды
+_telegram_session = requests.Session()
+_telegram_session.mount(TELEGRAM_API_BASE, HTTPAdapter(
+    pool_connections=TELEGRAM_POOL_SIZE,
+    pool_maxsize=TELEGRAM_POOL_SIZE,
+    max_retries=Retry(total=TELEGRAM_CONNECT_RETRIES, connect=TELEGRAM_CONNECT_RETRIES, read=0, status=0, other=0)
+))
+TELEGRAM_METRICS: Dict[str, Any] = {'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'methods': {}}
+
+def telegram_call(bot_token: str, method: str, payload: Dict[str, Any] = None, timeout: float = None) -> requests.Response:
+    started = time.monotonic()
+    try:
+        with trace_span('telegram.call', method=method):
+            return _telegram_session.post(
+                f'{TELEGRAM_API_BASE}/bot{bot_token}/{method}',
+                json=payload or {},
+                timeout=timeout or TELEGRAM_TIMEOUT
+            )
+    except requests.RequestException:
+        TELEGRAM_METRICS['errors'] += 1
+        raise
+    finally:
+        elapsed_ms = (time.monotonic() - started) * 1000
+        TELEGRAM_METRICS['calls'] += 1
+        TELEGRAM_METRICS['total_ms'] += elapsed_ms
+        TELEGRAM_METRICS['max_ms'] = max(TELEGRAM_METRICS['max_ms'], round(elapsed_ms, 3))
+        per_method = TELEGRAM_METRICS['methods'].setdefault(method, {'calls': 0, 'total_ms': 0.0})
+        per_method['calls'] += 1
+        per_method['total_ms'] += elapsed_ms
+
+TELEGRAM_RATE_PER_TOKEN = float(os.environ.get('TELEGRAM_RATE_PER_TOKEN', '30'))
+TELEGRAM_RATE_PER_CHAT = float(os.environ.get('TELEGRAM_RATE_PER_CHAT', '1'))
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', '3'))
+
+TELEGRAM_BUCKETS_SIZE = int(os.environ.get('TELEGRAM_BUCKETS_SIZE', '10000'))
+
+# Token bucket: ключ -> (доступные токены, время последнего пополнения). Давно не тронутые
+# вёдра успели наполниться и ничем не отличаются от новых, поэтому вытесняются первыми
+_buckets: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()
+# Бот-токен -> момент, до которого Telegram просил не слать (retry_after из 429)
+_blocked_until: Dict[str, float] = {}
+
+def bucket_wait(key: str, rate: float, capacity: float, now: float) -> float:
+    tokens, updated_at = _buckets.get(key, (capacity, now))
+    tokens = min(capacity, tokens + (now - updated_at) * rate)
+    _buckets[key] = (tokens, now)
+    _buckets.move_to_end(key)
+    while len(_buckets) > TELEGRAM_BUCKETS_SIZE:
+        _buckets.popitem(last=False)
+    return 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+def bucket_take(key: str):
+    tokens, updated_at = _buckets[key]
+    _buckets[key] = (tokens - 1, updated_at)
+
+def bucket_keys(item: Dict[str, Any]) -> List[Tuple[str, float, float]]:
+    keys = [(f'token:{item["bot_token"]}', TELEGRAM_RATE_PER_TOKEN, TELEGRAM_RATE_PER_TOKEN)]
+    chat_id = item['payload'].get('chat_id')
+    if chat_id is not None:
+        keys.append((f'chat:{item["bot_token"]}:{chat_id}', TELEGRAM_RATE_PER_CHAT, TELEGRAM_CHAT_BURST))
+    return keys
+
+def send_wait(item: Dict[str, Any], now: float) -> float:
+    waits = [bucket_wait(key, rate, capacity, now) for key, rate, capacity in bucket_keys(item)]
+    blocked_until = _blocked_until.get(item['bot_token'])
+    if blocked_until is not None:
+        if blocked_until <= now:
+            del _blocked_until[item['bot_token']]
+        waits.append(blocked_until - now)
+    return max(waits)
+
+def claim_batch(cursor, batch_size: int) -> List[Dict[str, Any]]:
+    # Аренда: next_attempt_at сдвигается вперёд, чтобы упавший диспетчер не потерял записи
+    cursor.execute(
+        '''UPDATE outbox SET attempts = attempts + 1,
+                             next_attempt_at = CURRENT_TIMESTAMP + %s * INTERVAL '1 second'
+           WHERE id IN (
+               SELECT id FROM outbox
+               WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+               ORDER BY next_attempt_at
+               LIMIT %s
+               FOR UPDATE SKIP LOCKED
+           )
+           RETURNING id, bot_token, method, payload, attempts''',
+        (DISPATCH_LEASE_SECONDS, batch_size)
+    )
+    return cursor.fetchall()
+
+def backoff_seconds(attempts: int) -> int:
+    return min(DISPATCH_MAX_BACKOFF, DISPATCH_BASE_BACKOFF * 2 ** (attempts - 1))
+
+def deliver(item: Dict[str, Any]) -> Tuple[str, int, str]:
+    try:
+        response = telegram_call(item['bot_token'], item['method'], item['payload'])
+    except requests.RequestException as e:
+        # Текст исключения содержит URL с токеном, в last_error пишем только тип
+        return 'retry', backoff_seconds(item['attempts']), type(e).__name__
+    
+    if response.status_code == 200:
+        return 'sent', 0, ''
+    
+    try:
+        description = response.json()
+    except ValueError:
+        description = {}
+    error = description.get('description', f'HTTP {response.status_code}')
+    
+    if response.status_code == 429:
+        retry_after = int(description.get('parameters', {}).get('retry_after', 1))
+        _blocked_until[item['bot_token']] = time.monotonic() + retry_after
+        return 'deferred', retry_after, error
+    if response.status_code >= 500:
+        return 'retry', backoff_seconds(item['attempts']), error
+    # Чат заблокировал бота, удалён или не существует: получатель выбывает из рассылок
+    if item['payload'].get('chat_id') is not None and (
+        response.status_code == 403 or 'chat not found' in error.lower()
+    ):
+        return 'blocked', 0, error
+    return 'failed', 0, error
+
+def dispatch_batch(batch: List[Dict[str, Any]], deadline: float, lease_deadline: float) -> List[Tuple[int, str, int, str]]:
+    # Сообщения в чаты, упёршиеся в лимит, пропускают вперёд остальные; если ждать слишком долго,
+    # запись возвращается в очередь без списания попытки. Отправка начинается, только если
+    # вызов успеет завершиться до конца бюджета и аренды: иначе истёкшую аренду подхватит
+    # другой диспетчер и сообщение уйдёт дважды
+    pending = list(batch)
+    results = []
+    while pending:
+        now = time.monotonic()
+        if now >= deadline or now + TELEGRAM_TIMEOUT >= lease_deadline:
+            results.extend((item['id'], 'deferred', 0, '') for item in pending)
+            break
+        waits = [send_wait(item, now) for item in pending]
+        ready = next((i for i, wait in enumerate(waits) if wait <= 0), None)
+        
+        if ready is None:
+            shortest = min(waits)
+            if shortest > DISPATCH_MAX_WAIT or now + shortest > deadline:
+                for item, wait in zip(pending, waits):
+                    results.append((item['id'], 'deferred', math.ceil(wait), ''))
+                break
+            time.sleep(shortest)
+            continue
+        
+        item = pending.pop(ready)
+        for key, _, _ in bucket_keys(item):
+            bucket_take(key)
+        outcome, delay, error = deliver(item)
+        results.append((item['id'], outcome, delay, error))
+    return results
+
+def save_results(cursor, results: List[Tuple[int, str, int, str]]):
+    rows = []
+    for outbox_id, outcome, delay, error in results:
+        if outcome in ('retry', 'deferred') and delay == 0:
+            delay = 1
+        rows.append((outbox_id, outcome, delay, error or None))
+    
+    # Тем же оператором помечаем заблокировавшие бота чаты, принятые Telegram вебхуки
+    # и двигаем счётчики рассылок
+    execute_values(
+        cursor,
+        '''WITH updated AS (
+               UPDATE outbox AS o
+               SET status = CASE
+                       WHEN v.outcome = 'sent' THEN 'sent'
+                       WHEN v.outcome IN ('failed', 'blocked') OR (v.outcome = 'retry' AND o.attempts >= %s) THEN 'failed'
+                       ELSE 'pending'
+                   END,
+                   attempts = CASE WHEN v.outcome = 'deferred' THEN o.attempts - 1 ELSE o.attempts END,
+                   sent_at = CASE WHEN v.outcome = 'sent' THEN CURRENT_TIMESTAMP ELSE o.sent_at END,
+                   next_attempt_at = CURRENT_TIMESTAMP + v.delay * INTERVAL '1 second',
+                   last_error = v.error
+               FROM (VALUES %%s) AS v (id, outcome, delay, error)
+               WHERE o.id = v.id
+               RETURNING o.bot_token, o.method, o.payload, o.broadcast_id, o.status, v.outcome
+           ), registered AS (
+               UPDATE bots b SET webhook_registered_at = CURRENT_TIMESTAMP
+               FROM updated u
+               WHERE u.method = 'setWebhook' AND u.status = 'sent'
+                 AND b.bot_token = u.bot_token AND b.webhook_registered_at IS NULL
+           ), pruned AS (
+               UPDATE bot_subscribers s SET blocked_at = CURRENT_TIMESTAMP
+               FROM updated u
+               JOIN bots b ON b.bot_token = u.bot_token
+               WHERE u.outcome = 'blocked' AND s.bot_id = b.id AND s.chat_id::text = u.payload->>'chat_id'
+           )
+           UPDATE broadcasts bc
+           SET sent_count = bc.sent_count + p.sent,
+               failed_count = bc.failed_count + p.failed,
+               blocked_count = bc.blocked_count + p.blocked,
+               updated_at = CURRENT_TIMESTAMP
+           FROM (
+               SELECT broadcast_id,
+                      COUNT(*) FILTER (WHERE status = 'sent') AS sent,
+                      COUNT(*) FILTER (WHERE status = 'failed' AND outcome <> 'blocked') AS failed,
+                      COUNT(*) FILTER (WHERE outcome = 'blocked') AS blocked
+               FROM updated
+               WHERE broadcast_id IS NOT NULL
+               GROUP BY broadcast_id
+           ) p
+           WHERE bc.id = p.broadcast_id''' % DISPATCH_MAX_ATTEMPTS,
+        rows,
+        template='(%s, %s, %s::integer, %s)'
+    )
+
+def expand_broadcasts(cursor) -> int:
+    # Рассылка попадает в outbox окнами: у каждой не больше BROADCAST_WINDOW неотправленных записей,
+    # чтобы ответы на входящие не стояли за тысячами писем, а сами письма разнесены по next_attempt_at
+    # с темпом BROADCAST_RATE. last_chat_id сохраняется в одной транзакции со вставкой,
+    # поэтому прерванный по таймауту запуск продолжит рассылку с того же получателя
+    cursor.execute(
+        '''SELECT bc.id, bc.bot_id, bc.message_text, bc.last_chat_id, b.bot_token,
+                  bc.queued_count - bc.sent_count - bc.failed_count - bc.blocked_count AS in_flight
+           FROM broadcasts bc
+           JOIN bots b ON b.id = bc.bot_id
+           WHERE bc.status = 'running' AND b.is_active = true
+             AND bc.queued_count - bc.sent_count - bc.failed_count - bc.blocked_count <= %s
+           ORDER BY bc.id
+           FOR UPDATE OF bc SKIP LOCKED''',
+        (BROADCAST_WINDOW // 2,)
+    )
+    queued = 0
+    for job in cursor.fetchall():
+        limit = BROADCAST_WINDOW - job['in_flight']
+        cursor.execute(
+            '''WITH batch AS (
+                   SELECT chat_id, ROW_NUMBER() OVER (ORDER BY chat_id) AS n
+                   FROM bot_subscribers
+                   WHERE bot_id = %(bot_id)s AND blocked_at IS NULL
+                     AND chat_id > COALESCE(%(after)s, -9223372036854775808)
+                   ORDER BY chat_id
+                   LIMIT %(limit)s
+               ), queued AS (
+                   INSERT INTO outbox (bot_token, method, payload, broadcast_id, next_attempt_at)
+                   SELECT %(bot_token)s, 'sendMessage', jsonb_build_object('chat_id', chat_id, 'text', %(text)s), %(id)s,
+                          CURRENT_TIMESTAMP + ((%(in_flight)s + n - 1) / %(rate)s)::float8 * INTERVAL '1 second'
+                   FROM batch
+                   RETURNING 1
+               ), counts AS (
+                   SELECT (SELECT COUNT(*) FROM queued) AS queued, (SELECT MAX(chat_id) FROM batch) AS last_chat_id
+               )
+               UPDATE broadcasts bc
+               SET queued_count = bc.queued_count + c.queued,
+                   last_chat_id = COALESCE(c.last_chat_id, bc.last_chat_id),
+                   status = CASE WHEN c.queued < %(limit)s THEN 'queued' ELSE bc.status END,
+                   updated_at = CURRENT_TIMESTAMP
+               FROM counts c
+               WHERE bc.id = %(id)s
+               RETURNING c.queued''',
+            {
+                'id': job['id'], 'bot_id': job['bot_id'], 'bot_token': job['bot_token'], 'text': job['message_text'],
+                'after': job['last_chat_id'], 'limit': limit, 'in_flight': job['in_flight'], 'rate': BROADCAST_RATE
+            }
+        )
+        queued += cursor.fetchone()['queued']
+    return queued
+
+def register_webhooks(cursor) -> int:
+    # Боты, подключённые до V0017, получают вебхук с ?bot=<id> и секретом через outbox;
+    # адрес берётся из WEBHOOK_URL. webhook_requested_at не даёт поставить вызов дважды,
+    # а исчерпавший попытки setWebhook повторится через WEBHOOK_REGISTER_RETRY секунд.
+    # webhook_registered_at заполняет save_results, когда Telegram принял вызов
+    cursor.execute(
+        '''WITH picked AS (
+               UPDATE bots SET webhook_requested_at = CURRENT_TIMESTAMP
+               WHERE id IN (
+                   SELECT id FROM bots
+                   WHERE webhook_registered_at IS NULL AND is_active = true AND delivery_mode = 'webhook'
+                     AND (webhook_requested_at IS NULL
+                          OR webhook_requested_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second')
+                   ORDER BY id
+                   LIMIT %s
+                   FOR UPDATE SKIP LOCKED
+               )
+               RETURNING id, bot_token, webhook_secret
+           )
+           INSERT INTO outbox (bot_token, method, payload)
+           SELECT bot_token, 'setWebhook', jsonb_build_object('url', %s || '?bot=' || id, 'secret_token', webhook_secret)
+           FROM picked
+           RETURNING 1''',
+        (WEBHOOK_REGISTER_RETRY, WEBHOOK_REGISTER_BATCH, WEBHOOK_URL)
+    )
+    return len(cursor.fetchall())
+
+def finish_broadcasts(cursor):
+    cursor.execute(
+        '''UPDATE broadcasts
+           SET status = 'done', finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+           WHERE status = 'queued' AND queued_count = sent_count + failed_count + blocked_count'''
+    )
+
+def seconds_until_due(cursor) -> Optional[float]:
+    cursor.execute(
+        '''SELECT EXTRACT(EPOCH FROM MIN(next_attempt_at) - CURRENT_TIMESTAMP) AS due
+           FROM outbox WHERE status = 'pending' '''
+    )
+    due = cursor.fetchone()['due']
+    return float(due) if due is not None else None
+
+def wait_for_outbox(conn, timeout: float) -> bool:
+    # Пустая очередь не завершает запуск: до конца бюджета ждём NOTIFY outbox_pending,
+    # чтобы новые записи уходили сразу, а не со следующим запуском по расписанию
+    conn.poll()
+    if not conn.notifies and timeout > 0:
+        if select.select([conn], [], [], timeout) != ([], [], []):
+            conn.poll()
+    woken = bool(conn.notifies)
+    conn.notifies.clear()
+    return woken
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'POST')
+    trace_start()
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    query_params = event.get('queryStringParameters', {}) or {}
+    batch_size = int(query_params.get('batch_size', DISPATCH_BATCH_SIZE))
+    
+    started = time.monotonic()
+    stats = {'sent': 0, 'retry': 0, 'deferred': 0, 'failed': 0, 'blocked': 0, 'batches': 0, 'broadcast_queued': 0,
+             'webhooks_queued': 0}
+    
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    listening = False
+    
+    try:
+        stats['webhooks_queued'] = register_webhooks(cursor)
+        conn.commit()
+        while time.monotonic() - started < DISPATCH_TIME_BUDGET:
+            conn.poll()
+            conn.notifies.clear()
+            stats['broadcast_queued'] += expand_broadcasts(cursor)
+            finish_broadcasts(cursor)
+            lease_deadline = time.monotonic() + DISPATCH_LEASE_SECONDS
+            batch = claim_batch(cursor, batch_size)
+            conn.commit()
+            if not batch:
+                if not listening:
+                    # Подписка нужна только на время ожидания и действует после коммита; очередь
+                    # перечитываем уже с ней, чтобы не пропустить запись, вставленную до LISTEN
+                    cursor.execute('LISTEN outbox_pending')
+                    conn.commit()
+                    listening = True
+                    continue
+                remaining = DISPATCH_TIME_BUDGET - (time.monotonic() - started)
+                # Отложенные записи (темп рассылки, лимиты) дожидаемся в пределах бюджета
+                due = seconds_until_due(cursor)
+                conn.commit()
+                if due is not None and due < remaining:
+                    wait_for_outbox(conn, max(due, DISPATCH_MIN_IDLE_WAIT))
+                    continue
+                if DISPATCH_IDLE_LISTEN and wait_for_outbox(conn, remaining):
+                    continue
+                break
+            
+            results = dispatch_batch(batch, started + DISPATCH_TIME_BUDGET, lease_deadline)
+            for _, outcome, _, _ in results:
+                stats[outcome] += 1
+            
+            save_results(cursor, results)
+            finish_broadcasts(cursor)
+            conn.commit()
+            stats['batches'] += 1
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps(stats),
+            'isBase64Encoded': False
+        }
+    
+    except Exception as e:
+        conn.rollback()
+        trace_error(e)
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
+    
+    finally:
+        if listening and not conn.closed:
+            # Соединение вернётся в пул - подписка не должна пережить запуск
+            try:
+                conn.rollback()
+                cursor.execute('UNLISTEN outbox_pending')
+                conn.commit()
+                conn.notifies.clear()
+            except psycopg2.Error:
+                pass
+        cursor.close()
+        release_db_connection(conn)
+        log_pool_metrics('telegram-dispatcher', context)
@@ -1,23 +1,509 @@
 '''
 Business: Webhook для приема сообщений от Telegram ботов
-Args: event с httpMethod POST, body с Telegram update, queryStringParameters с bot_token
+Args: event с httpMethod POST, body с Telegram update, queryStringParameters с bot (id бота),
+      заголовок X-Telegram-Bot-Api-Secret-Token с секретом вебхука
       context с request_id
 Returns: HTTP response 200 OK для подтверждения получения
 '''
 
+import bisect
+import hashlib
+import hmac
 import json
 import os
+import threading
+import time
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from typing import Dict, Any
-import requests
+import psycopg2.pool
+from psycopg2.extras import RealDictCursor, Json, execute_values
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Set, Tuple
 
-def get_db_connection():
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', '300'))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.environ.get('DB_POOL_CHECKOUT_TIMEOUT', '10'))
+DB_POOL_LOG_METRICS = os.environ.get('DB_POOL_LOG_METRICS') == '1'
+
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED') == '1'
+TRACE_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Трассировка запроса: спаны копятся в потоке и в конце обработчика пишутся одной JSON-строкой;
+# при выключенной трассировке trace_span отдаёт общий пустой контекст и ничего не замеряет
+_trace_local = threading.local()
+_trace_lock = threading.Lock()
+TRACE_HISTOGRAMS: Dict[str, Dict[str, Any]] = {}
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+class _Span:
+    __slots__ = ('name', 'tags', 'started')
+
+    def __init__(self, name: str, tags: Dict[str, Any]):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.tags['error'] = exc_type.__name__
+        trace_record(self.name, (time.perf_counter() - self.started) * 1000, self.started, **self.tags)
+        return False
+
+def trace_span(name: str, **tags):
+    if not TRACE_ENABLED:
+        return _NOOP_SPAN
+    return _Span(name, tags)
+
+def trace_start():
+    if TRACE_ENABLED:
+        _trace_local.started = time.perf_counter()
+        _trace_local.spans = []
+        _trace_local.error = None
+
+def trace_record(name: str, elapsed_ms: float, started: float = None, **tags):
+    spans = getattr(_trace_local, 'spans', None) if TRACE_ENABLED else None
+    if spans is None:
+        return
+    at = (started if started is not None else time.perf_counter() - elapsed_ms / 1000) - _trace_local.started
+    spans.append({'name': name, 'at_ms': round(at * 1000, 3), 'ms': round(elapsed_ms, 3), **tags})
+
+def trace_error(error: Exception):
+    if TRACE_ENABLED:
+        _trace_local.error = f'{type(error).__name__}: {error}'
+
+def _trace_observe(name: str, elapsed_ms: float):
+    histogram = TRACE_HISTOGRAMS.get(name)
+    if histogram is None:
+        histogram = TRACE_HISTOGRAMS[name] = {
+            'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * (len(TRACE_BUCKETS_MS) + 1)
+        }
+    histogram['count'] += 1
+    histogram['total_ms'] += elapsed_ms
+    histogram['max_ms'] = max(histogram['max_ms'], round(elapsed_ms, 3))
+    histogram['buckets'][bisect.bisect_left(TRACE_BUCKETS_MS, elapsed_ms)] += 1
+
+def flush_trace(function_name: str, context: Any):
+    spans = getattr(_trace_local, 'spans', None) if TRACE_ENABLED else None
+    if spans is None:
+        return
+    duration_ms = (time.perf_counter() - _trace_local.started) * 1000
+    with _trace_lock:
+        _trace_observe('request', duration_ms)
+        for span in spans:
+            _trace_observe(span['name'], span['ms'])
+    print(json.dumps({
+        'trace': function_name,
+        'request_id': getattr(context, 'request_id', None),
+        'duration_ms': round(duration_ms, 3),
+        'error': _trace_local.error,
+        'spans': spans
+    }, default=str))
+    _trace_local.spans = None
+
+def _statement_name(query: Any) -> str:
+    text = query[:160].decode(errors='replace') if isinstance(query, bytes) else str(query)[:160]
+    return ' '.join(text.split())[:80]
+
+_traced_cursors: Dict[type, type] = {}
+
+def _traced_cursor(base: type) -> type:
+    if base not in _traced_cursors:
+        class TracedCursor(base):
+            def execute(self, query, vars=None):
+                with trace_span('db.query', statement=_statement_name(query)):
+                    return super().execute(query, vars)
+
+        _traced_cursors[base] = TracedCursor
+    return _traced_cursors[base]
+
+class TracedConnection(psycopg2.extensions.connection):
+    # Подключается только при TRACE_ENABLED: каждый запрос, commit и rollback становится спаном
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _traced_cursor(base)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        with trace_span('db.commit'):
+            return super().commit()
+
+    def rollback(self):
+        with trace_span('db.rollback'):
+            return super().rollback()
+
+# Пул живёт на уровне модуля и переживает "тёплые" вызовы функции
+_pool_lock = threading.Condition()
+_pool_idle: List[Tuple[Any, float]] = []
+POOL_METRICS: Dict[str, Any] = {
+    'checkouts': 0,
+    'created': 0,
+    'discarded': 0,
+    'in_use': 0,
+    'idle': 0,
+    'last_wait_ms': 0.0,
+    'max_wait_ms': 0.0,
+    'total_wait_ms': 0.0
+}
+
+def _open_db_connection():
     dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn)
+    with trace_span('db.connect'):
+        conn = psycopg2.connect(dsn, connection_factory=TracedConnection if TRACE_ENABLED else None)
+    with conn.cursor() as cursor:
+        cursor.execute('LISTEN bots_changed')
+    conn.commit()
+    POOL_METRICS['created'] += 1
+    # Новое соединение не видело уведомлений, пришедших до LISTEN
+    _bot_cache.clear()
+    return conn
+
+def _discard_db_connection(conn):
+    POOL_METRICS['discarded'] += 1
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def _is_connection_healthy(conn, idle_for: float) -> bool:
+    if conn.closed:
+        return False
+    if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        return False
+    if idle_for < DB_POOL_CHECK_AFTER:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _reap_idle_connections(now: float):
+    while len(_pool_idle) > DB_POOL_MIN_SIZE and now - _pool_idle[0][1] > DB_POOL_IDLE_TIMEOUT:
+        conn, _ = _pool_idle.pop(0)
+        _discard_db_connection(conn)
+
+def get_db_connection():
+    # Под замком только ожидание слота и выбор кандидата; connect и проверка SELECT 1
+    # идут без замка, чтобы медленная сеть не останавливала выдачу соединений другим потокам
+    started = time.monotonic()
+    with _pool_lock:
+        _reap_idle_connections(started)
+        while not _pool_idle and POOL_METRICS['in_use'] >= DB_POOL_MAX_SIZE:
+            remaining = DB_POOL_CHECKOUT_TIMEOUT - (time.monotonic() - started)
+            if remaining <= 0 or not _pool_lock.wait(timeout=remaining):
+                raise psycopg2.pool.PoolError('connection pool exhausted')
+        POOL_METRICS['in_use'] += 1
+        candidate = _pool_idle.pop() if _pool_idle else None
+        POOL_METRICS['idle'] = len(_pool_idle)
+    
+    try:
+        while candidate is not None and not _is_connection_healthy(candidate[0], time.monotonic() - candidate[1]):
+            _discard_db_connection(candidate[0])
+            with _pool_lock:
+                candidate = _pool_idle.pop() if _pool_idle else None
+                POOL_METRICS['idle'] = len(_pool_idle)
+        conn = candidate[0] if candidate is not None else _open_db_connection()
+    except Exception:
+        with _pool_lock:
+            POOL_METRICS['in_use'] -= 1
+            _pool_lock.notify()
+        raise
+    
+    wait_ms = (time.monotonic() - started) * 1000
+    with _pool_lock:
+        POOL_METRICS['checkouts'] += 1
+        POOL_METRICS['last_wait_ms'] = round(wait_ms, 3)
+        POOL_METRICS['max_wait_ms'] = max(POOL_METRICS['max_wait_ms'], round(wait_ms, 3))
+        POOL_METRICS['total_wait_ms'] += wait_ms
+    trace_record('db.checkout', wait_ms)
+    return conn
+
+def release_db_connection(conn):
+    with _pool_lock:
+        POOL_METRICS['in_use'] -= 1
+        if conn.closed or len(_pool_idle) >= DB_POOL_MAX_SIZE:
+            _discard_db_connection(conn)
+        else:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                _pool_idle.append((conn, time.monotonic()))
+            except psycopg2.Error:
+                _discard_db_connection(conn)
+        POOL_METRICS['idle'] = len(_pool_idle)
+        _pool_lock.notify()
+
+BOT_CACHE_TTL = float(os.environ.get('BOT_CACHE_TTL', '60'))
+BOT_CACHE_SIZE = int(os.environ.get('BOT_CACHE_SIZE', '1024'))
+
+# LRU активных ботов: id бота -> (запись бота или None, момент истечения)
+_bot_cache: 'OrderedDict[int, Tuple[Optional[Dict[str, Any]], float]]' = OrderedDict()
+BOT_CACHE_METRICS: Dict[str, int] = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+
+def token_key(bot_token: str) -> str:
+    return hashlib.md5(bot_token.encode()).hexdigest()
+
+def drain_bot_notifications(conn):
+    conn.poll()
+    while conn.notifies:
+        notify = conn.notifies.pop(0)
+        if notify.payload.isdigit() and _bot_cache.pop(int(notify.payload), None) is not None:
+            BOT_CACHE_METRICS['invalidations'] += 1
+
+def peek_cached_bot(bot_id: int) -> Optional[Dict[str, Any]]:
+    # Без обращения к базе: нужен для отсечения повторов до взятия соединения
+    cached = _bot_cache.get(bot_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+def get_active_bot(cursor, bot_id: int) -> Optional[Dict[str, Any]]:
+    now = time.monotonic()
+    cached = _bot_cache.get(bot_id)
+    if cached and cached[1] > now:
+        _bot_cache.move_to_end(bot_id)
+        BOT_CACHE_METRICS['hits'] += 1
+        return cached[0]
+    
+    BOT_CACHE_METRICS['misses'] += 1
+    cursor.execute(
+        'SELECT id, bot_token, welcome_text, webhook_secret FROM bots WHERE id = %s AND is_active = true',
+        (bot_id,)
+    )
+    row = cursor.fetchone()
+    bot = dict(row) if row else None
+    if bot:
+        bot['bot_key'] = token_key(bot['bot_token'])
+    
+    _bot_cache[bot_id] = (bot, now + BOT_CACHE_TTL)
+    _bot_cache.move_to_end(bot_id)
+    while len(_bot_cache) > BOT_CACHE_SIZE:
+        _bot_cache.popitem(last=False)
+        BOT_CACHE_METRICS['evictions'] += 1
+    return bot
+
+# Старые адреса ?bot_token= принимаются, пока диспетчер не перерегистрирует вебхуки (V0017);
+# когда у активных ботов с delivery_mode = 'webhook' не останется пустого webhook_registered_at
+# (его ставит диспетчер после ответа Telegram), маршрут выключается WEBHOOK_LEGACY_TOKEN_ROUTE=0
+WEBHOOK_LEGACY_TOKEN_ROUTE = os.environ.get('WEBHOOK_LEGACY_TOKEN_ROUTE', '1') == '1'
+
+def resolve_legacy_route(cursor, bot_token: str) -> Optional[int]:
+    cursor.execute('SELECT id FROM bots WHERE bot_token = %s', (bot_token,))
+    row = cursor.fetchone()
+    return row['id'] if row else None
+
+def is_authorized(bot: Dict[str, Any], secret: str, legacy: bool) -> bool:
+    # В старом адресе секретом служит сам токен; в новом сравниваем заголовок за постоянное время
+    if legacy:
+        return True
+    return hmac.compare_digest(bot['webhook_secret'].encode(), secret.encode())
+
+def get_header(headers: Dict[str, str], name: str) -> str:
+    for key, value in (headers or {}).items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+ACK_TEXT = '✅ Спасибо! Ваше сообщение передано владельцу.'
+
+# Новые сообщения сразу пересылаются владельцу в чат бота-конструктора (если он им пользуется)
+CONSTRUCTOR_BOT_TOKEN = os.environ.get('CONSTRUCTOR_BOT_TOKEN')
+OWNER_FORWARD_TEXT_LIMIT = int(os.environ.get('OWNER_FORWARD_TEXT_LIMIT', '1000'))
+
+INGEST_BATCH_WINDOW_MS = float(os.environ.get('INGEST_BATCH_WINDOW_MS', '0'))
+INGEST_BATCH_MAX_ROWS = int(os.environ.get('INGEST_BATCH_MAX_ROWS', '500'))
+
+# Групповая запись: первый поток становится лидером, ждёт до INGEST_BATCH_WINDOW_MS
+# или INGEST_BATCH_MAX_ROWS строк и записывает всех ожидающих одной вставкой и одним коммитом
+_ingest_lock = threading.Condition()
+_ingest_buffer: List[Dict[str, Any]] = []
+_ingest_state: Dict[str, Any] = {'leader': False, 'pending_rows': 0}
+
+def flush_messages(conn, rows: List[Tuple]) -> Set[Tuple[str, int]]:
+    # Строка пишется, только если её update_id удалось занять в processed_updates
+    with conn.cursor() as cursor:
+        forwarded = ''
+        if CONSTRUCTOR_BOT_TOKEN:
+            constructor_token = cursor.mogrify('%s', (CONSTRUCTOR_BOT_TOKEN,)).decode().replace('%', '%%')
+            forwarded = f'''
+               forwarded AS (
+                   INSERT INTO outbox (bot_token, method, payload)
+                   SELECT {constructor_token}, 'sendMessage', jsonb_build_object(
+                       'chat_id', u.telegram_user_id,
+                       'text', '📨 ' || COALESCE('@' || NULLIF(i.username, ''), i.first_name, '')
+                               || ' → @' || COALESCE(b.bot_username, '') || E'\\n\\n'
+                               || LEFT(i.message_text, {OWNER_FORWARD_TEXT_LIMIT}),
+                       'reply_markup', jsonb_build_object('inline_keyboard', jsonb_build_array(jsonb_build_array(
+                           jsonb_build_object('text', '↩️ Ответить', 'callback_data', 'reply_' || i.id)
+                       )))
+                   )
+                   FROM inserted i
+                   JOIN bots b ON b.id = i.bot_id
+                   JOIN bot_constructor_users u
+                     ON u.telegram_user_id = CASE WHEN b.owner_id ~ '^[0-9]+$' THEN b.owner_id::bigint END
+               ),'''
+        claimed = execute_values(
+            cursor,
+            f'''WITH batch (bot_id, chat_id, username, first_name, last_name, message_text, telegram_message_id, bot_token, ack, bot_key, update_id) AS (
+                   VALUES %s
+               ),
+               claimed AS (
+                   INSERT INTO processed_updates (bot_key, update_id)
+                   SELECT bot_key, update_id FROM batch WHERE update_id IS NOT NULL
+                   ON CONFLICT DO NOTHING
+                   RETURNING bot_key, update_id
+               ),
+               accepted AS (
+                   SELECT * FROM batch b
+                   WHERE b.update_id IS NULL
+                      OR EXISTS (SELECT 1 FROM claimed c WHERE c.bot_key = b.bot_key AND c.update_id = b.update_id)
+               ),
+               inserted AS (
+                   INSERT INTO messages (bot_id, chat_id, username, first_name, last_name, message_text, telegram_message_id)
+                   SELECT bot_id, chat_id, username, first_name, last_name, message_text, telegram_message_id FROM accepted
+                   RETURNING id, bot_id, username, first_name, message_text
+               ),{forwarded}
+               acknowledged AS (
+                   INSERT INTO outbox (bot_token, method, payload)
+                   SELECT bot_token, 'sendMessage', ack FROM accepted
+               )
+               SELECT bot_key, update_id FROM claimed''',
+            rows,
+            template='(%s::integer, %s::bigint, %s, %s, %s, %s, %s::bigint, %s, %s::jsonb, %s, %s::bigint)',
+            page_size=len(rows),
+            fetch=True
+        )
+    conn.commit()
+    return {(bot_key, update_id) for bot_key, update_id in claimed}
+
+def ingest_messages(conn, rows: List[Tuple]) -> int:
+    entry = {'rows': rows, 'done': False, 'error': None, 'duplicates': 0}
+    with _ingest_lock:
+        _ingest_buffer.append(entry)
+        _ingest_state['pending_rows'] += len(rows)
+        _ingest_lock.notify_all()
+        while not entry['done'] and _ingest_state['leader']:
+            _ingest_lock.wait()
+        if entry['done']:
+            if entry['error']:
+                raise entry['error']
+            return entry['duplicates']
+        _ingest_state['leader'] = True
+        
+        deadline = time.monotonic() + INGEST_BATCH_WINDOW_MS / 1000
+        while _ingest_state['pending_rows'] < INGEST_BATCH_MAX_ROWS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            _ingest_lock.wait(timeout=remaining)
+        
+        batch = list(_ingest_buffer)
+        _ingest_buffer.clear()
+        _ingest_state['pending_rows'] = 0
+    
+    error = None
+    try:
+        # Повтор одного update_id внутри пачки отбрасывается до записи
+        seen = set()
+        flush_rows = []
+        for item in batch:
+            item['keys'] = []
+            for row in item['rows']:
+                key = (row[-2], row[-1])
+                if key[1] is not None and key in seen:
+                    item['duplicates'] += 1
+                    continue
+                seen.add(key)
+                flush_rows.append(row)
+                item['keys'].append(key)
+        
+        claimed = flush_messages(conn, flush_rows) if flush_rows else set()
+        for item in batch:
+            item['duplicates'] += sum(1 for key in item['keys'] if key[1] is not None and key not in claimed)
+    except Exception as e:
+        conn.rollback()
+        error = e
+    
+    with _ingest_lock:
+        for item in batch:
+            item['done'] = True
+            item['error'] = error
+        _ingest_state['leader'] = False
+        _ingest_lock.notify_all()
+    if error:
+        raise error
+    return entry['duplicates']
+
+def enqueue_welcome(cursor, bot_key: str, update_id: Optional[int], bot_token: str, chat_id: int, text: str) -> bool:
+    if update_id is None:
+        cursor.execute(
+            '''INSERT INTO outbox (bot_token, method, payload) VALUES (%s, 'sendMessage', %s)''',
+            (bot_token, Json({'chat_id': chat_id, 'text': text}))
+        )
+        return True
+    
+    cursor.execute(
+        '''WITH claimed AS (
+               INSERT INTO processed_updates (bot_key, update_id) VALUES (%s, %s)
+               ON CONFLICT DO NOTHING
+               RETURNING 1
+           )
+           INSERT INTO outbox (bot_token, method, payload)
+           SELECT %s, 'sendMessage', %s FROM claimed''',
+        (bot_key, update_id, bot_token, Json({'chat_id': chat_id, 'text': text}))
+    )
+    return cursor.rowcount > 0
+
+UPDATE_DEDUP_SIZE = int(os.environ.get('UPDATE_DEDUP_SIZE', '10000'))
+
+# Недавно обработанные (md5(bot_token), update_id): повтор отсекается ещё до обращения к базе
+_recent_updates: 'OrderedDict[Tuple[str, int], None]' = OrderedDict()
+DEDUP_METRICS: Dict[str, int] = {'suppressed': 0}
+
+def is_recent_update(bot_key: str, update_id: Optional[int]) -> bool:
+    if update_id is None or (bot_key, update_id) not in _recent_updates:
+        return False
+    _recent_updates.move_to_end((bot_key, update_id))
+    DEDUP_METRICS['suppressed'] += 1
+    return True
+
+def remember_update(bot_key: str, update_id: Optional[int]):
+    if update_id is None:
+        return
+    _recent_updates[(bot_key, update_id)] = None
+    _recent_updates.move_to_end((bot_key, update_id))
+    while len(_recent_updates) > UPDATE_DEDUP_SIZE:
+        _recent_updates.popitem(last=False)
+
+def log_pool_metrics(function_name: str, context: Any):
+    flush_trace(function_name, context)
+    if DB_POOL_LOG_METRICS:
+        print(json.dumps({
+            'function': function_name,
+            'request_id': getattr(context, 'request_id', None),
+            'db_pool': POOL_METRICS,
+            'bot_cache': BOT_CACHE_METRICS,
+            'dedup': DEDUP_METRICS,
+            'traces': TRACE_HISTOGRAMS if TRACE_ENABLED else None
+        }))
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'POST')
+    trace_start()
     
     if method == 'OPTIONS':
         return {
@@ -41,13 +527,44 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     query_params = event.get('queryStringParameters', {}) or {}
-    bot_token = query_params.get('bot_token')
+    route = query_params.get('bot', '')
+    legacy_token = query_params.get('bot_token') if WEBHOOK_LEGACY_TOKEN_ROUTE else None
     
-    if not bot_token:
+    if not route.isdigit() and not legacy_token:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'bot_token is required'}),
+            'body': json.dumps({'error': 'bot is required'}),
+            'isBase64Encoded': False
+        }
+    
+    try:
+        update = json.loads(event.get('body') or '{}')
+    except ValueError:
+        update = None
+    if not isinstance(update, dict):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Invalid JSON body'}),
+            'isBase64Encoded': False
+        }
+    
+    update_id = update.get('update_id')
+    secret = get_header(event.get('headers'), 'x-telegram-bot-api-secret-token')
+    legacy = not route.isdigit()
+    
+    if legacy:
+        recent_key = token_key(legacy_token)
+    else:
+        cached = peek_cached_bot(int(route))
+        recent_key = cached['bot_key'] if cached and is_authorized(cached, secret, legacy) else None
+    
+    if recent_key and is_recent_update(recent_key, update_id):
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'ok': True}),
             'isBase64Encoded': False
         }
     
@@ -55,11 +572,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
-        cursor.execute(
-            'SELECT id, bot_token, welcome_text FROM bots WHERE bot_token = %s AND is_active = true',
-            (bot_token,)
-        )
-        bot = cursor.fetchone()
+        drain_bot_notifications(conn)
+        bot_id = resolve_legacy_route(cursor, legacy_token) if legacy else int(route)
+        bot = get_active_bot(cursor, bot_id) if bot_id is not None else None
         
         if not bot:
             return {
@@ -69,7 +584,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        update = json.loads(event.get('body', '{}'))
+        if not is_authorized(bot, secret, legacy):
+            return {
+                'statusCode': 403,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid secret token'}),
+                'isBase64Encoded': False
+            }
+        
+        bot_token = bot['bot_token']
+        bot_key = bot['bot_key']
         
         if 'message' not in update:
             return {
@@ -87,11 +611,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         message_text = message.get('text', '')
         
         if message_text == '/start':
-            telegram_api_url = f'https://api.telegram.org/bot{bot_token}/sendMessage'
-            requests.post(telegram_api_url, json={
-                'chat_id': chat_id,
-                'text': bot['welcome_text']
-            }, timeout=10)
+            if not enqueue_welcome(cursor, bot_key, update_id, bot_token, chat_id, bot['welcome_text']):
+                DEDUP_METRICS['suppressed'] += 1
+            conn.commit()
+            remember_update(bot_key, update_id)
             
             return {
                 'statusCode': 200,
@@ -100,18 +623,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        cursor.execute(
-            '''INSERT INTO messages (bot_id, chat_id, username, first_name, last_name, message_text)
-               VALUES (%s, %s, %s, %s, %s, %s)''',
-            (bot['id'], chat_id, username, first_name, last_name, message_text)
-        )
-        conn.commit()
-        
-        telegram_api_url = f'https://api.telegram.org/bot{bot_token}/sendMessage'
-        requests.post(telegram_api_url, json={
-            'chat_id': chat_id,
-            'text': '✅ Спасибо! Ваше сообщение передано владельцу.'
-        }, timeout=10)
+        DEDUP_METRICS['suppressed'] += ingest_messages(conn, [(
+            bot['id'], chat_id, username, first_name, last_name, message_text, message.get('message_id'),
+            bot_token, Json({'chat_id': chat_id, 'text': ACK_TEXT}), bot_key, update_id
+        )])
+        remember_update(bot_key, update_id)
         
         return {
             'statusCode': 200,
@@ -122,6 +638,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     except Exception as e:
         conn.rollback()
+        trace_error(e)
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -131,4 +648,5 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     finally:
         cursor.close()
-        conn.close()
+        release_db_connection(conn)
+        log_pool_metrics('telegram-webhook', context)
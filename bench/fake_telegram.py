@@ -0,0 +1,151 @@
+'''
+Business: Поддельный Telegram Bot API для бенчмарков - отвечает как api.telegram.org и считает вызовы
+Args: порт и необязательная задержка ответа в миллисекундах; токены с INVALID получают 401;
+      с enforce_limits превышение лимитов Telegram (30/с на бота, 1/с на чат с запасом 3) получает 429
+Returns: FakeTelegram с адресом base_url для TELEGRAM_API_BASE и счётчиками по методам (429 - под ключом '429')
+'''
+
+import hashlib
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Optional, Tuple
+
+class _Server(ThreadingHTTPServer):
+    # Бенчмарк открывает сотни соединений разом; стандартной очереди accept (5) не хватает
+    daemon_threads = True
+    request_queue_size = 256
+
+class FakeTelegram:
+    def __init__(self, port: int = 0, latency_ms: float = 0, enforce_limits: bool = False,
+                 rate_per_token: float = 30, rate_per_chat: float = 1, chat_burst: float = 3):
+        self.latency_ms = latency_ms
+        self.enforce_limits = enforce_limits
+        self.limits = {'token': (rate_per_token, rate_per_token), 'chat': (rate_per_chat, chat_burst)}
+        self.calls: Counter = Counter()
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self._server = _Server(('127.0.0.1', port), self._make_handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FakeTelegram':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self._buckets.clear()
+
+    def check_limits(self, token: str, payload: Dict[str, Any]) -> Optional[int]:
+        # Token bucket по боту и по чату, как у Telegram; возвращает retry_after, если запрос сверх лимита
+        keys = [(f'token:{token}',) + self.limits['token']]
+        if payload.get('chat_id') is not None:
+            keys.append((f'chat:{token}:{payload["chat_id"]}',) + self.limits['chat'])
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            for key, rate, capacity in keys:
+                tokens, updated_at = self._buckets.get(key, (capacity, now))
+                levels.append((key, min(capacity, tokens + (now - updated_at) * rate), rate))
+            # Запас в десятую долю токена покрывает разницу между моментом отправки и приёма
+            short = [(1 - tokens) / rate for _, tokens, rate in levels if tokens < 0.9]
+            if short:
+                self.calls['429'] += 1
+                return max(1, int(max(short) + 0.999))
+            for key, tokens, _ in levels:
+                self._buckets[key] = (tokens - 1, now)
+        return None
+
+    def total_calls(self) -> int:
+        with self._lock:
+            return sum(self.calls.values())
+
+    def answer(self, token: str, method: str, payload: Dict[str, Any]) -> Any:
+        with self._lock:
+            self.calls[method] += 1
+            if method in ('sendMessage', 'editMessageText'):
+                self._message_id += 1
+                message_id = self._message_id
+
+        if method == 'getMe':
+            bot_id = token.split(':', 1)[0]
+            return {
+                'id': int(bot_id) if bot_id.isdigit() else 1,
+                'is_bot': True,
+                'first_name': 'Bench',
+                'username': f'bench_{hashlib.md5(token.encode()).hexdigest()[:8]}_bot'
+            }
+        if method in ('sendMessage', 'editMessageText'):
+            return {
+                'message_id': payload.get('message_id', message_id),
+                'chat': {'id': payload.get('chat_id'), 'type': 'private'},
+                'date': int(time.time()),
+                'text': payload.get('text', '')
+            }
+        if method == 'getUpdates':
+            return []
+        return True
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                payload = json.loads(raw) if raw else {}
+
+                parts = self.path.strip('/').split('/')
+                if len(parts) != 2 or not parts[0].startswith('bot'):
+                    self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                    return
+
+                if fake.latency_ms:
+                    time.sleep(fake.latency_ms / 1000)
+                # Токены с INVALID ведут себя как отозванные
+                if 'INVALID' in parts[0]:
+                    with fake._lock:
+                        fake.calls[parts[1]] += 1
+                    self._reply(401, {'ok': False, 'error_code': 401, 'description': 'Unauthorized'})
+                    return
+                if fake.enforce_limits:
+                    retry_after = fake.check_limits(parts[0][3:], payload)
+                    if retry_after:
+                        self._reply(429, {
+                            'ok': False, 'error_code': 429,
+                            'description': f'Too Many Requests: retry after {retry_after}',
+                            'parameters': {'retry_after': retry_after}
+                        })
+                        return
+                result = fake.answer(parts[0][3:], parts[1], payload)
+                self._reply(200, {'ok': True, 'result': result})
+
+            do_GET = do_POST
+
+            def _reply(self, status: int, body: Dict[str, Any]):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
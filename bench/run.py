@@ -0,0 +1,664 @@
+'''
+Business: Нагрузочный бенчмарк функций - вызывает handler(event, context) в процессе на одноразовой
+          базе Postgres и поддельном Telegram API, считает пропускную способность, p50/p99,
+          обращения к базе и исходящие вызовы Telegram на одно обновление, проверяет планы горячих запросов
+Args: BENCH_DATABASE_URL - одноразовая база (схема public пересоздаётся!); без неё поднимается
+      временный кластер через initdb/pg_ctl из PATH или PG_BIN; параметры нагрузки - см. --help
+Returns: таблица результатов в stdout и, с --json, файл для сравнения между запусками; ненулевой код
+         выхода, если горячий запрос читает большую таблицу целиком или Telegram ответил 429
+'''
+
+import argparse
+import base64
+import glob
+import gzip
+import importlib.util
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, Any, List, Optional, Callable, Tuple
+import psycopg2
+import psycopg2.extensions
+
+from fake_telegram import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONSTRUCTOR_TOKEN = '424242:BENCH_CONSTRUCTOR_TOKEN_0000000000000'
+
+# Счётчики обращений к базе: каждый execute, commit и rollback - один round trip
+_db_lock = threading.Lock()
+DB_COUNTERS: Dict[str, int] = {'connects': 0, 'queries': 0, 'commits': 0, 'rollbacks': 0}
+_cursor_classes: Dict[type, type] = {}
+
+def count_db(name: str):
+    with _db_lock:
+        DB_COUNTERS[name] += 1
+
+def counting_cursor(base: type) -> type:
+    if base not in _cursor_classes:
+        class CountingCursor(base):
+            def execute(self, query, vars=None):
+                count_db('queries')
+                return super().execute(query, vars)
+
+        _cursor_classes[base] = CountingCursor
+    return _cursor_classes[base]
+
+_connection_classes: Dict[type, type] = {}
+
+def counting_connection(base: type) -> type:
+    # Поверх фабрики соединений функции (например, трассировки), чтобы счётчики работали и с ней
+    if base not in _connection_classes:
+        class CountingConnection(base):
+            def cursor(self, *args, **kwargs):
+                cursor_base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+                kwargs['cursor_factory'] = counting_cursor(cursor_base)
+                return super().cursor(*args, **kwargs)
+
+            def commit(self):
+                count_db('commits')
+                return super().commit()
+
+            def rollback(self):
+                count_db('rollbacks')
+                return super().rollback()
+
+        _connection_classes[base] = CountingConnection
+    return _connection_classes[base]
+
+def install_db_counters():
+    connect = psycopg2.connect
+
+    def counting_connect(*args, **kwargs):
+        count_db('connects')
+        kwargs['connection_factory'] = counting_connection(kwargs.get('connection_factory') or psycopg2.extensions.connection)
+        return connect(*args, **kwargs)
+
+    psycopg2.connect = counting_connect
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class TemporaryPostgres:
+    def __init__(self):
+        pg_bin = os.environ.get('PG_BIN')
+        self.initdb = os.path.join(pg_bin, 'initdb') if pg_bin else shutil.which('initdb')
+        self.pg_ctl = os.path.join(pg_bin, 'pg_ctl') if pg_bin else shutil.which('pg_ctl')
+        if not self.initdb or not self.pg_ctl:
+            raise SystemExit('BENCH_DATABASE_URL is not set and initdb/pg_ctl are not on PATH (set PG_BIN)')
+        self.directory = tempfile.mkdtemp(prefix='bench-pg-')
+        self.port = free_port()
+
+    def start(self) -> str:
+        data = os.path.join(self.directory, 'data')
+        subprocess.run([self.initdb, '-D', data, '-U', 'bench', '--auth=trust', '-E', 'UTF8'],
+                       check=True, stdout=subprocess.DEVNULL)
+        # fsync не выключаем: групповая запись вебхука экономит именно сброс WAL на диск при коммите
+        options = f"-p {self.port} -k {self.directory} -c listen_addresses=''"
+        subprocess.run([self.pg_ctl, '-D', data, '-o', options, '-l', os.path.join(self.directory, 'log'), '-w', 'start'],
+                       check=True, stdout=subprocess.DEVNULL)
+        return f'host={self.directory} port={self.port} user=bench dbname=postgres'
+
+    def stop(self):
+        subprocess.run([self.pg_ctl, '-D', os.path.join(self.directory, 'data'), '-m', 'immediate', 'stop'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+DURABILITY_SETTINGS = ('fsync', 'synchronous_commit', 'wal_sync_method', 'full_page_writes')
+
+def durability_settings(dsn: str) -> Dict[str, str]:
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT name, setting FROM pg_settings WHERE name = ANY(%s)', (list(DURABILITY_SETTINGS),))
+        settings = dict(cursor.fetchall())
+    conn.close()
+    return settings
+
+def apply_migrations(dsn: str):
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute('DROP SCHEMA IF EXISTS public CASCADE')
+        cursor.execute('CREATE SCHEMA public')
+        for path in sorted(glob.glob(os.path.join(ROOT, 'db_migrations', '*.sql'))):
+            with open(path, encoding='utf-8') as migration:
+                cursor.execute(migration.read())
+    conn.close()
+
+def load_function(name: str):
+    path = os.path.join(ROOT, 'backend', name, 'index.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def bot_token(index: int) -> str:
+    return f'{500000 + index}:BENCH{index:030d}'
+
+def seed(dsn: str, bots: int, owners: int) -> List[Dict[str, Any]]:
+    conn = psycopg2.connect(dsn)
+    seeded = []
+    with conn.cursor() as cursor:
+        for owner in range(owners):
+            cursor.execute(
+                'INSERT INTO bot_constructor_users (telegram_user_id, telegram_username) VALUES (%s, %s)',
+                (700000 + owner, f'owner{owner}')
+            )
+        for index in range(bots):
+            owner_id = str(700000 + index % owners)
+            cursor.execute(
+                '''INSERT INTO bots (owner_id, bot_token, bot_username)
+                   VALUES (%s, %s, %s) RETURNING id, webhook_secret''',
+                (owner_id, bot_token(index), f'bench{index}_bot')
+            )
+            bot_id, secret = cursor.fetchone()
+            seeded.append({'id': bot_id, 'owner_id': owner_id, 'bot_token': bot_token(index), 'webhook_secret': secret})
+    conn.commit()
+    conn.close()
+    return seeded
+
+HISTORY_WORDS = ['заказ', 'доставка', 'оплата', 'вопрос', 'hello', 'price', 'спасибо', 'адрес']
+
+def seed_history(dsn: str, bots: List[Dict[str, Any]], args):
+    # Планы проверяются на объёмах, близких к боевым: чужие боты других владельцев, история
+    # сообщений за два месяца с подписчиками и отправленные записи outbox. На паре тысяч строк
+    # планировщику выгоднее читать таблицу целиком, и регрессия индекса не видна
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """INSERT INTO bots (owner_id, bot_token, bot_username)
+               SELECT (800000 + g / 3)::text, (600000 + g) || ':FILLER' || lpad(g::text, 30, '0'), 'filler' || g || '_bot'
+               FROM generate_series(1, %s) g""",
+            (args.filler_bots,)
+        )
+        cursor.execute(
+            """INSERT INTO messages (bot_id, chat_id, username, first_name, message_text, is_read, created_at)
+               SELECT ids[1 + g %% array_length(ids, 1)], 100000 + g %% %(chats)s, 'user' || g %% %(chats)s, 'User',
+                      'history ' || g || ' ' || (%(words)s::text[])[1 + g %% 8] || ' ' || (%(words)s::text[])[1 + g / 8 %% 8],
+                      g %% 10 <> 0, CURRENT_TIMESTAMP - (g %% 5184000) * INTERVAL '1 second'
+               FROM generate_series(1, %(rows)s) g,
+                    (SELECT array_agg(id) AS ids FROM bots) b""",
+            {'chats': args.chats * 10, 'words': HISTORY_WORDS, 'rows': args.history_messages}
+        )
+        cursor.execute(
+            """INSERT INTO outbox (bot_token, method, payload, status, attempts, sent_at, created_at)
+               SELECT b.bot_token, 'sendMessage', jsonb_build_object('chat_id', g, 'text', 'history'), 'sent', 1,
+                      CURRENT_TIMESTAMP - (g %% 5184000) * INTERVAL '1 second',
+                      CURRENT_TIMESTAMP - (g %% 5184000) * INTERVAL '1 second'
+               FROM generate_series(1, %s) g
+               JOIN bots b ON b.id = %s""",
+            (args.history_outbox, bots[0]['id'])
+        )
+    conn.commit()
+    conn.close()
+
+def message_update(update_id: int, chat_id: int, text: str) -> Dict[str, Any]:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench', 'username': f'user{chat_id}'},
+            'text': text
+        }
+    }
+
+def callback_update(update_id: int, user_id: int, data: str) -> Dict[str, Any]:
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Owner', 'username': f'owner{user_id}'},
+            'message': {'message_id': 1, 'chat': {'id': user_id, 'type': 'private'}},
+            'data': data
+        }
+    }
+
+def telegram_event(token: str, update: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'httpMethod': 'POST',
+        'headers': {'Content-Type': 'application/json'},
+        'queryStringParameters': {'bot_token': token},
+        'body': json.dumps(update)
+    }
+
+def webhook_event(bot: Dict[str, Any], update: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'httpMethod': 'POST',
+        'headers': {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': bot['webhook_secret']},
+        'queryStringParameters': {'bot': str(bot['id'])},
+        'body': json.dumps(update)
+    }
+
+def webhook_events(bots: List[Dict[str, Any]], args, rng: random.Random, first_update_id: int = 1) -> List[Dict[str, Any]]:
+    # Смесь: /start, обычный текст и повторная доставка того же update_id
+    events = []
+    for update_id in range(first_update_id, first_update_id + args.updates):
+        bot = rng.choice(bots)
+        chat_id = 100000 + rng.randrange(args.chats)
+        text = '/start' if rng.random() < args.start_ratio else f'bench message {update_id}'
+        event = webhook_event(bot, message_update(update_id, chat_id, text))
+        events.append(event)
+        if rng.random() < args.duplicates:
+            events.append(event)
+    return events
+
+def constructor_events(bots: List[Dict[str, Any]], args, rng: random.Random) -> List[Dict[str, Any]]:
+    owners = sorted({int(bot['owner_id']) for bot in bots})
+    bots_by_owner: Dict[int, List[int]] = {}
+    for bot in bots:
+        bots_by_owner.setdefault(int(bot['owner_id']), []).append(bot['id'])
+
+    events = []
+    update_id = 1
+    while len(events) < args.constructor_updates:
+        owner = rng.choice(owners)
+        flow = [
+            message_update(update_id, owner, '/start'),
+            callback_update(update_id + 1, owner, 'my_bots'),
+            callback_update(update_id + 2, owner, f'bot_{rng.choice(bots_by_owner[owner])}'),
+            callback_update(update_id + 3, owner, 'messages'),
+            callback_update(update_id + 4, owner, 'main_menu')
+        ]
+        update_id += len(flow)
+        events.extend(telegram_event(CONSTRUCTOR_TOKEN, update) for update in flow)
+    return events[:args.constructor_updates]
+
+def api_event(user_id: str, params: Dict[str, str], etag: Optional[str] = None) -> Dict[str, Any]:
+    headers = {'X-User-Id': user_id, 'Accept-Encoding': 'gzip'}
+    if etag:
+        headers['If-None-Match'] = etag
+    return {'httpMethod': 'GET', 'headers': headers, 'queryStringParameters': params, 'body': ''}
+
+def percentile(values: List[float], share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+def response_sizes(responses: List[Dict[str, Any]]) -> Tuple[int, int]:
+    # Байты ответа на проводе против прежнего json.dumps(..., default=str) без сжатия для тех же данных
+    wire = plain = 0
+    for response in responses:
+        if response['statusCode'] != 200 or not response['body']:
+            continue
+        body = base64.b64decode(response['body']) if response.get('isBase64Encoded') else response['body'].encode()
+        wire += len(body)
+        if response['headers'].get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        try:
+            plain += len(json.dumps(json.loads(body), default=str).encode())
+        except ValueError:
+            plain += len(body)
+    return wire, plain
+
+def run_scenario(name: str, handler: Callable, events: List[Dict[str, Any]], concurrency: int,
+                 fake: FakeTelegram, units: Callable[[List[Dict[str, Any]]], int] = None) -> Dict[str, Any]:
+    latencies: List[float] = []
+    responses: List[Dict[str, Any]] = []
+    for key in DB_COUNTERS:
+        DB_COUNTERS[key] = 0
+    fake.reset()
+
+    def invoke(event: Dict[str, Any]):
+        started = time.perf_counter()
+        response = handler(event, SimpleNamespace(request_id=f'bench-{name}'))
+        latencies.append((time.perf_counter() - started) * 1000)
+        responses.append(response)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(invoke, events))
+    elapsed = time.perf_counter() - started
+
+    operations = units(responses) if units else len(events)
+    operations = max(operations, 1)
+    statuses: Dict[str, int] = {}
+    for response in responses:
+        statuses[str(response['statusCode'])] = statuses.get(str(response['statusCode']), 0) + 1
+    round_trips = DB_COUNTERS['queries'] + DB_COUNTERS['commits'] + DB_COUNTERS['rollbacks']
+    wire_bytes, plain_bytes = response_sizes(responses)
+
+    return {
+        'scenario': name,
+        'invocations': len(events),
+        'operations': operations,
+        'seconds': round(elapsed, 3),
+        'throughput': round(operations / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+        'db_round_trips_per_op': round(round_trips / operations, 2),
+        'db_connects': DB_COUNTERS['connects'],
+        'telegram_calls_per_op': round(fake.total_calls() / operations, 2),
+        'telegram_calls': dict(fake.calls),
+        'statuses': statuses,
+        'response_bytes': wire_bytes,
+        'plain_json_bytes': plain_bytes
+    }
+
+def dispatched_items(responses: List[Dict[str, Any]]) -> int:
+    total = 0
+    for response in responses:
+        if response['statusCode'] == 200:
+            stats = json.loads(response['body'])
+            total += stats['sent'] + stats['retry'] + stats['failed'] + stats['blocked']
+    return total
+
+def drain_outbox(dispatcher, fake: FakeTelegram, concurrency: int, name: str = 'telegram-dispatcher') -> Dict[str, Any]:
+    # Один вызов диспетчера разбирает очередь до конца бюджета; вызываем, пока есть что отправлять
+    event = {'httpMethod': 'POST', 'queryStringParameters': {}, 'body': ''}
+    return run_scenario(name, dispatcher.handler, [event] * concurrency, concurrency, fake,
+                        units=dispatched_items)
+
+RATE_LIMIT_ENV = ('TELEGRAM_RATE_PER_TOKEN', 'TELEGRAM_RATE_PER_CHAT', 'TELEGRAM_CHAT_BURST')
+
+def rate_limit_check(dsn: str, fake: FakeTelegram, bot: Dict[str, Any],
+                     chats: int = 10, per_chat: int = 5) -> Dict[str, Any]:
+    # Диспетчер с боевыми лимитами против Telegram, который сам отвечает 429 сверх лимита:
+    # планировщик обязан уложиться в лимиты без единого 429. Пятьдесят писем одного бота
+    # упираются и в лимит бота, и в лимит чата. Остатки прошлых сценариев снимаем,
+    # чтобы они не смешивались с проверкой
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute("UPDATE outbox SET status = 'failed', last_error = 'bench: superseded' WHERE status = 'pending'")
+        for chat in range(chats):
+            for number in range(per_chat):
+                cursor.execute(
+                    'INSERT INTO outbox (bot_token, method, payload) VALUES (%s, %s, %s)',
+                    (bot['bot_token'], 'sendMessage',
+                     json.dumps({'chat_id': 900000 + chat, 'text': f'limit check {number}'}))
+                )
+    conn.commit()
+    conn.close()
+
+    saved = {name: os.environ.pop(name, None) for name in RATE_LIMIT_ENV}
+    try:
+        dispatcher = load_function('telegram-dispatcher')
+    finally:
+        for name, value in saved.items():
+            if value is not None:
+                os.environ[name] = value
+    fake.enforce_limits = True
+    try:
+        # Один экземпляр диспетчера: лимиты считаются в памяти процесса
+        return drain_outbox(dispatcher, fake, 1, 'telegram-dispatcher limits')
+    finally:
+        fake.enforce_limits = False
+
+def count_messages(dsn: str) -> int:
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM messages')
+        total = cursor.fetchone()[0]
+    conn.close()
+    return total
+
+def ingest_scenario(dsn: str, name: str, window_ms: float, events: List[Dict[str, Any]],
+                    concurrency: int, fake: FakeTelegram) -> Dict[str, Any]:
+    # Вебхук с заданным окном групповой записи; операция - записанная строка messages
+    os.environ['INGEST_BATCH_WINDOW_MS'] = str(window_ms)
+    webhook = load_function('telegram-webhook')
+    before = count_messages(dsn)
+    return run_scenario(name, webhook.handler, events, concurrency, fake,
+                        units=lambda responses: count_messages(dsn) - before)
+
+def bulk_registration_events(args) -> List[Dict[str, Any]]:
+    # Каждый владелец регистрирует пачку новых ботов; каждый десятый токен отозван
+    events = []
+    for owner in range(args.owners):
+        tokens = [
+            f'{900000 + owner * args.bulk_tokens + index}:BENCH{"INVALID" if index % 10 == 9 else "BULK"}{owner:04d}{index:06d}'
+            for index in range(args.bulk_tokens)
+        ]
+        event = api_event(str(700000 + owner), {})
+        event['httpMethod'] = 'POST'
+        event['body'] = json.dumps({'bot_tokens': tokens})
+        events.append(event)
+    return events
+
+def registered_bots(responses: List[Dict[str, Any]]) -> int:
+    return sum(json.loads(response['body'])['registered'] for response in responses if response['statusCode'] == 200)
+
+def broadcast_events(bots: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # По рассылке на каждого бота: подписчики уже накоплены сценарием вебхука
+    events = []
+    for bot in bots:
+        event = api_event(bot['owner_id'], {'resource': 'broadcasts'})
+        event['httpMethod'] = 'POST'
+        event['body'] = json.dumps({'bot_id': bot['id'], 'text': f'bench broadcast {bot["id"]}'})
+        events.append(event)
+    return events
+
+def revalidation_events(module, requests_: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    events = []
+    for event in requests_:
+        response = module.handler(event, SimpleNamespace(request_id='bench-warmup'))
+        etag = response['headers'].get('ETag')
+        events.append(api_event(event['headers']['X-User-Id'], event['queryStringParameters'], etag))
+    return events
+
+class ExplainCursor:
+    # Курсор для функций хендлеров: запросы не выполняются, а объясняются, поэтому проверяется
+    # ровно тот SQL, который строит код; fetch* по очереди отдают заготовленные строки
+    def __init__(self, cursor, rows: List[Any] = None):
+        self.cursor = cursor
+        self.rows = list(rows or [])
+        self.plans: List[Dict[str, Any]] = []
+
+    def execute(self, sql, args=None):
+        self.cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, args)
+        self.plans.append(self.cursor.fetchone()[0][0]['Plan'])
+
+    def fetchall(self):
+        return self.rows.pop(0) if self.rows else []
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+def explain_query(cursor, query: Tuple[str, List[Any], bool]):
+    cursor.execute(query[0], query[1])
+
+def explain_broadcast_batch(modules, cursor, bots):
+    # Первый запрос выбирает рассылки; подставляем одну, чтобы объяснить выборку окна получателей
+    bot = bots[0]
+    cursor.rows = [[{'id': 0, 'bot_id': bot['id'], 'message_text': 'bench', 'last_chat_id': None,
+                     'bot_token': bot['bot_token'], 'in_flight': 0}], {'queued': 0}]
+    modules['dispatcher'].expand_broadcasts(cursor)
+
+# Запросы горячего пути, построенные самими хендлерами; проверяется план последнего выполненного запроса
+HOT_QUERIES: Dict[str, Callable] = {
+    'webhook_bot_lookup': lambda modules, cursor, bots: modules['webhook'].get_active_bot(cursor, bots[0]['id']),
+    'inbox_first_page': lambda modules, cursor, bots: modules['constructor'].fetch_inbox_page(cursor, bots[0]['owner_id']),
+    'inbox_search': lambda modules, cursor, bots: modules['constructor'].fetch_search_page(
+        cursor, bots[0]['owner_id'], 'доставка заказа'),
+    'bot_first_page': lambda modules, cursor, bots: explain_query(
+        cursor, modules['bot_messages'].build_messages_query(bots[0]['id'], {})),
+    'bot_unread_page': lambda modules, cursor, bots: explain_query(
+        cursor, modules['bot_messages'].build_messages_query(bots[0]['id'], {'is_read': 'false'})),
+    'bot_search': lambda modules, cursor, bots: explain_query(
+        cursor, modules['bot_messages'].build_messages_query(bots[0]['id'], {'q': 'доставка заказа'})),
+    'broadcast_batch': explain_broadcast_batch,
+    'outbox_claim': lambda modules, cursor, bots: modules['dispatcher'].claim_batch(
+        cursor, modules['dispatcher'].DISPATCH_BATCH_SIZE)
+}
+# Последовательное чтение таблицы больше этого числа строк на горячем пути - провал бенчмарка;
+# пустые и почти пустые секции (будущие месяцы, default) планировщик вправе читать целиком
+SEQ_SCAN_MIN_ROWS = 10000
+
+def plan_nodes(plan: Dict[str, Any]) -> List[str]:
+    node = plan['Node Type'] + (f" on {plan['Relation Name']}" if 'Relation Name' in plan else '')
+    if 'Index Name' in plan:
+        node += f" using {plan['Index Name']}"
+    nodes = [node]
+    for child in plan.get('Plans', []):
+        nodes.extend(plan_nodes(child))
+    return nodes
+
+def explain_hot_queries(dsn: str, bots: List[Dict[str, Any]], modules: Dict[str, Any]) -> Dict[str, Any]:
+    # Проверка регрессий планов: последовательное чтение большой таблицы на горячем пути - провал
+    conn = psycopg2.connect(dsn)
+    plans = {}
+    with conn.cursor() as cursor:
+        cursor.execute('ANALYZE')
+        cursor.execute(
+            "SELECT relname FROM pg_class WHERE relkind = 'r' AND reltuples >= %s", (SEQ_SCAN_MIN_ROWS,)
+        )
+        large = {row[0] for row in cursor.fetchall()}
+        for name, explain in HOT_QUERIES.items():
+            explaining = ExplainCursor(cursor)
+            explain(modules, explaining, bots)
+            nodes = plan_nodes(explaining.plans[-1])
+            plans[name] = {
+                'nodes': nodes,
+                'seq_scans': [n for n in nodes if n.startswith('Seq Scan on ') and n[len('Seq Scan on '):] in large]
+            }
+    conn.rollback()
+    conn.close()
+    return plans
+
+def print_report(results: List[Dict[str, Any]], plans: Dict[str, Any], durability: Dict[str, str]) -> List[str]:
+    print('durability ' + ', '.join(f'{name}={durability.get(name)}' for name in DURABILITY_SETTINGS))
+    if durability.get('fsync') != 'on' or durability.get('synchronous_commit') == 'off':
+        print('warning: commits are not flushed to disk, per-row vs batched ingest is not comparable')
+    header = f"{'scenario':<28}{'ops':>8}{'ops/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'db/op':>8}{'tg/op':>8}  statuses"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(
+            f"{result['scenario']:<28}{result['operations']:>8}{result['throughput']:>10}"
+            f"{result['p50_ms']:>9}{result['p99_ms']:>9}{result['db_round_trips_per_op']:>8}"
+            f"{result['telegram_calls_per_op']:>8}  {result['statuses']}"
+        )
+    # Размер ответов до (json.dumps без сжатия, всегда полное тело) и после (orjson, gzip, 304 без тела);
+    # повторный опрос с ETag раньше получал то же тело, что и первый
+    plain_sizes: Dict[str, int] = {}
+    for result in results:
+        if not result['scenario'].startswith(('bot-messages GET', 'bot-manager GET')) or not result['invocations']:
+            continue
+        base = result['scenario'].replace(' 304', '')
+        plain = plain_sizes.setdefault(base, result['plain_json_bytes'] // result['invocations'])
+        print(f"size {result['scenario']:<24}{result['response_bytes'] // result['invocations']:>8} B/response, "
+              f"before {plain} B/response")
+    for name, plan in plans.items():
+        marker = 'FAIL ' + ', '.join(plan['seq_scans']) if plan['seq_scans'] else 'ok'
+        print(f"plan {name:<24}{marker}: {' -> '.join(plan['nodes'])}")
+
+    failures = [f"plan {name}: {', '.join(plan['seq_scans'])}" for name, plan in plans.items() if plan['seq_scans']]
+    for result in results:
+        if result['telegram_calls'].get('429'):
+            failures.append(f"{result['scenario']}: {result['telegram_calls']['429']} responses 429")
+    return failures
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='In-process load test for the cloud function handlers')
+    parser.add_argument('--bots', type=int, default=50)
+    parser.add_argument('--owners', type=int, default=10)
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--filler-bots', type=int, default=3000, help='bots of other owners seeded for realistic plans')
+    parser.add_argument('--history-messages', type=int, default=300000, help='messages seeded before the run')
+    parser.add_argument('--history-outbox', type=int, default=100000, help='sent outbox rows seeded before the run')
+    parser.add_argument('--updates', type=int, default=5000, help='webhook updates to replay')
+    parser.add_argument('--constructor-updates', type=int, default=1000)
+    parser.add_argument('--start-ratio', type=float, default=0.1, help='share of /start among webhook updates')
+    parser.add_argument('--duplicates', type=float, default=0.05, help='share of redelivered webhook updates')
+    parser.add_argument('--ingest-window-ms', type=float, default=5,
+                        help='INGEST_BATCH_WINDOW_MS for the batched webhook run (the other run uses 0)')
+    parser.add_argument('--bulk-tokens', type=int, default=100, help='tokens per bulk registration request')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--telegram-latency-ms', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+
+    postgres = None
+    dsn = os.environ.get('BENCH_DATABASE_URL')
+    if not dsn:
+        postgres = TemporaryPostgres()
+        dsn = postgres.start()
+    fake = FakeTelegram(latency_ms=args.telegram_latency_ms).start()
+
+    try:
+        apply_migrations(dsn)
+        bots = seed(dsn, args.bots, args.owners)
+        seed_history(dsn, bots, args)
+
+        # Бенчмарк меряет код, а не лимиты Telegram; их можно вернуть через переменные окружения
+        os.environ['DATABASE_URL'] = dsn
+        os.environ['TELEGRAM_API_BASE'] = fake.base_url
+        os.environ['CONSTRUCTOR_BOT_TOKEN'] = CONSTRUCTOR_TOKEN
+        os.environ.setdefault('DISPATCH_IDLE_LISTEN', '0')
+        os.environ.setdefault('TELEGRAM_RATE_PER_TOKEN', '1000000')
+        os.environ.setdefault('TELEGRAM_RATE_PER_CHAT', '1000000')
+        os.environ.setdefault('TELEGRAM_CHAT_BURST', '1000000')
+        os.environ.setdefault('BROADCAST_RATE', '1000000')
+        os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.concurrency))
+        install_db_counters()
+
+        constructor = load_function('telegram-bot-constructor')
+        dispatcher = load_function('telegram-dispatcher')
+        bot_messages = load_function('bot-messages')
+        bot_manager = load_function('bot-manager')
+
+        # Одни и те же параметры нагрузки построчно (окно 0) и с групповой записью; update_id не пересекаются
+        results = [
+            ingest_scenario(dsn, 'telegram-webhook per-row', 0, webhook_events(bots, args, rng),
+                            args.concurrency, fake),
+            ingest_scenario(dsn, f'telegram-webhook batch {args.ingest_window_ms:g}ms', args.ingest_window_ms,
+                            webhook_events(bots, args, rng, first_update_id=args.updates + 1), args.concurrency, fake),
+            run_scenario('telegram-bot-constructor', constructor.handler, constructor_events(bots, args, rng),
+                         args.concurrency, fake),
+            drain_outbox(dispatcher, fake, args.concurrency)
+        ]
+
+        messages_requests = [api_event(bot['owner_id'], {'bot_id': str(bot['id'])}) for bot in bots]
+        results.append(run_scenario('bot-messages GET', bot_messages.handler, messages_requests, args.concurrency, fake))
+        results.append(run_scenario('bot-messages GET 304', bot_messages.handler,
+                                    revalidation_events(bot_messages, messages_requests), args.concurrency, fake))
+
+        manager_requests = [api_event(owner, {}) for owner in sorted({bot['owner_id'] for bot in bots})]
+        results.append(run_scenario('bot-manager GET', bot_manager.handler, manager_requests, args.concurrency, fake))
+        results.append(run_scenario('bot-manager GET 304', bot_manager.handler,
+                                    revalidation_events(bot_manager, manager_requests), args.concurrency, fake))
+
+        results.append(run_scenario('bot-manager bulk POST', bot_manager.handler, bulk_registration_events(args),
+                                    args.concurrency, fake, units=registered_bots))
+        results.append(run_scenario('bot-manager broadcast POST', bot_manager.handler, broadcast_events(bots),
+                                    args.concurrency, fake))
+        results.append(drain_outbox(dispatcher, fake, args.concurrency, 'telegram-dispatcher broadcast'))
+        results.append(rate_limit_check(dsn, fake, bots[0]))
+
+        plans = explain_hot_queries(dsn, bots, {
+            'webhook': load_function('telegram-webhook'), 'constructor': constructor,
+            'dispatcher': dispatcher, 'bot_messages': bot_messages
+        })
+        durability = durability_settings(dsn)
+        failures = print_report(results, plans, durability)
+
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as output:
+                json.dump({'args': vars(args), 'durability': durability, 'results': results, 'plans': plans,
+                           'failures': failures}, output, indent=2)
+    finally:
+        fake.stop()
+        if postgres:
+            postgres.stop()
+    if failures:
+        raise SystemExit(f'FAILED: {"; ".join(failures)}')
+
+if __name__ == '__main__':
+    main()
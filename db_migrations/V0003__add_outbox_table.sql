@@ -0,0 +1,16 @@
+-- Очередь исходящих сообщений Telegram: вебхук только пишет в неё, отправкой занимается диспетчер
+CREATE TABLE IF NOT EXISTS outbox (
+    id SERIAL PRIMARY KEY,
+    bot_token VARCHAR(255) NOT NULL,
+    method VARCHAR(64) NOT NULL DEFAULT 'sendMessage',
+    payload JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP
+);
+
+-- Диспетчер выбирает только ожидающие отправки записи в порядке готовности
+CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(next_attempt_at) WHERE status = 'pending';
@@ -0,0 +1,17 @@
+-- Уведомляем вебхук об изменении ботов, чтобы он сбрасывал закэшированные записи
+CREATE OR REPLACE FUNCTION notify_bots_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM pg_notify('bots_changed', md5(OLD.bot_token));
+    END IF;
+    IF TG_OP <> 'DELETE' AND (TG_OP = 'INSERT' OR NEW.bot_token <> OLD.bot_token) THEN
+        PERFORM pg_notify('bots_changed', md5(NEW.bot_token));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_bots_changed ON bots;
+CREATE TRIGGER trg_bots_changed
+    AFTER INSERT OR UPDATE OR DELETE ON bots
+    FOR EACH ROW EXECUTE FUNCTION notify_bots_changed();
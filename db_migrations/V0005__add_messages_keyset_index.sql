@@ -0,0 +1,2 @@
+-- Индекс для keyset-пагинации входящих сообщений бота по (created_at, id)
+CREATE INDEX IF NOT EXISTS idx_messages_bot_created_id ON messages(bot_id, created_at DESC, id DESC);
@@ -0,0 +1,16 @@
+-- UNIQUE (bot_token) уже создаёт индекс, отдельный idx_bots_bot_token только замедляет запись
+DROP INDEX IF EXISTS idx_bots_bot_token;
+
+-- bot_id является префиксом idx_messages_bot_created_id
+DROP INDEX IF EXISTS idx_messages_bot_id;
+
+-- Глобальный индекс по is_read бесполезен: ищем непрочитанные в рамках бота
+DROP INDEX IF EXISTS idx_messages_is_read;
+CREATE INDEX IF NOT EXISTS idx_messages_bot_unread ON messages(bot_id, created_at DESC, id DESC) WHERE is_read = false;
+
+-- Списки ботов владельца и JOIN messages -> bots всегда фильтруют по is_active = true
+DROP INDEX IF EXISTS idx_bots_owner_id;
+CREATE INDEX IF NOT EXISTS idx_bots_owner_active ON bots(owner_id, id) WHERE is_active = true;
+
+-- UNIQUE (telegram_user_id) уже создаёт индекс
+DROP INDEX IF EXISTS idx_bot_constructor_users_telegram_id;
@@ -0,0 +1,79 @@
+-- Счётчики входящих по боту, поддерживаются триггерами вместо агрегации messages
+CREATE TABLE IF NOT EXISTS bot_stats (
+    bot_id INTEGER PRIMARY KEY REFERENCES bots(id),
+    total_count INTEGER NOT NULL DEFAULT 0,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    last_message_at TIMESTAMP
+);
+
+INSERT INTO bot_stats (bot_id, total_count, unread_count, last_message_at)
+SELECT bot_id, COUNT(*), COUNT(*) FILTER (WHERE is_read IS NOT TRUE), MAX(created_at)
+FROM messages
+WHERE bot_id IS NOT NULL
+GROUP BY bot_id
+ON CONFLICT (bot_id) DO NOTHING;
+
+-- Триггеры уровня оператора: пакетная вставка обновляет строку бота один раз
+CREATE OR REPLACE FUNCTION bot_stats_on_insert() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO bot_stats (bot_id, total_count, unread_count, last_message_at)
+    SELECT bot_id, COUNT(*), COUNT(*) FILTER (WHERE is_read IS NOT TRUE), MAX(created_at)
+    FROM new_rows
+    WHERE bot_id IS NOT NULL
+    GROUP BY bot_id
+    ON CONFLICT (bot_id) DO UPDATE
+    SET total_count = bot_stats.total_count + EXCLUDED.total_count,
+        unread_count = bot_stats.unread_count + EXCLUDED.unread_count,
+        last_message_at = GREATEST(bot_stats.last_message_at, EXCLUDED.last_message_at);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bot_stats_on_update() RETURNS trigger AS $$
+BEGIN
+    UPDATE bot_stats s
+    SET unread_count = s.unread_count + d.delta
+    FROM (
+        SELECT n.bot_id,
+               SUM((n.is_read IS NOT TRUE)::int - (o.is_read IS NOT TRUE)::int) AS delta
+        FROM old_rows o
+        JOIN new_rows n ON n.id = o.id
+        GROUP BY n.bot_id
+    ) d
+    WHERE s.bot_id = d.bot_id AND d.delta <> 0;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bot_stats_on_delete() RETURNS trigger AS $$
+BEGIN
+    UPDATE bot_stats s
+    SET total_count = s.total_count - d.total_count,
+        unread_count = s.unread_count - d.unread_count
+    FROM (
+        SELECT bot_id, COUNT(*) AS total_count, COUNT(*) FILTER (WHERE is_read IS NOT TRUE) AS unread_count
+        FROM old_rows
+        GROUP BY bot_id
+    ) d
+    WHERE s.bot_id = d.bot_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_messages_stats_insert ON messages;
+CREATE TRIGGER trg_messages_stats_insert
+    AFTER INSERT ON messages
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bot_stats_on_insert();
+
+DROP TRIGGER IF EXISTS trg_messages_stats_update ON messages;
+CREATE TRIGGER trg_messages_stats_update
+    AFTER UPDATE ON messages
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bot_stats_on_update();
+
+DROP TRIGGER IF EXISTS trg_messages_stats_delete ON messages;
+CREATE TRIGGER trg_messages_stats_delete
+    AFTER DELETE ON messages
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bot_stats_on_delete();
@@ -0,0 +1,2 @@
+-- Архивированные сообщения скрываются из входящих, но остаются в истории
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS is_archived BOOLEAN NOT NULL DEFAULT false;
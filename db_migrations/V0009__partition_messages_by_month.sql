@@ -0,0 +1,75 @@
+-- Переводим messages на помесячное секционирование по created_at.
+-- Существующая таблица не копируется, а подключается секцией до начала следующего месяца.
+ALTER TABLE messages RENAME TO messages_legacy;
+ALTER INDEX messages_pkey RENAME TO messages_legacy_pkey;
+ALTER INDEX idx_messages_bot_created_id RENAME TO idx_messages_legacy_bot_created_id;
+ALTER INDEX idx_messages_bot_unread RENAME TO idx_messages_legacy_bot_unread;
+
+DROP TRIGGER IF EXISTS trg_messages_stats_insert ON messages_legacy;
+DROP TRIGGER IF EXISTS trg_messages_stats_update ON messages_legacy;
+DROP TRIGGER IF EXISTS trg_messages_stats_delete ON messages_legacy;
+
+UPDATE messages_legacy SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+ALTER TABLE messages_legacy ALTER COLUMN created_at SET NOT NULL;
+-- Ключ секции должен совпадать с ключом родительской таблицы
+ALTER TABLE messages_legacy DROP CONSTRAINT messages_legacy_pkey;
+ALTER TABLE messages_legacy ADD CONSTRAINT messages_legacy_pkey PRIMARY KEY (id, created_at);
+
+CREATE TABLE messages (
+    id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+    bot_id INTEGER REFERENCES bots(id),
+    chat_id BIGINT NOT NULL,
+    username VARCHAR(255),
+    first_name VARCHAR(255),
+    last_name VARCHAR(255),
+    message_text TEXT NOT NULL,
+    is_read BOOLEAN DEFAULT false,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    is_archived BOOLEAN NOT NULL DEFAULT false,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+CREATE INDEX IF NOT EXISTS idx_messages_bot_created_id ON messages(bot_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_bot_unread ON messages(bot_id, created_at DESC, id DESC) WHERE is_read = false;
+
+DO $$
+DECLARE
+    next_month DATE := date_trunc('month', CURRENT_DATE) + INTERVAL '1 month';
+BEGIN
+    EXECUTE format(
+        'ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        next_month
+    );
+    FOR i IN 0..1 LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+            'messages_p' || to_char(next_month + i * INTERVAL '1 month', 'YYYYMM'),
+            next_month + i * INTERVAL '1 month',
+            next_month + (i + 1) * INTERVAL '1 month'
+        );
+    END LOOP;
+END;
+$$;
+
+-- Страховочная секция: сюда попадут строки, если обслуживание не успело создать нужный месяц
+CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;
+
+CREATE TRIGGER trg_messages_stats_insert
+    AFTER INSERT ON messages
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bot_stats_on_insert();
+
+CREATE TRIGGER trg_messages_stats_update
+    AFTER UPDATE ON messages
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bot_stats_on_update();
+
+CREATE TRIGGER trg_messages_stats_delete
+    AFTER DELETE ON messages
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bot_stats_on_delete();
+
+-- Срок хранения сообщений бота в днях; NULL - хранить, пока не истечёт общий срок
+ALTER TABLE bots ADD COLUMN IF NOT EXISTS retention_days INTEGER;
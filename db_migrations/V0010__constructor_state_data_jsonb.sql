@@ -0,0 +1,4 @@
+-- Состояние диалога конструктора хранится как JSONB, без json.loads/json.dumps на каждый запрос
+ALTER TABLE bot_constructor_users
+    ALTER COLUMN state_data TYPE JSONB USING NULLIF(state_data, '')::jsonb;
+ALTER TABLE bot_constructor_users ALTER COLUMN state_data SET DEFAULT '{}'::jsonb;
@@ -0,0 +1,10 @@
+-- Обработанные update_id Telegram для подавления повторных доставок; бот идентифицируется md5(bot_token)
+CREATE TABLE IF NOT EXISTS processed_updates (
+    bot_key CHAR(32) NOT NULL,
+    update_id BIGINT NOT NULL,
+    processed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (bot_key, update_id)
+);
+
+-- Для очистки по сроку жизни
+CREATE INDEX IF NOT EXISTS idx_processed_updates_processed_at ON processed_updates(processed_at);
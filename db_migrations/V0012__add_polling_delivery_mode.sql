@@ -0,0 +1,9 @@
+-- Способ получения обновлений: webhook (по умолчанию) или long polling через воркер getUpdates
+ALTER TABLE bots ADD COLUMN IF NOT EXISTS delivery_mode VARCHAR(16) NOT NULL DEFAULT 'webhook';
+
+-- Смещение getUpdates для ботов в режиме polling; отдельно от bots, чтобы не будить триггер кэша
+CREATE TABLE IF NOT EXISTS bot_poll_offsets (
+    bot_id INTEGER PRIMARY KEY REFERENCES bots(id),
+    update_offset BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,16 @@
+-- Идентификатор сообщения в чате с ботом - ответ владельца уходит как нативный reply
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS telegram_message_id BIGINT;
+
+-- Ключ ответа: сообщение-приглашение в чате владельца -> исходное сообщение и чат отправителя
+CREATE TABLE IF NOT EXISTS reply_keys (
+    owner_chat_id BIGINT NOT NULL,
+    prompt_message_id BIGINT NOT NULL,
+    message_id INTEGER NOT NULL,
+    bot_id INTEGER NOT NULL REFERENCES bots(id),
+    chat_id BIGINT NOT NULL,
+    telegram_message_id BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (owner_chat_id, prompt_message_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_reply_keys_created_at ON reply_keys(created_at);
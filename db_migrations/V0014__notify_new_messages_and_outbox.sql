@@ -0,0 +1,27 @@
+-- Push вместо опроса: новые сообщения будят ожидающие запросы bot-messages (wait),
+-- новые записи outbox будят простаивающий диспетчер
+CREATE OR REPLACE FUNCTION notify_messages_new() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('messages_new', json_build_object('bot_id', bot_id, 'last_id', last_id)::text)
+    FROM (SELECT bot_id, MAX(id) AS last_id FROM new_rows GROUP BY bot_id) n;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_messages_notify_new ON messages;
+CREATE TRIGGER trg_messages_notify_new
+    AFTER INSERT ON messages
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_messages_new();
+
+CREATE OR REPLACE FUNCTION notify_outbox_pending() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('outbox_pending', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_outbox_notify_pending ON outbox;
+CREATE TRIGGER trg_outbox_notify_pending
+    AFTER INSERT ON outbox
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_outbox_pending();
@@ -0,0 +1,52 @@
+-- Версия изменений сообщений бота: на ней строятся ETag для bot-manager и bot-messages
+ALTER TABLE bot_stats ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION bot_stats_on_insert() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO bot_stats (bot_id, total_count, unread_count, last_message_at, version)
+    SELECT bot_id, COUNT(*), COUNT(*) FILTER (WHERE is_read IS NOT TRUE), MAX(created_at), 1
+    FROM new_rows
+    WHERE bot_id IS NOT NULL
+    GROUP BY bot_id
+    ON CONFLICT (bot_id) DO UPDATE
+    SET total_count = bot_stats.total_count + EXCLUDED.total_count,
+        unread_count = bot_stats.unread_count + EXCLUDED.unread_count,
+        last_message_at = GREATEST(bot_stats.last_message_at, EXCLUDED.last_message_at),
+        version = bot_stats.version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Архивация прочитанных не меняет счётчики, но меняет выдачу - версию двигаем всегда
+CREATE OR REPLACE FUNCTION bot_stats_on_update() RETURNS trigger AS $$
+BEGIN
+    UPDATE bot_stats s
+    SET unread_count = s.unread_count + d.delta,
+        version = s.version + 1
+    FROM (
+        SELECT n.bot_id,
+               SUM((n.is_read IS NOT TRUE)::int - (o.is_read IS NOT TRUE)::int) AS delta
+        FROM old_rows o
+        JOIN new_rows n ON n.id = o.id
+        GROUP BY n.bot_id
+    ) d
+    WHERE s.bot_id = d.bot_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bot_stats_on_delete() RETURNS trigger AS $$
+BEGIN
+    UPDATE bot_stats s
+    SET total_count = s.total_count - d.total_count,
+        unread_count = s.unread_count - d.unread_count,
+        version = s.version + 1
+    FROM (
+        SELECT bot_id, COUNT(*) AS total_count, COUNT(*) FILTER (WHERE is_read IS NOT TRUE) AS unread_count
+        FROM old_rows
+        GROUP BY bot_id
+    ) d
+    WHERE s.bot_id = d.bot_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,17 @@
+-- Полнотекстовый поиск по входящим: текст (русская и английская морфология) и имя отправителя.
+-- Хранимая генерируемая колонка считается при вставке, секции переписываются один раз при миграции
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+    setweight(to_tsvector('russian', message_text), 'A') ||
+    setweight(to_tsvector('english', message_text), 'B') ||
+    setweight(to_tsvector('simple', COALESCE(username, '') || ' ' || COALESCE(first_name, '') || ' ' || COALESCE(last_name, '')), 'C')
+) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_vector);
+
+-- Короткие запросы (префиксы, ники, номера) ищутся подстрокой по триграммам;
+-- выражение должно совпадать с SEARCH_TEXT_SQL в bot-messages и конструкторе
+CREATE INDEX IF NOT EXISTS idx_messages_search_trgm ON messages USING GIN (
+    (message_text || ' ' || COALESCE(username, '') || ' ' || COALESCE(first_name, '') || ' ' || COALESCE(last_name, '')) gin_trgm_ops
+);
@@ -0,0 +1,26 @@
+-- Вебхук адресуется по id бота (?bot=<id>), а подлинность запроса подтверждает
+-- заголовок X-Telegram-Bot-Api-Secret-Token; токен больше не попадает в URL и логи
+ALTER TABLE bots ADD COLUMN IF NOT EXISTS webhook_secret VARCHAR(64) NOT NULL
+    DEFAULT replace(gen_random_uuid()::text, '-', '');
+
+-- Кэш вебхука теперь ключуется по id бота
+CREATE OR REPLACE FUNCTION notify_bots_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('bots_changed', OLD.id::text);
+    ELSE
+        PERFORM pg_notify('bots_changed', NEW.id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Вебхуки существующих ботов ещё смотрят на ?bot_token=: у них пустой webhook_registered_at.
+-- Диспетчер ставит в outbox setWebhook с адресом из WEBHOOK_URL и секретом (webhook_requested_at),
+-- а webhook_registered_at заполняет, только когда Telegram принял вызов.
+-- Новые боты регистрируются сразу при подключении, им ставится текущее время
+ALTER TABLE bots ADD COLUMN IF NOT EXISTS webhook_registered_at TIMESTAMP;
+ALTER TABLE bots ALTER COLUMN webhook_registered_at SET DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE bots ADD COLUMN IF NOT EXISTS webhook_requested_at TIMESTAMP;
+CREATE INDEX IF NOT EXISTS idx_bots_webhook_unregistered ON bots(id)
+    WHERE webhook_registered_at IS NULL;
@@ -0,0 +1,66 @@
+-- Подписчики бота: все чаты, когда-либо писавшие ему. Ведётся триггером по вставкам в messages
+-- и переживает удаление старых сообщений; blocked_at ставит диспетчер, когда чат заблокировал бота
+CREATE TABLE IF NOT EXISTS bot_subscribers (
+    bot_id INTEGER NOT NULL REFERENCES bots(id),
+    chat_id BIGINT NOT NULL,
+    first_seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    blocked_at TIMESTAMP,
+    PRIMARY KEY (bot_id, chat_id)
+);
+
+INSERT INTO bot_subscribers (bot_id, chat_id, first_seen_at, last_seen_at)
+SELECT bot_id, chat_id, MIN(created_at), MAX(created_at)
+FROM messages
+WHERE bot_id IS NOT NULL
+GROUP BY bot_id, chat_id
+ON CONFLICT (bot_id, chat_id) DO NOTHING;
+
+-- Строку подписчика переписываем только при разблокировке или раз в час,
+-- чтобы поток сообщений из одного чата не порождал по обновлению на каждую вставку
+CREATE OR REPLACE FUNCTION bot_subscribers_on_insert() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO bot_subscribers (bot_id, chat_id, first_seen_at, last_seen_at)
+    SELECT bot_id, chat_id, MIN(created_at), MAX(created_at)
+    FROM new_rows
+    WHERE bot_id IS NOT NULL
+    GROUP BY bot_id, chat_id
+    ON CONFLICT (bot_id, chat_id) DO UPDATE
+    SET last_seen_at = EXCLUDED.last_seen_at,
+        blocked_at = NULL
+    WHERE bot_subscribers.blocked_at IS NOT NULL
+       OR bot_subscribers.last_seen_at < EXCLUDED.last_seen_at - INTERVAL '1 hour';
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_messages_subscribers_insert ON messages;
+CREATE TRIGGER trg_messages_subscribers_insert
+    AFTER INSERT ON messages
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bot_subscribers_on_insert();
+
+-- Рассылка: running - диспетчер дописывает в outbox очередные пачки после last_chat_id,
+-- queued - все получатели в очереди, done/cancelled - завершена
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id SERIAL PRIMARY KEY,
+    bot_id INTEGER NOT NULL REFERENCES bots(id),
+    message_text TEXT NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'running',
+    total_count INTEGER NOT NULL DEFAULT 0,
+    queued_count INTEGER NOT NULL DEFAULT 0,
+    sent_count INTEGER NOT NULL DEFAULT 0,
+    failed_count INTEGER NOT NULL DEFAULT 0,
+    blocked_count INTEGER NOT NULL DEFAULT 0,
+    last_chat_id BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_broadcasts_bot_id ON broadcasts(bot_id, id DESC);
+CREATE INDEX IF NOT EXISTS idx_broadcasts_active ON broadcasts(id) WHERE status IN ('running', 'queued');
+
+-- Записи рассылки в outbox ссылаются на неё для подсчёта прогресса и отмены
+ALTER TABLE outbox ADD COLUMN IF NOT EXISTS broadcast_id INTEGER REFERENCES broadcasts(id);
+CREATE INDEX IF NOT EXISTS idx_outbox_broadcast_pending ON outbox(broadcast_id) WHERE status = 'pending';
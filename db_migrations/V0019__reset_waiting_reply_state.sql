@@ -0,0 +1,5 @@
+-- Состояния waiting_reply больше нет: ответы идут через reply_keys. Пользователи, застрявшие в нём,
+-- возвращаются в главное меню, а токен бота из state_data удаляется вместе с состоянием
+UPDATE bot_constructor_users
+SET state = 'idle', state_data = '{}', updated_at = CURRENT_TIMESTAMP
+WHERE state = 'waiting_reply';
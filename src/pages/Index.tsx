@@ -28,7 +28,6 @@ type Bot = {
 
 const BOT_MANAGER_URL = 'https://functions.poehali.dev/7a54001b-4010-4175-9428-a7e922d7da84';
 const BOT_MESSAGES_URL = 'https://functions.poehali.dev/a23d9b25-8628-485e-893e-7fb977d07046';
-const WEBHOOK_URL = 'https://functions.poehali.dev/af40ed3c-a51d-4f3f-ae16-ef69f32d3a02';
 const BOT_CONSTRUCTOR_WEBHOOK = 'https://functions.poehali.dev/79eb3c45-12ba-4c25-bf0a-00e946f51c3b';
 
 const Index = () => {
@@ -53,9 +52,47 @@ const Index = () => {
   }, []);
 
   useEffect(() => {
-    if (currentBot) {
-      loadMessages();
-    }
+    if (!currentBot) return;
+    const controller = new AbortController();
+    let newestId: number | null = null;
+
+    const pause = () => new Promise((resolve) => setTimeout(resolve, 5000));
+
+    // Долгий опрос: сервер держит запрос до прихода нового сообщения. Первая итерация
+    // загружает текущую страницу. Ошибку и ответ без ожидания (лимит ожидающих на сервере)
+    // не повторяем сразу, чтобы не крутить запросы в цикле
+    const listen = async () => {
+      while (!controller.signal.aborted) {
+        try {
+          const cursor = newestId ? `&after_id=${newestId}` : '';
+          const response = await fetch(`${BOT_MESSAGES_URL}?bot_id=${currentBot.id}&wait=25${cursor}`, {
+            method: 'GET',
+            headers: {
+              'X-User-Id': userId,
+            },
+            signal: controller.signal,
+          });
+          if (!response.ok) {
+            await pause();
+            continue;
+          }
+          const data = await response.json();
+          if (data.newest_id) {
+            const incremental = newestId !== null;
+            setMessages((prev) => (incremental ? [...data.messages, ...prev] : data.messages));
+            newestId = data.newest_id;
+          } else if (!data.waited) {
+            await pause();
+          }
+        } catch (error) {
+          if (controller.signal.aborted) return;
+          await pause();
+        }
+      }
+    };
+
+    listen();
+    return () => controller.abort();
   }, [currentBot]);
 
   const loadBotData = async () => {
@@ -76,24 +113,6 @@ const Index = () => {
     }
   };
 
-  const loadMessages = async () => {
-    if (!currentBot) return;
-    try {
-      const response = await fetch(`${BOT_MESSAGES_URL}?bot_id=${currentBot.id}`, {
-        method: 'GET',
-        headers: {
-          'X-User-Id': userId,
-        },
-      });
-      const data = await response.json();
-      if (data.messages) {
-        setMessages(data.messages);
-      }
-    } catch (error) {
-      console.error('Error loading messages:', error);
-    }
-  };
-
   const handleConnectBot = async () => {
     if (botToken.length < 10) {
       toast({
@@ -122,13 +141,6 @@ const Index = () => {
 
       if (response.ok && data.success) {
         setCurrentBot(data.bot);
-        
-        const webhookUrl = `${WEBHOOK_URL}?bot_token=${botToken}`;
-        await fetch(`https://api.telegram.org/bot${botToken}/setWebhook`, {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ url: webhookUrl }),
-        });
 
         setScreen('home');
         setBotToken('');
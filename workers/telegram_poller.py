@@ -0,0 +1,186 @@
+'''
+Business: Воркер long polling getUpdates - обслуживает ботов в режиме delivery_mode = 'polling' из одного процесса
+Args: переменные окружения DATABASE_URL, POLL_TIMEOUT, POLL_REFRESH_SECONDS, POLL_WORKERS
+Returns: работает до SIGINT/SIGTERM; обновления передаются в telegram-webhook handler
+'''
+
+import asyncio
+import importlib.util
+import json
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, Any, List
+import aiohttp
+
+POLL_TIMEOUT = int(os.environ.get('POLL_TIMEOUT', '25'))
+POLL_REFRESH_SECONDS = float(os.environ.get('POLL_REFRESH_SECONDS', '30'))
+POLL_WORKERS = int(os.environ.get('POLL_WORKERS', '16'))
+POLL_ERROR_BACKOFF = float(os.environ.get('POLL_ERROR_BACKOFF', '5'))
+
+# Обновления из множества ботов приходят параллельно, поэтому групповая запись вебхука имеет смысл
+os.environ.setdefault('INGEST_BATCH_WINDOW_MS', '5')
+os.environ.setdefault('DB_POOL_MAX_SIZE', str(POLL_WORKERS))
+
+WEBHOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'telegram-webhook', 'index.py')
+_spec = importlib.util.spec_from_file_location('telegram_webhook', WEBHOOK_PATH)
+webhook = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(webhook)
+
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org')
+
+def load_polling_bots() -> List[Dict[str, Any]]:
+    conn = webhook.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                '''SELECT b.id, b.bot_token, b.webhook_secret, COALESCE(o.update_offset, 0)
+                   FROM bots b
+                   LEFT JOIN bot_poll_offsets o ON o.bot_id = b.id
+                   WHERE b.is_active = true AND b.delivery_mode = 'polling' '''
+            )
+            rows = cursor.fetchall()
+        conn.commit()
+        return [
+            {'id': bot_id, 'bot_token': bot_token, 'webhook_secret': secret, 'offset': offset}
+            for bot_id, bot_token, secret, offset in rows
+        ]
+    finally:
+        webhook.release_db_connection(conn)
+
+def save_offset(bot_id: int, offset: int):
+    conn = webhook.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                '''INSERT INTO bot_poll_offsets (bot_id, update_offset, updated_at)
+                   VALUES (%s, %s, CURRENT_TIMESTAMP)
+                   ON CONFLICT (bot_id) DO UPDATE
+                   SET update_offset = EXCLUDED.update_offset, updated_at = CURRENT_TIMESTAMP''',
+                (bot_id, offset)
+            )
+        conn.commit()
+    finally:
+        webhook.release_db_connection(conn)
+
+def deactivate_bot(bot: Dict[str, Any]):
+    # Токен отозван или бот удалён: без отключения бот снова попадал бы в опрос при каждом обновлении списка.
+    # Условие по токену не даёт отключить бота, которому владелец тем временем прислал новый токен
+    conn = webhook.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                '''UPDATE bots SET is_active = false, updated_at = CURRENT_TIMESTAMP
+                   WHERE id = %s AND bot_token = %s''',
+                (bot['id'], bot['bot_token'])
+            )
+        conn.commit()
+    finally:
+        webhook.release_db_connection(conn)
+
+def ingest_update(bot: Dict[str, Any], update: Dict[str, Any]) -> int:
+    event = {
+        'httpMethod': 'POST',
+        'headers': {'X-Telegram-Bot-Api-Secret-Token': bot['webhook_secret']},
+        'queryStringParameters': {'bot': str(bot['id'])},
+        'body': json.dumps(update)
+    }
+    context = SimpleNamespace(request_id=f'poll-{update.get("update_id")}')
+    return webhook.handler(event, context)['statusCode']
+
+async def poll_bot(session: aiohttp.ClientSession, executor: ThreadPoolExecutor, bot: Dict[str, Any]):
+    loop = asyncio.get_running_loop()
+    url = f'{TELEGRAM_API_BASE}/bot{bot["bot_token"]}'
+    offset = bot['offset']
+    
+    while True:
+        try:
+            async with session.post(
+                f'{url}/getUpdates',
+                json={'offset': offset, 'timeout': POLL_TIMEOUT, 'allowed_updates': ['message']},
+                timeout=aiohttp.ClientTimeout(total=POLL_TIMEOUT + 10)
+            ) as response:
+                status = response.status
+                data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            await asyncio.sleep(POLL_ERROR_BACKOFF)
+            continue
+        
+        if status == 409:
+            # У бота ещё установлен вебхук - getUpdates с ним несовместим
+            async with session.post(f'{url}/deleteWebhook', json={}) as response:
+                await response.read()
+            continue
+        if status in (401, 404):
+            await loop.run_in_executor(executor, deactivate_bot, bot)
+            return
+        if status == 429:
+            await asyncio.sleep(data.get('parameters', {}).get('retry_after', POLL_ERROR_BACKOFF))
+            continue
+        if status != 200:
+            await asyncio.sleep(POLL_ERROR_BACKOFF)
+            continue
+        
+        updates = data.get('result', [])
+        if not updates:
+            continue
+        
+        statuses = await asyncio.gather(*(
+            loop.run_in_executor(executor, ingest_update, bot, update) for update in updates
+        ), return_exceptions=True)
+        
+        # Смещение двигается только до первого необработанного обновления; повтор безопасен,
+        # вебхук отбрасывает уже обработанные update_id
+        next_offset = offset
+        for update, result in zip(updates, statuses):
+            if isinstance(result, Exception) or result >= 500:
+                break
+            next_offset = update['update_id'] + 1
+        
+        if next_offset != offset:
+            offset = next_offset
+            await loop.run_in_executor(executor, save_offset, bot['id'], offset)
+        else:
+            await asyncio.sleep(POLL_ERROR_BACKOFF)
+
+async def run(stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=POLL_WORKERS)
+    tasks: Dict[int, asyncio.Task] = {}
+    
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        while not stop.is_set():
+            bots = await loop.run_in_executor(executor, load_polling_bots)
+            active = {bot['id']: bot for bot in bots}
+            
+            for bot_id in list(tasks):
+                if bot_id not in active or tasks[bot_id].done():
+                    tasks.pop(bot_id).cancel()
+            for bot_id, bot in active.items():
+                if bot_id not in tasks:
+                    tasks[bot_id] = asyncio.create_task(poll_bot(session, executor, bot))
+            
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=POLL_REFRESH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+    executor.shutdown(wait=True)
+
+def main():
+    stop = asyncio.Event()
+    
+    async def serve():
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await run(stop)
+    
+    asyncio.run(serve())
+
+if __name__ == '__main__':
+    main()